@@ -0,0 +1,34 @@
+import time
+
+from botconf import Conf
+
+conf = Conf("paradox.conf")
+
+# This script adds the index on property values, used by find and find_not_empty, to an existing database.
+# New sqlite databases get the index when their tables are created, but building it on a large table takes a while,
+# so it may be run here with the bot stopped instead of at the next startup.
+# Run it from the bot directory.
+
+print("Connecting to the database")
+DB_TYPE = conf.get("DB_TyPE")
+if not DB_TYPE or DB_TYPE.lower() == "sqlite":
+    from paradata_sqlite import BotData
+    data = BotData(app="", data_file=conf.get("bot_data_file"))
+elif DB_TYPE == "mysql":
+    from paradata_mysql import BotData
+    data = BotData(app="",
+                   username=conf.get("username"),
+                   password=conf.get("password"),
+                   host=conf.get("host"),
+                   database=conf.get("database"))
+else:
+    raise Exception("Unknown data storage type {} in configuration".format(DB_TYPE))
+
+for table in data.tables:
+    print("Indexing table {}".format(table.table))
+    start = time.perf_counter()
+    data.executor.run_sync(table.ensure_index)
+    print("Indexed table {} in {:.2f}s".format(table.table, time.perf_counter() - start))
+
+data.close()
+print("Done")
@@ -0,0 +1,164 @@
+"""
+Check the LaTeX detector in modules/Tex/tex_detect.py against the original classifier, and benchmark both.
+
+Every message in the corpus is classified by both, and the code blocks extracted from LaTeX messages are compared.
+The corpus is a built-in set of messages, messages from an optional corpus file,
+and randomly generated messages built from the tokens the classifier looks for.
+Mismatches are printed as issues, followed by the per-message cost of each classifier.
+
+Usage:
+    python3 helper_scripts/tex_detect_check.py [--corpus FILE] [--random N] [--seed SEED]
+
+The corpus file contains messages separated by lines consisting of `%%%`.
+"""
+import os
+import sys
+import random
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules", "Tex"))
+
+from tex_detect import scan_tex  # noqa
+
+
+def reference_is_tex(content):
+    """
+    The original classifier from tex_cmds._is_tex.
+    """
+    is_tex = False
+    is_tex = is_tex or (("$" in content) and
+                        1 - (content.count("$") % 2) and
+                        content.strip("$"))
+    is_tex = is_tex or (content.count('$') > 6)
+    is_tex = is_tex or ("\\begin{" in content)
+    is_tex = is_tex or ("\\[" in content and "\\]" in content)
+    is_tex = is_tex or ("\\(" in content and "\\)" in content)
+    if is_tex and "```" in content and not any(word in content for word in ["```tex", "```latex", "```\n"]):
+        lines = content.splitlines()
+        if not all(1 - line.count("```") % 2 or " " in line or line == "```" for line in lines if "```" in line):
+            is_tex = False
+    return bool(is_tex)
+
+
+def reference_code(source):
+    """
+    The original code block extraction from tex_cmds.parse_tex.
+    """
+    if "```" not in source:
+        return None
+    lines = source.splitlines()
+    to_compile = []
+    in_block = False
+    for line in lines:
+        if "```" in line:
+            splits = line.split("```")
+            for split in splits:
+                if in_block and split not in ["", "tex", "latex"]:
+                    to_compile.append("{}\n".format(split))
+                in_block = not in_block
+            if in_block:
+                to_compile.append("\n")
+            in_block = not in_block
+        elif in_block:
+            to_compile.append(line)
+    return "\n".join(to_compile)
+
+
+corpus = [
+    "",
+    "hello everyone",
+    "that costs $5",
+    "between $5 and $10",
+    "$$",
+    "$$$$",
+    "$ $",
+    "$x^2$",
+    "$$\\int_0^1 f(x)\\,dx$$",
+    "$1 $2 $3 $4 $5 $6 $7",
+    "\\begin{align*} a &= b \\end{align*}",
+    "\\[ x = 1 \\]",
+    "\\( x \\)",
+    "only \\[ an opening",
+    "\\\\[2pt] escaped",
+    "```py\nprint('$x$')\n```",
+    "```tex\n$x$\n```",
+    "```latex\n\\begin{equation} x \\end{equation}\n```",
+    "```\n$x$\n```",
+    "`$x$`",
+    "```$x$```",
+    "```python $x$```",
+    "some text ```py\ncode $x$\n``` and more",
+    "````tex\n$x$\n````",
+    "```tex $x$ ``` and ```py $y$ ```",
+    "$x$\r\n```py\r\n$y$\r\n```",
+    "\u2028```py\u2028$x$\u2028```",
+    "```\n```\n$a$ $b$",
+    "see <@123456789> for $x$",
+]
+
+tokens = ["$", "$$", "```", "```tex", "```latex", "```py", "\\begin{", "\\[", "\\]", "\\(", "\\)",
+          "\\", "[", "(", "`", " ", "\n", "\r\n", "x", "tex", "latex", "py", "a b"]
+
+
+def random_message(rng):
+    return "".join(rng.choice(tokens) for _ in range(rng.randint(0, 20)))
+
+
+def load_corpus(fn):
+    with open(fn, 'r') as f:
+        return f.read().split("\n%%%\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark the LaTeX detector.")
+    parser.add_argument("--corpus", help="File of messages separated by lines of %%%%%%.")
+    parser.add_argument("--random", type=int, default=100000, help="Number of random messages to check.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random messages.")
+    args = parser.parse_args()
+
+    messages = list(corpus)
+    if args.corpus:
+        messages += load_corpus(args.corpus)
+
+    rng = random.Random(args.seed)
+    checked = messages + [random_message(rng) for _ in range(args.random)]
+
+    print("Checking {} messages".format(len(checked)))
+    issues = 0
+    for content in checked:
+        scan = scan_tex(content)
+        expected = reference_is_tex(content)
+        if scan.is_tex != expected:
+            issues += 1
+            print("ISSUE: Classified {!r} as {}, expected {}".format(content, scan.is_tex, expected))
+        if scan.code != (reference_code(content) if expected else None):
+            issues += 1
+            print("ISSUE: Extracted {!r} from {!r}, expected {!r}".format(scan.code, content, reference_code(content)))
+    print("Found {} issues".format(issues))
+
+    # Benchmark over the fixed corpus, which is closer to real traffic than the random messages
+    number = 2000
+    old = timeit.timeit(lambda: [reference_is_tex(content) for content in messages], number=number)
+    new = timeit.timeit(lambda: [scan_tex(content) for content in messages], number=number)
+    per_message = number * len(messages) / 1000000
+    print("Original classifier: {:.2f}us per message".format(old / per_message))
+    print("Original classifier and code extraction: {:.2f}us per message".format(
+        timeit.timeit(lambda: [(reference_is_tex(content), reference_code(content)) for content in messages],
+                      number=number) / per_message
+    ))
+    print("scan_tex, with code extraction: {:.2f}us per message".format(new / per_message))
+
+    # Most listened messages aren't LaTeX, and only need classifying
+    plain = [content for content in messages if not reference_is_tex(content)]
+    per_message = number * len(plain) / 1000000
+    print("Original classifier, messages which aren't LaTeX: {:.2f}us per message".format(
+        timeit.timeit(lambda: [reference_is_tex(content) for content in plain], number=number) / per_message
+    ))
+    print("scan_tex, messages which aren't LaTeX: {:.2f}us per message".format(
+        timeit.timeit(lambda: [scan_tex(content) for content in plain], number=number) / per_message
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Benchmark the LaTeX rasterisation backends in modules/Tex/tex_raster.py over a corpus of snippets.
+
+Each snippet is compiled once to PDF and once to DVI with the default header and preamble,
+and each available backend then rasterises the output repeatedly.
+Reports the latency and output size of each backend, so the `latex_rasteriser` option can be chosen.
+
+Usage:
+    python3 helper_scripts/tex_raster_bench.py [--corpus FILE] [--repeat N] [--backends NAME [NAME ...]]
+
+The corpus file contains snippets separated by lines consisting of `%%%`.
+Without a corpus file, a small built-in corpus is used.
+Requires pdflatex, and the tools for each backend to be benchmarked.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+tex_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules", "Tex")
+sys.path.insert(0, tex_dir)
+
+import tex_raster  # noqa
+
+# Matches the header in tex_compile.py
+header = "\\documentclass[preview, border=20pt, 12pt]{standalone}\n\\nonstopmode"
+
+to_compile = "{header}\n{preamble}\n\\begin{{document}}\n{source}\n\\end{{document}}"
+
+corpus = [
+    "$x^2$",
+    "$\\int_0^\\infty e^{-x^2}\\,dx = \\frac{\\sqrt{\\pi}}{2}$",
+    "$$\\sum_{n=1}^\\infty \\frac{1}{n^2} = \\frac{\\pi^2}{6}$$",
+    "\\begin{align*}\n(a+b)^2 &= a^2 + 2ab + b^2 \\\\\n(a-b)^2 &= a^2 - 2ab + b^2\n\\end{align*}",
+    "$\\begin{pmatrix} 1 & 2 \\\\ 3 & 4 \\end{pmatrix}\\begin{pmatrix} x \\\\ y \\end{pmatrix}$",
+    "Let $G$ be a group and $H \\leq G$. Then $|G| = [G : H]\\,|H|$ whenever $G$ is finite.",
+    "$\\mathbb{R}, \\mathfrak{g}, \\mathscr{L}, \\mathcal{O}_X$",
+    "\\begin{tikzcd}\nA \\arrow[r, \"f\"] \\arrow[d] & B \\arrow[d, \"g\"] \\\\\nC \\arrow[r] & D\n\\end{tikzcd}",
+    "\\textcolor{red}{Red} and \\textcolor{blue}{blue} text with $\\cancel{x}$ cancelled.",
+]
+
+
+def load_corpus(fn):
+    with open(fn, 'r') as f:
+        snippets = [part.strip() for part in f.read().split("\n%%%\n")]
+    return [snippet for snippet in snippets if snippet]
+
+
+def compile_snippet(path, name, source, preamble, dvi):
+    with open(os.path.join(path, "{}.tex".format(name)), 'w') as f:
+        f.write(to_compile.format(header=header, preamble=preamble, source=source))
+    args = ["pdflatex", "-no-shell-escape", "-interaction=nonstopmode"]
+    if dvi:
+        args.append("-output-format=dvi")
+    subprocess.run(args + ["{}.tex".format(name)], cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return os.path.isfile(os.path.join(path, "{}.{}".format(name, "dvi" if dvi else "pdf")))
+
+
+def percentile(values, pc):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pc / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the LaTeX rasterisation backends.")
+    parser.add_argument("--corpus", help="File of snippets separated by lines of %%%%%%.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of times to rasterise each snippet.")
+    parser.add_argument("--backends", nargs="+", default=list(tex_raster.backends), help="Backends to benchmark.")
+    args = parser.parse_args()
+
+    snippets = load_corpus(args.corpus) if args.corpus else corpus
+    with open(os.path.join(tex_dir, "preamble.tex"), 'r') as f:
+        preamble = f.read()
+
+    backends = []
+    for name in args.backends:
+        if name not in tex_raster.backends:
+            print("Unknown backend {}, skipping.".format(name))
+        elif not tex_raster.backends[name]["available"]():
+            print("Backend {} is not available, skipping.".format(name))
+        else:
+            backends.append(name)
+
+    if not backends:
+        print("No backends to benchmark!")
+        return
+
+    work = tempfile.mkdtemp(prefix="tex_raster_bench_")
+    try:
+        # Compile each snippet once per output format
+        print("Compiling {} snippets".format(len(snippets)))
+        compiled = []
+        for i, source in enumerate(snippets):
+            path = os.path.join(work, str(i))
+            os.makedirs(path)
+            if not compile_snippet(path, "pdf", source, preamble, False):
+                print("Snippet {} failed to compile, skipping.".format(i))
+                continue
+            has_dvi = compile_snippet(path, "dvi", source, preamble, True)
+            compiled.append((path, has_dvi))
+
+        print("\n{:<12}{:>10}{:>10}{:>10}{:>10}{:>12}".format("Backend", "Snippets", "Mean ms", "Median", "P95", "Mean KB"))
+        for name in backends:
+            dvi = tex_raster.backends[name]["dvi"]
+            times = []
+            sizes = []
+            for path, has_dvi in compiled:
+                if dvi and not has_dvi:
+                    continue
+                job = os.path.join(path, name)
+                shutil.copyfile(os.path.join(path, "dvi.dvi" if dvi else "pdf.pdf"),
+                                "{}.{}".format(job, "dvi" if dvi else "pdf"))
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    tex_raster.rasterise(path, name, name)
+                    times.append((time.perf_counter() - start) * 1000)
+                png = "{}.png".format(job)
+                if os.path.isfile(png):
+                    sizes.append(os.path.getsize(png))
+
+            if not times:
+                print("{:<12}{:>10}".format(name, 0))
+                continue
+            print("{:<12}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.1f}".format(
+                name,
+                len(times) // args.repeat,
+                sum(times) / len(times),
+                percentile(times, 50),
+                percentile(times, 95),
+                sum(sizes) / len(sizes) / 1024 if sizes else 0
+            ))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Check the recovery of the write buffer in paradata_writes.py from a failed batch, when other flushes overlap it.
+
+A scheduled flush takes a batch with an old value, and blocks in the database until it fails.
+Meanwhile the property is written again, and a flush started by a read takes the new value, queued behind it.
+The failed batch is then restored, and must not bring back the old value, which the next flush would write
+over the new value.
+
+Usage:
+    python3 helper_scripts/write_buffer_check.py
+"""
+import os
+import sys
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from paradata_executor import DBExecutor  # noqa
+from paradata_writes import WriteBuffer  # noqa
+
+
+class FailingStore:
+    """
+    Stand-in for the database, failing the first batch once it is released.
+    """
+    def __init__(self):
+        self.committed = {}
+        self.batches = 0
+        self.release = threading.Event()
+
+    def write_batch(self, batch):
+        self.batches += 1
+        if self.batches == 1:
+            self.release.wait()
+            raise RuntimeError("First batch failed")
+        for table, entries in batch.items():
+            self.committed.update({(table, key): value for key, value in entries.items()})
+
+
+async def check():
+    store = FailingStore()
+    buffer = WriteBuffer(DBExecutor(), store.write_batch, interval=50, max_ops=1000)
+
+    key = (1, "prop")
+    buffer.put("users", key, "old")
+    first = asyncio.ensure_future(buffer.flush())
+    await asyncio.sleep(0.05)
+
+    # Write the new value, and flush it from a read, queued behind the first batch
+    buffer.put("users", key, "new")
+    second = asyncio.ensure_future(buffer.flush())
+    await asyncio.sleep(0.05)
+
+    # Fail the first batch, and flush whatever it restored
+    store.release.set()
+    await asyncio.wait([first, second])
+    await buffer.flush()
+
+    value = store.committed.get(("users", key), None)
+    pending = buffer.lookup("users", key)
+    print("Committed value: {!r}, pending write: {!r}".format(value, pending))
+    if value != "new" or pending[0]:
+        print("ISSUE: The failed batch restored a stale value.")
+        return False
+    print("No issues")
+    return True
+
+
+if __name__ == "__main__":
+    ok = asyncio.get_event_loop().run_until_complete(check())
+    sys.exit(0 if ok else 1)
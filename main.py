@@ -46,7 +46,11 @@ CURRENT_APP = conf.get("APP")
 DB_TYPE = conf.get("DB_TyPE")
 if not DB_TYPE or DB_TYPE.lower() == "sqlite":
     from paradata_sqlite import BotData
-    dbopts = {'data_file': conf.get("bot_data_file")}
+    dbopts = {
+        'data_file': conf.get("bot_data_file"),
+        'journal_mode': conf.get("data_sqlite_journal_mode"),
+        'synchronous': conf.get("data_sqlite_synchronous")
+    }
 elif DB_TYPE == "mysql":
     from paradata_mysql import BotData
     dbopts = {
@@ -58,6 +62,15 @@ elif DB_TYPE == "mysql":
 else:
     raise Exception("Unknown data storage type {} in configuration".format(DB_TYPE))
 
+# Property read cache size per table, and lifetime of a cached property in seconds
+dbopts['cache_size'] = conf.get("data_cache_size", 10000)
+dbopts['cache_ttl'] = conf.get("data_cache_ttl", 60)
+
+# Write-behind batching of property writes, flushed every interval milliseconds or once a number of writes are pending
+dbopts['write_behind'] = conf.get("data_write_behind", False)
+dbopts['flush_interval'] = conf.get("data_flush_interval", 500)
+dbopts['flush_ops'] = conf.get("data_flush_ops", 100)
+
 botdata = BotData(app=CURRENT_APP, **dbopts)
 
 # Initialise the logger
@@ -256,3 +269,6 @@ bot.add_after_event("ready", publish_ready, priority=100)
 
 # ----Everything is defined, start the bot!----
 bot.run(conf.get("TOKEN"))
+
+# Write out any buffered data
+botdata.close()
@@ -17,6 +17,8 @@ Commands provided:
         Sends a dm to the user with user id given
     logs:
         Attempts to send the logfile or last n lines of the log.
+    dbstats:
+        Shows the database queue, query time, property cache and write buffer statistics.
 """
 
 status_dict = {"online": discord.Status.online,
@@ -32,6 +34,7 @@ status_dict = {"online": discord.Status.online,
 @cmds.require("manager_perm")
 async def cmd_shutdown(ctx):
     await ctx.reply("Shutting down...")
+    await ctx.bot.data.flush()
     await ctx.bot.logout()
 
 
@@ -109,3 +112,44 @@ async def cmd_logs(ctx):
     elif ctx.params[0].isdigit():
         logs = await ctx.tail(ctx.bot.log_file, ctx.params[0])
         await ctx.reply("Here are your logs:\n```{}```".format(logs))
+
+
+@cmds.cmd("dbstats",
+          category="Bot admin",
+          short_help="Shows the database queue statistics")
+@cmds.require("manager_perm")
+async def cmd_dbstats(ctx):
+    """
+    Usage:
+        {prefix}dbstats
+    Description:
+        Shows the number of queued database operations and the query times.
+        Wait and query times are over the last 1000 operations.
+        Also shows the number of cached properties, and the proportion of property reads served from the cache,
+        and the write buffer statistics if writes are buffered.
+    """
+    stats = ctx.bot.data.stats()
+    lookups = stats["cache_hits"] + stats["cache_misses"]
+    props = ["Queued", "Max queued", "Queries", "Errors", "Wait", "Query", "Cache"]
+    values = [
+        stats["queued"],
+        stats["max_depth"],
+        stats["queries"],
+        stats["errors"],
+        "{:.1f}ms mean".format(stats["mean_wait"] * 1000),
+        "{:.1f}ms mean, {:.1f}ms p95, {:.1f}ms max".format(
+            stats["mean_query"] * 1000, stats["p95_query"] * 1000, stats["max_query"] * 1000
+        ),
+        "{} properties, {} hits, {} misses, {:.1%} hit rate".format(
+            stats["cache_entries"], stats["cache_hits"], stats["cache_misses"],
+            stats["cache_hits"] / lookups if lookups else 0
+        )
+    ]
+    if stats["write_buffer"] is not None:
+        buffer = stats["write_buffer"]
+        props.append("Write buffer")
+        values.append("{} pending, {} writes, {} coalesced, {} flushes of {:.1f} mean, {:.1f}ms mean, {} failed".format(
+            buffer["pending"], buffer["writes"], buffer["coalesced"], buffer["flushes"], buffer["mean_batch"],
+            buffer["mean_flush"] * 1000, buffer["failures"]
+        ))
+    await ctx.reply("**Database:**\n{}".format(ctx.prop_tabulate(props, values)))
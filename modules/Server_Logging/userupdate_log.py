@@ -3,18 +3,19 @@ from datetime import datetime
 
 
 async def log_member_update(bot, before, after):
-    userlog = await bot.data.servers.get(before.server.id, "userlog_ch")
+    settings = await bot.data.servers.get_many(before.server.id, props=["userlog_ch", "userlog_ignore", "userlog_events"])
+    userlog = settings["userlog_ch"]
     if not userlog:
         return
     userlog = before.server.get_channel(userlog)
     if not userlog:
         return
 
-    log_ignore = await bot.data.servers.get(before.server.id, "userlog_ignore")
+    log_ignore = settings["userlog_ignore"]
     if log_ignore and (before.id in log_ignore):
         return
 
-    events = await bot.data.servers.get(before.server.id, "userlog_events")
+    events = settings["userlog_events"]
 
     desc_lines = []
     image_url = None
@@ -12,7 +12,7 @@ star format:
 async def register_starboard_emojis(bot):
     bot.objects["server_starboard_emojis"] = {}
     bot.objects["server_starboards"] = {}
-    for serverid in await bot.data.servers.find("starboard_enabled", True, read=True):
+    async for serverid in bot.data.servers.iter_find("starboard_enabled", True, read=True):
         emoji = await bot.data.servers.get(str(serverid), "starboard_emoji")
         emoji = emoji if emoji else bot.s_conf.starboard_emoji.default
         bot.objects["server_starboard_emojis"][str(serverid)] = emoji
@@ -0,0 +1,273 @@
+import os
+import hashlib
+
+from cachetools import LRUCache
+
+from paraCH import paraCH
+
+cmds = paraCH()
+
+"""
+Content addressed cache for compiled LaTeX output.
+
+Renders are keyed on a hash of the full compiled document and the rasteriser,
+and store the png data of the render before any colourscheme is applied (see tex_image.coverage),
+along with the compile error text. Renders which produced no output are stored with empty png data.
+Entries are kept in a size bounded LRU in memory, backed by a size bounded LRU directory on disk.
+
+Commands provided:
+    texcache:
+        Show the cache statistics, or flush the cache.
+
+Configuration (bot configuration file):
+    latex_cache_mem: int
+        Maximum size of the in memory cache, in MB.
+    latex_cache_disk: int
+        Maximum size of the on disk cache, in MB. 0 disables the disk cache.
+
+Bot Objects:
+    latex_render_cache: RenderCache
+"""
+
+# Directory for the on disk cache
+cache_dir = "tex/cache"
+
+
+def render_key(document, *options):
+    """
+    Compute the cache key for a compiled document and its rendering options.
+    """
+    key = hashlib.sha256(document.encode())
+    for option in options:
+        key.update(b"\0")
+        key.update(str(option).encode())
+    return key.hexdigest()
+
+
+class _SizedLRU(LRUCache):
+    """
+    LRU cache bounded by the total size of the stored renders, counting evictions.
+    """
+    def __init__(self, maxsize):
+        super().__init__(maxsize, getsizeof=lambda entry: len(entry[0]) + len(entry[1]))
+        self.evictions = 0
+
+    def popitem(self):
+        self.evictions += 1
+        return super().popitem()
+
+
+class RenderCache:
+    def __init__(self, max_mem=64, max_disk=512, directory=cache_dir):
+        self.directory = directory
+        self.max_disk = max_disk * 1024 * 1024
+
+        self.memory = _SizedLRU(max_mem * 1024 * 1024)
+
+        # Keys of the renders on disk and their sizes, least recently used first
+        self.disk = LRUCache(float('inf'))
+        self.disk_size = 0
+
+        # Statistics
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+
+        if self.max_disk:
+            self._load_disk()
+
+    def _paths(self, key):
+        return (os.path.join(self.directory, "{}.png".format(key)),
+                os.path.join(self.directory, "{}.err".format(key)))
+
+    def _load_disk(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for fn in os.listdir(self.directory):
+            key, ext = os.path.splitext(fn)
+            if ext != ".png":
+                continue
+            png_path, err_path = self._paths(key)
+            if not os.path.isfile(err_path):
+                os.remove(png_path)
+                continue
+            size = os.path.getsize(png_path) + os.path.getsize(err_path)
+            entries.append((os.path.getmtime(png_path), key, size))
+
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_size += size
+        self._remove_files(self._evict_disk())
+
+    def _evict_disk(self):
+        """
+        Drop the least recently used renders until the disk cache fits, returning their keys.
+        """
+        evicted = []
+        while self.disk_size > self.max_disk and self.disk:
+            key, size = self.disk.popitem()
+            evicted.append(key)
+            self.disk_size -= size
+            self.disk_evictions += 1
+        return evicted
+
+    def _remove_files(self, keys):
+        for key in keys:
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _read(self, key):
+        """
+        Read a render from disk, touching it to record its use.
+        Returns a tuple (png data, error data), or None if its files are gone.
+        """
+        png_path, err_path = self._paths(key)
+        try:
+            with open(png_path, 'rb') as f:
+                image = f.read()
+            with open(err_path, 'rb') as f:
+                error = f.read()
+            os.utime(png_path)
+        except FileNotFoundError:
+            return None
+        return (image, error)
+
+    def _write(self, key, image, error):
+        os.makedirs(self.directory, exist_ok=True)
+        png_path, err_path = self._paths(key)
+        with open(err_path, 'wb') as f:
+            f.write(error)
+        with open(png_path, 'wb') as f:
+            f.write(image)
+
+    def __contains__(self, key):
+        return key in self.memory or key in self.disk
+
+    async def get(self, loop, key):
+        """
+        Retrieve a cached render as a tuple (png data, error text), or None on a miss.
+        The memory cache is checked directly, and the disk cache is read in the executor.
+        """
+        entry = self.memory.get(key, None)
+        if entry is not None:
+            self.hits += 1
+            return (entry[0], entry[1].decode())
+
+        if key in self.disk:
+            entry = await loop.run_in_executor(None, self._read, key)
+            if entry is None:
+                if key in self.disk:
+                    self.disk_size -= self.disk.pop(key)
+            else:
+                # Touch the entry to record its use, if it wasn't evicted while it was read
+                if key in self.disk:
+                    self.disk[key]
+
+                self.hits += 1
+                self.disk_hits += 1
+                try:
+                    self.memory[key] = entry
+                except ValueError:
+                    pass
+                return (entry[0], entry[1].decode())
+
+        self.misses += 1
+        return None
+
+    async def put(self, loop, key, image, error):
+        """
+        Store a render in the cache, writing it to disk in the executor.
+        """
+        error = error.encode()
+        try:
+            self.memory[key] = (image, error)
+        except ValueError:
+            # The render is larger than the whole memory cache
+            pass
+
+        if self.max_disk and key not in self.disk:
+            # Claim the entry first, so concurrent stores of the same render don't write it twice
+            self.disk[key] = len(image) + len(error)
+            self.disk_size += len(image) + len(error)
+            await loop.run_in_executor(None, self._write, key, image, error)
+            evicted = self._evict_disk()
+            if evicted:
+                await loop.run_in_executor(None, self._remove_files, evicted)
+
+    async def flush(self, loop):
+        """
+        Empty the cache, both in memory and on disk.
+        """
+        evictions = self.memory.evictions
+        self.memory.clear()
+        self.memory.evictions = evictions
+
+        keys = list(self.disk.keys())
+        self.disk.clear()
+        self.disk_size = 0
+        await loop.run_in_executor(None, self._remove_files, keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.memory),
+            "memory": self.memory.currsize,
+            "disk_entries": len(self.disk),
+            "disk": self.disk_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "evictions": self.memory.evictions,
+            "disk_evictions": self.disk_evictions
+        }
+
+
+@cmds.cmd("texcache",
+          category="Bot admin",
+          short_help="Inspect or flush the LaTeX render cache",
+          flags=["flush"])
+@cmds.require("manager_perm")
+async def cmd_texcache(ctx):
+    """
+    Usage:
+        {prefix}texcache
+        {prefix}texcache --flush
+    Description:
+        Shows the LaTeX render cache statistics, and the renders shared between identical requests in flight.
+    Flags:2
+        flush:: Empties the cache, in memory and on disk.
+    """
+    cache = ctx.bot.objects["latex_render_cache"]
+    if ctx.flags["flush"]:
+        await cache.flush(ctx.bot.loop)
+        await ctx.reply("The LaTeX render cache has been flushed.")
+        return
+
+    stats = cache.stats()
+    flights = ctx.bot.objects["latex_render_flights"].stats()
+    props = ["Memory", "Disk", "Hits", "Misses", "Hit rate", "Evictions", "In flight"]
+    values = [
+        "{} renders, {:.2f}MB".format(stats["entries"], stats["memory"] / (1024 ** 2)),
+        "{} renders, {:.2f}MB".format(stats["disk_entries"], stats["disk"] / (1024 ** 2)),
+        "{} ({} from disk)".format(stats["hits"], stats["disk_hits"]),
+        stats["misses"],
+        "{:.1%}".format(stats["hit_rate"]),
+        "{} in memory, {} on disk".format(stats["evictions"], stats["disk_evictions"]),
+        "{} running, {} started, {} shared, {} cancelled".format(
+            flights["running"], flights["started"], flights["shared"], flights["cancelled"]
+        )
+    ]
+    await ctx.reply("**LaTeX render cache:**\n{}".format(ctx.prop_tabulate(props, values)))
+
+
+def load_into(bot):
+    conf = bot.bot_conf
+    bot.objects["latex_render_cache"] = RenderCache(
+        max_mem=conf.get("latex_cache_mem", 64),
+        max_disk=conf.get("latex_cache_disk", 512)
+    )
@@ -1,6 +1,8 @@
 import discord
 import asyncio
-import os
+import hashlib
+import time
+from io import BytesIO
 
 
 from contextBot.Context import MessageContext as MCtx
@@ -8,11 +10,16 @@ from contextBot.Context import MessageContext as MCtx
 from tex_config import show_config
 from tex_compile import colourschemes
 from tex_preamble import tex_pagination
+from tex_detect import scan_tex, extract_code
 
 from paraCH import paraCH
+from timerwheel import TTLStore
 
 cmds = paraCH()
 
+# User settings read for each render
+latex_user_settings = ["latex_alwaysmath", "latex_colour", "latex_keep_message", "latex_showname", "latex_allowother"]
+
 """
 Commands and handlers for LaTeX compilation, both manual and automatic.
 
@@ -32,10 +39,18 @@ Initialisation:
     register_tex_listeners:
         Add all users and servers with tex listening enabled to bot objects
 
+Configuration (bot configuration file):
+    latex_edit_debounce: float
+        Seconds to wait for further edits before rendering an edited message.
+    latex_message_ttl: int
+        Seconds to keep track of a rendered message for edits, after its last edit or compilation.
+    latex_message_max: int
+        Maximum number of rendered messages to keep track of.
+
 Bot Objects:
     user_tex_listeners: set of user id strings
     server_tex_listeners: dictionary of lists of math channel ids, indexed by server id
-    latex_messages: dictionary of Contexts, indexed by message ids
+    latex_messages: TTLStore of LatexMessages, indexed by message ids
 
 User data:
     tex_listening: bool
@@ -98,38 +113,6 @@ async def cmd_texlisten(ctx):
         await ctx.reply("I am now listening to your tex.")
 
 
-def _is_tex(msg):
-    """
-    Helper to check whether an incoming or edited message contains LaTeX source code.
-    """
-    content = msg.clean_content
-    is_tex = False
-
-    # Check if there are an even number of dollar signs
-    is_tex = is_tex or (("$" in content) and
-                        1 - (content.count("$") % 2) and
-                        content.strip("$"))
-
-    # Check if there are more than 6 dollar signs
-    is_tex = is_tex or (content.count('$') > 6)
-
-    # Check if it contains the start of an environment
-    is_tex = is_tex or ("\\begin{" in content)
-
-    # Check if it contains the \[ \] or \( \) math modes
-    is_tex = is_tex or ("\\[" in content and "\\]" in content)
-    is_tex = is_tex or ("\\(" in content and "\\)" in content)
-
-    # If a non-latex code block exists, the message probably isn't LaTeX
-    if is_tex and "```" in content and not any(word in content for word in ["```tex", "```latex", "```\n"]):
-        # Check whether every such code block is a one liner, or has a space in the syntax field
-        lines = content.splitlines()
-        if not all(1 - line.count("```") % 2 or " " in line or line == "```" for line in lines if "```" in line):
-            is_tex = False
-
-    return is_tex
-
-
 @cmds.cmd("tex",
           category="Maths",
           short_help="Renders LaTeX code",
@@ -240,58 +223,109 @@ async def cmd_tex(ctx):
     # Set the messages compilation flags
     ctx.objs["latex_listening"] = False
     ctx.objs["latex_source_deleted"] = False
-    ctx.objs["latex_out_deleted"] = False
     ctx.objs["latex_handled"] = True
-    ctx.bot.objects["latex_messages"][ctx.msg.id] = ctx
     ctx.objs["latex_wide"] = (ctx.used_cmd_name == "texw")
     ctx.objs["latex_spoiler"] = (ctx.used_cmd_name == "texsp")
+    track_latex(ctx)
 
     # Compile and send the final output message
     out_msg = await make_latex(ctx)
+    hold_latex(ctx, out_msg)
 
-    # If we failed to send any output, pop the context and go home
-    if out_msg is None:
-        ctx.bot.objects["latex_messages"].pop(ctx.msg.id, None)
-        return
 
-    # Start the reaction handler
-    asyncio.ensure_future(reaction_edit_handler(ctx, out_msg), loop=ctx.bot.loop)
+class LatexMessage:
+    """
+    Compact record of a rendered LaTeX message, kept in latex_messages so that edits can re-render it.
+    Holds what is needed to rebuild a context for the edited message, and the state of the latest render.
+    """
+    __slots__ = ("listening", "cmd_name", "wide", "spoiler", "source_deleted",
+                 "out_msg", "out_deleted", "document", "task", "cancellable", "superseded", "edit_count")
+
+    def __init__(self, ctx):
+        self.listening = ctx.objs["latex_listening"]
+        self.cmd_name = None if self.listening else ctx.used_cmd_name
+        self.wide = ctx.objs.get("latex_wide", False)
+        self.spoiler = ctx.objs["latex_spoiler"]
+        self.source_deleted = False
+
+        # The output message of the latest render, and whether the user deleted it
+        self.out_msg = None
+        self.out_deleted = False
+
+        # Hash of the latest rendered document, and the task rendering it
+        self.document = None
+        self.task = None
+        self.cancellable = False
+        self.superseded = False
+
+        self.edit_count = 0
+
+    def context(self, bot, message):
+        """
+        Build a context for rendering an edited version of the message.
+        """
+        ctx = MCtx(bot=bot, message=message)
+        ctx.used_cmd_name = self.cmd_name
+        ctx.objs["latex_handled"] = True
+        ctx.objs["latex_listening"] = self.listening
+        ctx.objs["latex_wide"] = self.wide
+        ctx.objs["latex_spoiler"] = self.spoiler
+        ctx.objs["latex_source_deleted"] = self.source_deleted
+        ctx.objs["latex_message"] = self
+        return ctx
+
+    def current(self):
+        """
+        Check whether the latest render is still running, or has posted output which still exists.
+        """
+        if self.task is None or self.task.cancelled():
+            return False
+        if not self.task.done():
+            return True
+        return self.out_msg is not None and not self.out_deleted
 
-    # Hold the message context in cache for 600 seconds after the last edit or compilation
-    if not ctx.objs["latex_source_deleted"]:
-        ctx.objs["latex_edit_renew"] = False
-        while True:
-            await asyncio.sleep(600)
-            if not ctx.objs["latex_edit_renew"]:
-                break
-            ctx.objs["latex_edit_renew"] = False
-        ctx.bot.objects["latex_messages"].pop(ctx.msg.id, None)
+
+def track_latex(ctx):
+    """
+    Start keeping track of a new LaTeX message, so that edits re-render it.
+    """
+    record = LatexMessage(ctx)
+    ctx.objs["latex_message"] = record
+    ctx.bot.objects["latex_messages"].set(ctx.msg.id, record)
+
+
+def hold_latex(ctx, out_msg):
+    """
+    Start the reaction handler for the first render of a message,
+    and keep its record for edits until it expires, if the source still exists.
+    """
+    # If we failed to send any output, or the source was deleted, forget the message
+    # If the render was superseded by an edit, keep the record for the edit
+    if (out_msg is None and not ctx.objs["latex_message"].superseded) or ctx.objs["latex_source_deleted"]:
+        ctx.bot.objects["latex_messages"].pop(ctx.msg.id)
+    else:
+        # Keep the record for a while after the last edit or compilation
+        ctx.bot.objects["latex_messages"].renew(ctx.msg.id)
+
+    # Start the reaction handler
+    if out_msg is not None:
+        asyncio.ensure_future(reaction_edit_handler(ctx, out_msg), loop=ctx.bot.loop)
 
 
 async def parse_tex(ctx, source):
     """
     Extract the LaTeX source code to compile from a raw incoming message containing LaTeX.
     """
-    if "```" in source:
-        # TeX source with codeblocks gets treated specially.
-        # Only the code in the codeblocks gets rendered.
-        # We can assume here, from _is_tex, that there are no foreign codeblocks
-        lines = source.splitlines()
-        to_compile = []
-        in_block = False
-        for line in lines:
-            if "```" in line:
-                splits = line.split("```")
-                for split in splits:
-                    if in_block and split not in ["", "tex", "latex"]:
-                        to_compile.append("{}\n".format(split))
-                    in_block = not in_block
-                if in_block:
-                    to_compile.append("\n")
-                in_block = not in_block
-            elif in_block:
-                to_compile.append(line)
-        source = "\n".join(to_compile)
+    # TeX source with codeblocks gets treated specially.
+    # Only the code in the codeblocks gets rendered.
+    # We can assume here, from scan_tex, that there are no foreign codeblocks
+    scan = ctx.objs.get("latex_scan", None)
+    if scan is not None and scan.content == source:
+        # Reuse the code blocks extracted by the listener
+        if scan.code is not None:
+            source = scan.code
+    elif "```" in source:
+        source = extract_code(source.splitlines())
 
     # If the message starts and ends with backticks, strip them
     if source.startswith('`') and source.endswith('`'):
@@ -302,7 +336,7 @@ async def parse_tex(ctx, source):
         return source
 
     # Different compilation commands require different source wrappers
-    always = await ctx.bot.data.users.get(ctx.authid, "latex_alwaysmath")
+    always = ctx.objs["latex_settings"]["latex_alwaysmath"]
     if ctx.used_cmd_name in ["latex", "texw"] or (ctx.used_cmd_name == "tex" and not always):
         return source
     if ctx.used_cmd_name in ["$", ","] or (ctx.used_cmd_name == "tex" and always):
@@ -315,26 +349,91 @@ async def parse_tex(ctx, source):
         return source
 
 
-async def make_latex(ctx):
+async def latex_document(ctx):
     """
-    Compile LaTeX, send the output, and handle cleanup
+    Extract the LaTeX source from the message, and collect the user's compilation options.
+    Returns the source, preamble, colourscheme, and whether the output is wide.
+    The user's LaTeX settings are read together, and kept in ctx.objs["latex_settings"] for the rest of the render.
     """
+    ctx.objs["latex_settings"] = await ctx.data.users.get_many(ctx.authid, props=latex_user_settings)
+
     # Strip the command header off the message if required
     source = ctx.msg.clean_content if ctx.objs["latex_listening"] else ctx.msg.clean_content.partition(ctx.used_cmd_name)[2].strip()
-    ctx.objs["latex_source"] = await parse_tex(ctx, source)
+    source = await parse_tex(ctx, source)
+
+    preamble = await ctx.get_preamble()
+    colour = ctx.objs["latex_settings"]["latex_colour"]
+    colour = colour if colour else "default"
+    wide = ctx.objs.get("latex_wide", False)
+    return (source, preamble, colour, wide)
+
+
+def _document_key(document):
+    """
+    Hash a document from latex_document for comparison, ignoring whitespace which doesn't change the output.
+    """
+    source, preamble, colour, wide = document
+    source = "\n".join(line.rstrip() for line in source.strip().splitlines())
+    return hashlib.sha256("{}\0{}\0{}\0{}".format(source, preamble, colour, wide).encode()).digest()
+
+
+async def make_latex(ctx, document=None):
+    """
+    Render the LaTeX in the message as a task, which is cancelled if the message is edited while compiling.
+    The document from latex_document is built if not given.
+    Returns the output message, or None if nothing was sent.
+    """
+    record = ctx.objs["latex_message"]
+    record.superseded = False
+    task = asyncio.ensure_future(_make_latex(ctx, document), loop=ctx.bot.loop)
+    record.task = task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        # A later edit of the message will be rendered instead
+        record.superseded = True
+        return None
 
-    # Retrieve the user id lock, creating it if required
-    if ctx.authid not in ctx.bot.objects['latex_locks']:
-        ctx.bot.objects['latex_locks'][ctx.authid] = asyncio.Lock()
-    lock = ctx.bot.objects['latex_locks'][ctx.authid]
 
-    async with lock:
+async def _make_latex(ctx, document=None):
+    """
+    Compile LaTeX, send the output, and handle cleanup
+    """
+    record = ctx.objs["latex_message"]
+    record.cancellable = True
+
+    if document is None:
+        document = await latex_document(ctx)
+    ctx.objs["latex_source"], ctx.objs["latex_preamble"], ctx.objs["latex_colour"], _ = document
+
+    # Remember what we rendered, so edits which don't change it can be skipped
+    record.document = _document_key(document)
+
+    # Wait for a render slot from the scheduler
+    scheduler = ctx.bot.objects["latex_scheduler"]
+    async with scheduler.slot(ctx.authid, ctx.server.id if ctx.server else None, key=ctx.msg.id) as job:
+        if job.shed == "superseded":
+            # A later edit of the message will be rendered instead
+            record.superseded = True
+            return None
+        elif job.shed:
+            try:
+                await ctx.reply("I'm too busy to render that right now, please try again in a moment!")
+            except discord.Forbidden:
+                pass
+            return None
+
         # Compile the source
-        error = await texcomp(ctx)
+        error, image = await texcomp(ctx)
         err_msg = ""
 
+        # Once we start posting the output, let the render finish
+        record.cancellable = False
+
         # Check if the user wants to keep the source message
-        keep = await ctx.data.users.get(ctx.authid, "latex_keep_message")
+        keep = ctx.objs["latex_settings"]["latex_keep_message"]
         keep = keep or (keep is None)
 
         # Make the error message if required
@@ -342,7 +441,7 @@ async def make_latex(ctx):
         if error != "":
             err_msg = "Compile error! Output:\n```\n{}\n```".format(error)
         elif not keep:
-            ctx.objs["latex_source_deleted"] = True
+            ctx.objs["latex_source_deleted"] = record.source_deleted = True
             await ctx.del_src()
 
         ctx.objs["latex_errmsg"] = err_msg
@@ -361,29 +460,24 @@ async def make_latex(ctx):
         ctx.objs["latex_show_emoji"] = ctx.bot.objects["emoji_tex_errors" if error else "emoji_tex_show"]
 
         # Clean up the author's name and store it
-        ctx.objs["latex_name"] = "**{}**:\n".format(ctx.author.name.replace("*", "\\*")) if (await ctx.data.users.get(ctx.authid, "latex_showname")) in [None, True] else ""
+        ctx.objs["latex_name"] = "**{}**:\n".format(ctx.author.name.replace("*", "\\*")) if ctx.objs["latex_settings"]["latex_showname"] in [None, True] else ""
 
-        # Send the final output, or a failure image if there is no output
-        file_name = "tex/staging/{id}/{id}.png".format(id=ctx.authid)
-        exists = True if os.path.isfile(file_name) else False
-        if exists and ctx.objs["latex_spoiler"]:
-            new_filename = "tex/staging/{id}/SPOILER_{id}.png".format(id=ctx.authid)
-            os.rename(file_name, new_filename)
-            file_name = new_filename
+        # Send the final output, or the failure image if there is no output, straight from memory
+        file_name = "{}{}.png".format("SPOILER_" if ctx.objs["latex_spoiler"] else "", ctx.authid)
 
-        # Send the output, if we are allowed to
+        # Send the output, if we are allowed to, recording the upload size and time
+        start = time.perf_counter()
         try:
-            out_msg = await ctx.reply(file_name=file_name if exists else "tex/failed.png",
+            out_msg = await ctx.reply(file_data=BytesIO(image), file_name=file_name,
                                       message="{}{}".format(ctx.objs["latex_name"],
                                                             ("Compile Error! Click the {} reaction for details. (You may edit your message)".format(ctx.objs["latex_show_emoji"])) if error else ""))
         except discord.Forbidden:
             out_msg = None
-
-        # Remove the output image and clean up
-        if exists:
-            os.remove(file_name)
+        else:
+            ctx.bot.objects["latex_output_stats"].record_upload(time.perf_counter() - start, len(image))
     ctx.objs["latex_show"] = 0
-    ctx.objs["latex_out_msg"] = out_msg
+    record.out_msg = out_msg
+    record.out_deleted = False
     return out_msg
 
 
@@ -397,25 +491,17 @@ async def reaction_edit_handler(ctx, out_msg):
     except discord.Forbidden:
         # If we can't react to the message or use external emojis, give up
         return
-    allow_other = await ctx.bot.data.users.get(ctx.authid, "latex_allowother")
+    allow_other = ctx.objs["latex_settings"]["latex_allowother"]
 
     # Build a check function to check if a reaction is valid
     def check(reaction, user):
-        if user == ctx.me:
-            return False
         result = reaction.emoji == ctx.objs["latex_del_emoji"] and user == ctx.author
         result = result or (reaction.emoji == ctx.objs["latex_show_emoji"] and (allow_other or user == ctx.author))
         result = result or (reaction.emoji == ctx.objs["latex_delsource_emoji"] and (user == ctx.author))
         return result
 
-    # Loop around, waiting for valid reactions and handling them if they occur
-    while True:
-        res = await ctx.bot.wait_for_reaction(message=out_msg,
-                                              timeout=300,
-                                              check=check)
-        if res is None:
-            break
-        if res.reaction.emoji == ctx.objs["latex_delsource_emoji"]:
+    async def handle_reaction(reaction, user):
+        if reaction.emoji == ctx.objs["latex_delsource_emoji"]:
             try:
                 await ctx.bot.delete_message(ctx.msg)
             except discord.NotFound:
@@ -430,13 +516,15 @@ async def reaction_edit_handler(ctx, out_msg):
             except discord.Forbidden:
                 pass
 
-        if res.reaction.emoji == ctx.objs["latex_del_emoji"] and res.user == ctx.author:
+        if reaction.emoji == ctx.objs["latex_del_emoji"] and user == ctx.author:
+            handler.finish()
             await ctx.bot.delete_message(out_msg)
-            ctx.objs["latex_out_deleted"] = True
+            if ctx.objs["latex_message"].out_msg == out_msg:
+                ctx.objs["latex_message"].out_deleted = True
             return
-        if res.reaction.emoji == ctx.objs["latex_show_emoji"] and (res.user != ctx.me):
+        if reaction.emoji == ctx.objs["latex_show_emoji"]:
             try:
-                await ctx.bot.remove_reaction(out_msg, ctx.objs["latex_show_emoji"], res.user)
+                await ctx.bot.remove_reaction(out_msg, ctx.objs["latex_show_emoji"], user)
             except discord.Forbidden:
                 pass
             except discord.NotFound:
@@ -449,39 +537,52 @@ async def reaction_edit_handler(ctx, out_msg):
             if ctx.objs["latex_show"] and ctx.objs["dm_source"]:
                 header = "{}[Click here to jump back to message]({})".format(ctx.objs["latex_errmsg"], ctx.msg_jumpto(out_msg))
                 pages = tex_pagination(ctx.objs["latex_source"], basetitle="LaTeX source", header=header)
-                await ctx.pager(pages, embed=True, destination=res.user)
+                await ctx.pager(pages, embed=True, destination=user)
 
-    # Remove the reactions and clean up
-    try:
-        await ctx.bot.remove_reaction(out_msg, ctx.objs["latex_del_emoji"], ctx.me)
-        await ctx.bot.remove_reaction(out_msg, ctx.objs["latex_show_emoji"], ctx.me)
-        await ctx.bot.remove_reaction(out_msg, ctx.objs["latex_delsource_emoji"], ctx.me)
-    except discord.Forbidden:
-        pass
-    except discord.NotFound:
-        pass
+    async def handler_expired():
+        # Remove the reactions and clean up
+        try:
+            await ctx.bot.remove_reaction(out_msg, ctx.objs["latex_del_emoji"], ctx.me)
+            await ctx.bot.remove_reaction(out_msg, ctx.objs["latex_show_emoji"], ctx.me)
+            await ctx.bot.remove_reaction(out_msg, ctx.objs["latex_delsource_emoji"], ctx.me)
+        except discord.Forbidden:
+            pass
+        except discord.NotFound:
+            pass
+
+    # Handle valid reactions as they occur, through the reaction router
+    handler = ctx.bot.objects["reaction_router"].register(
+        out_msg, handle_reaction,
+        emojis=[ctx.objs["latex_del_emoji"], ctx.objs["latex_show_emoji"], ctx.objs["latex_delsource_emoji"]],
+        check=check, on_expire=handler_expired
+    )
 
 
 async def texcomp(ctx):
     """
     Put together the final configuration options for the LaTeX compilation, and compile
+    Returns the compile error and the png data of the output
     """
     source = ctx.objs["latex_source"]
-    preamble = await ctx.get_preamble()
-    colour = await ctx.data.users.get(ctx.authid, "latex_colour")
-    colour = colour if colour else "default"
+    preamble = ctx.objs["latex_preamble"]
+    colour = ctx.objs["latex_colour"]
     wide = ctx.objs.get("latex_wide", False)
 
+    # Render simple maths in-process, falling back to pdflatex for everything else
+    result = await ctx.fastTeX(source, preamble, colour, pad=not wide)
+    if result is not None:
+        return result
     return await ctx.makeTeX(source, ctx.authid, preamble, colour, pad=not wide)
 
 
 async def register_tex_listeners(bot):
-    bot.objects["user_tex_listeners"] = set([str(userid) for userid in await bot.data.users.find("tex_listening", True, read=True)])
+    bot.objects["user_tex_listeners"] = set()
+    async for userid in bot.data.users.iter_find("tex_listening", True, read=True):
+        bot.objects["user_tex_listeners"].add(str(userid))
     bot.objects["server_tex_listeners"] = {}
-    for serverid in await bot.data.servers.find("latex_listen_enabled", True, read=True):
+    async for serverid in bot.data.servers.iter_find("latex_listen_enabled", True, read=True):
         channels = await bot.data.servers.get(serverid, "maths_channels")
         bot.objects["server_tex_listeners"][str(serverid)] = channels if channels else []
-    bot.objects["latex_messages"] = {}
     await bot.log("Loaded {} user tex listeners and {} server tex listeners.".format(len(bot.objects["user_tex_listeners"]), len(bot.objects["server_tex_listeners"])))
 
 
@@ -502,7 +603,8 @@ async def tex_listener(ctx):
     if ctx.server and (ctx.authid not in ctx.bot.objects["user_tex_listeners"]) and (ctx.server.id not in ctx.bot.objects["server_tex_listeners"]):
         # We are in a server, the user is not a listener, and the server is not a listener
         return
-    if not _is_tex(ctx.msg):
+    scan = scan_tex(ctx.msg.clean_content)
+    if not scan.is_tex:
         # The message doesn't contain any tex anyway
         return
     if ctx.server and (ctx.server.id in ctx.bot.objects["server_tex_listeners"]) and ctx.bot.objects["server_tex_listeners"][ctx.server.id] and not (ctx.ch.id in ctx.bot.objects["server_tex_listeners"][ctx.server.id]):
@@ -521,31 +623,14 @@ async def tex_listener(ctx):
     # Set the LaTeX compilation flags
     ctx.objs["latex_handled"] = True
     ctx.objs["latex_listening"] = True
+    ctx.objs["latex_scan"] = scan
     ctx.objs["latex_source_deleted"] = False
-    ctx.objs["latex_out_deleted"] = False
-    ctx.bot.objects["latex_messages"][ctx.msg.id] = ctx
     ctx.objs["latex_spoiler"] = False
+    track_latex(ctx)
 
     # Generate the LaTeX and post the result, if possible
     out_msg = await make_latex(ctx)
-
-    # If we failed to send any output, pop the context and go home
-    if out_msg is None:
-        ctx.bot.objects["latex_messages"].pop(ctx.msg.id, None)
-        return
-
-    # Start the reaction handler
-    asyncio.ensure_future(reaction_edit_handler(ctx, out_msg), loop=ctx.bot.loop)
-
-    # Message cache deletion timer
-    if not ctx.objs["latex_source_deleted"]:
-        ctx.objs["latex_edit_renew"] = False
-        while True:
-            await asyncio.sleep(600)
-            if not ctx.objs["latex_edit_renew"]:
-                break
-            ctx.objs["latex_edit_renew"] = False
-        ctx.bot.objects["latex_messages"].pop(ctx.msg.id, None)
+    hold_latex(ctx, out_msg)
 
 
 async def tex_edit_listener(bot, before, after):
@@ -559,27 +644,57 @@ async def tex_edit_listener(bot, before, after):
         await tex_listener(ctx)
         return
 
-    # Otherwise retrieve the previous context, update the message, and set the renew flag
-    ctx = bot.objects["latex_messages"][before.id]
-    ctx.objs["latex_edit_renew"] = True
-    ctx.msg = after
+    # Otherwise retrieve the message record, build a context for the edited message, and renew the record
+    record = bot.objects["latex_messages"][before.id]
+    bot.objects["latex_messages"].renew(before.id)
+    ctx = record.context(bot, after)
+
+    # Any earlier edit still waiting to render is replaced by this one
+    record.edit_count += 1
+    edit_count = record.edit_count
+
+    # If the edit doesn't change the compiled document, keep the current render and its output
+    document = await latex_document(ctx)
+    if record.edit_count != edit_count:
+        return
+    if _document_key(document) == record.document and record.current():
+        return
+
+    # Cancel any render of an earlier version which is still compiling
+    if record.task is not None and not record.task.done() and record.cancellable:
+        record.task.cancel()
+        record.document = None
+
+    # Wait for the edits to settle, leaving the render to the latest edit
+    await asyncio.sleep(bot.bot_conf.get("latex_edit_debounce", 1))
+    if record.edit_count != edit_count:
+        return
+
+    # Let a render which was already posting its output finish, so we can replace it
+    if record.task is not None and not record.task.done():
+        await asyncio.wait([record.task])
 
     # Get the previous output message and delete it if possible
-    old_out_msg = ctx.objs.get("latex_out_msg", None)
-    if old_out_msg is not None:
+    if record.out_msg is not None:
         try:
-            await ctx.bot.delete_message(old_out_msg)
+            await ctx.bot.delete_message(record.out_msg)
         except discord.NotFound:
             pass
+        bot.objects["reaction_router"].clear(record.out_msg.id)
+        record.out_msg = None
 
     # Compile the LaTeX and post the results, if possible
-    out_msg = await make_latex(ctx)
+    out_msg = await make_latex(ctx, document)
+    bot.objects["latex_messages"].renew(before.id)
     if out_msg is not None:
         asyncio.ensure_future(reaction_edit_handler(ctx, out_msg), loop=ctx.bot.loop)
 
 
 def load_into(bot):
-    bot.objects['latex_locks'] = {}
+    bot.objects["latex_messages"] = TTLStore(
+        ttl=bot.bot_conf.get("latex_message_ttl", 600),
+        max_entries=bot.bot_conf.get("latex_message_max", 10000)
+    )
 
     bot.data.users.ensure_exists(
         "tex_listening",
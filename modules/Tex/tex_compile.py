@@ -1,10 +1,55 @@
 import os
+import re
+import time
+import signal
 import shutil
+import asyncio
+import logging
+import tempfile
 
 from tex_config import default_preamble
+from tex_cache import render_key
+from tex_image import coverage, postprocess
+from tex_raster import rasterise, output_ext, get_backend, page_png, density
+from tex_mathtext import simple_math, get_renderer
+from tex_limits import kill_message
 
 """
-Provides a single context utility to compile LaTeX code from a user and return any error message
+Provides a single context utility to compile LaTeX code from a user and return any error message, with the output image
+
+Simple inline maths on the default preamble may be rendered in-process with fastTeX, see tex_mathtext.
+
+Several snippets sharing a preamble may be rendered together with makeTeX_batch,
+which compiles them as the pages of a single document, and maps any errors back to the snippet which caused them.
+
+Renders may instead be sent to a render service shared by every bot process on the host, see tex_service.
+
+Compiles run within the resource limits of the user's tier, see tex_limits.
+
+Each render is compiled in its own work directory, on a tmpfs where available, which is removed once the render is done.
+The final image is returned as png data, and never written to disk.
+
+Configuration (bot configuration file):
+    latex_fast_render: bool
+        Whether to render simple maths in-process, when matplotlib is installed. Defaults to True.
+    latex_staging_dir: string
+        Directory for the render work directories. Defaults to a directory in /dev/shm if it exists, otherwise tex/staging.
+    latex_staging_max_age: int
+        Age in seconds after which a leftover work directory is removed. Defaults to 600.
+    latex_max_area: int
+        Target maximum pixel area of rendered output, before padding. 0 for no limit. Defaults to 4000000.
+    latex_downscale: bool
+        Whether to downscale renders which are still larger than latex_max_area after rasterisation.
+    latex_png_palette: bool
+        Whether to encode output with at most 256 colours as a palette png.
+    latex_png_compression: int
+        zlib compression level of the output png, from 0 to 9.
+
+Bot Objects:
+    latex_output_stats: OutputStats
+    latex_staging: StagingArea
+    latex_render_flights: SingleFlight
+    latex_math_renderer: tex_mathtext.MathRenderer, or None if the fast path is disabled
 """
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -12,47 +57,152 @@ __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file
 
 def gencolour(colour, negate=True):
     """
-    Build the colour conversion command for the provided colour, negating black text if required
+    Build the colour conversion for the provided background colour, negating black text if required
     """
-    return r"convert {{image}} {} -bordercolor transparent -border 50 \
-        -background {} -flatten {{image}}".format("+negate" if negate else "", colour)
+    return {"negate": negate, "border": 50, "background": colour}
 
 
-# Dictionary of valid colours and the associated transformation commands
+# Dictionary of valid colours and the associated transformations, applied by tex_image.postprocess
+# Renders are cached before the colourscheme is applied, so changing colour never recompiles
 colourschemes = {}
 
-colourschemes["white"] = gencolour("white", False)
-colourschemes["black"] = gencolour("black")
+colourschemes["white"] = gencolour((255, 255, 255), False)
+colourschemes["black"] = gencolour((0, 0, 0))
 
-colourschemes["light"] = gencolour("'rgb(223, 223, 233)'", False)
-colourschemes["dark"] = gencolour("'rgb(20, 20, 20)'")
+colourschemes["light"] = gencolour((223, 223, 233), False)
+colourschemes["dark"] = gencolour((20, 20, 20))
 
-colourschemes["gray"] = colourschemes["grey"] = gencolour("'rgb(54, 57, 63)'")
-colourschemes["darkgrey"] = gencolour("'rgb(35, 39, 42)'")
+colourschemes["gray"] = colourschemes["grey"] = gencolour((54, 57, 63))
+colourschemes["darkgrey"] = gencolour((35, 39, 42))
 
-colourschemes["trans_white"] = r"convert {image} +negate -bordercolor transparent -border 40 {image}"
+colourschemes["trans_white"] = {"negate": True, "border": 40, "background": None}
 colourschemes["trans_black"] = None
 colourschemes["transparent"] = colourschemes["trans_white"]
 
 colourschemes["default"] = colourschemes["grey"]
 
 
-# Script which pads images to a minimum width of 1000
-pad_script = r"""
-width=`convert {image} -format "%[fx:w]" info:`
-minwidth=1000
-extra=$((minwidth-width))
+class OutputStats:
+    """
+    Running totals of the time spent encoding rendered output, and the size and upload time of the output.
+    """
+    def __init__(self):
+        self.encodes = 0
+        self.encode_time = 0
+        self.encode_bytes = 0
+
+        self.uploads = 0
+        self.upload_time = 0
+        self.upload_bytes = 0
+
+    def record_encode(self, duration, size):
+        self.encodes += 1
+        self.encode_time += duration
+        self.encode_bytes += size
+
+    def record_upload(self, duration, size):
+        self.uploads += 1
+        self.upload_time += duration
+        self.upload_bytes += size
+
+    def stats(self):
+        return {
+            "encodes": self.encodes,
+            "mean_encode": self.encode_time / self.encodes if self.encodes else 0,
+            "mean_encode_bytes": self.encode_bytes / self.encodes if self.encodes else 0,
+            "uploads": self.uploads,
+            "mean_upload": self.upload_time / self.uploads if self.uploads else 0,
+            "mean_upload_bytes": self.upload_bytes / self.uploads if self.uploads else 0
+        }
+
+
+def output_options(conf):
+    """
+    Read the output size and encoding options from the bot configuration.
+    """
+    return {
+        "max_area": conf.get("latex_max_area", 4000000),
+        "downscale": conf.get("latex_downscale", True),
+        "palette": conf.get("latex_png_palette", True),
+        "compress_level": conf.get("latex_png_compression", 6)
+    }
+
+
+class StagingArea:
+    """
+    Root directory of the per-render work directories.
+    The blocking filesystem work is done in an executor.
+    """
+    def __init__(self, root, max_age=600):
+        self.root = root
+        self.max_age = max_age
+
+        os.makedirs(self.root, exist_ok=True)
+
+        # Image sent when a render produces no output
+        with open(os.path.join(__location__, "failed.png"), 'rb') as f:
+            self.failed_image = f.read()
+
+        self.cleaner = None
+
+        # Statistics
+        self.created = 0
+        self.cleaned = 0
+
+    def _create(self, userid, document):
+        path = tempfile.mkdtemp(prefix="{}-".format(userid), dir=self.root)
+        os.chmod(path, 0o777)
+        with open(os.path.join(path, "job.tex"), 'w') as work:
+            work.write(document)
+        return path
+
+    async def create(self, loop, userid, document):
+        """
+        Create a new work directory containing the document as `job.tex`, returning its path.
+        """
+        self.created += 1
+        return await loop.run_in_executor(None, self._create, userid, document)
+
+    async def remove(self, loop, path):
+        await loop.run_in_executor(None, shutil.rmtree, path, True)
+
+    def _clean(self):
+        """
+        Remove any work directories older than the maximum age, left behind by crashes or restarts.
+        """
+        cutoff = time.time() - self.max_age
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_dir(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    shutil.rmtree(entry.path, True)
+                    self.cleaned += 1
+            except OSError:
+                pass
+
+    async def clean_loop(self, loop):
+        while True:
+            try:
+                await loop.run_in_executor(None, self._clean)
+            except Exception:
+                logging.exception("Failed to clean the LaTeX staging directory.")
+            await asyncio.sleep(self.max_age)
+
+
+def default_staging_dir():
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm/paradox-tex"
+    return "tex/staging"
 
-if (( extra > 0 )); then
-    convert {image} \
-        -gravity East +antialias -splice ${{extra}}x\
-        -alpha set -alpha Background -channel alpha -fx "i>${{width}}-5?0:a" +channel {image}
-fi
-"""
 
 # Path to the compile script
 compile_path = os.path.join(__location__, "texcompile.sh")
 
+# Prefix of the compile script output when the compile was killed for exceeding a limit
+killed_prefix = "Killed: "
+
+# First line of the compile script output when the precompiled format failed to load, and it compiled without it
+format_failed = "FormatFailed"
+
 # Header for every LaTeX source file
 header = "\\documentclass[preview, border=20pt, 12pt]{standalone}\
     \\IfFileExists{eggs.sty}{\\usepackage{eggs}}{}\
@@ -66,6 +216,14 @@ header = "\\documentclass[preview, border=20pt, 12pt]{standalone}\
     \n\\nonstopmode"
 """
 
+# Header for batched documents, with each snippet on its own page
+batch_header = "\\documentclass[preview, multi, border=20pt, 12pt]{standalone}\
+    \\IfFileExists{eggs.sty}{\\usepackage{eggs}}{}\
+    \n\\nonstopmode"
+
+# The page containing each snippet of a batched document
+batch_page = "\\begin{{standalone}}\n{source}\n\\end{{standalone}}"
+
 # The format of the source to compile
 to_compile = "{header}\
     \n{preamble}\
@@ -73,40 +231,434 @@ to_compile = "{header}\
     \n{source}\
     \n\\end{{document}}"
 
+# Compile error given when the render service can't be reached, and renders may not fall back to this process
+service_unavailable = "The LaTeX render service is currently unavailable, please try again later."
+
+
+class SingleFlight:
+    """
+    Runs at most one render of each document under each set of compile limits at a time,
+    sharing the result with every caller which asks for the same document with the same limits while it runs.
+    The render is only cancelled once every caller waiting for it has been cancelled.
+    """
+    def __init__(self):
+        # Running renders, as lists [task, number of waiting callers], keyed by render key and limits
+        self.flights = {}
+
+        # Statistics
+        self.started = 0
+        self.shared = 0
+        self.cancelled = 0
+
+    async def run(self, key, func):
+        """
+        Await the running render for the key, or start one by calling func, and return its result.
+        """
+        flight = self.flights.get(key, None)
+        if flight is None:
+            task = asyncio.ensure_future(func())
+            flight = self.flights[key] = [task, 0]
+            task.add_done_callback(lambda task: self._done(key, task))
+            self.started += 1
+        else:
+            self.shared += 1
+
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if not flight[1] and not flight[0].done():
+                # Nobody is waiting for the render any more, stop it, and let new callers start afresh
+                self.cancelled += 1
+                flight[0].cancel()
+                self._done(key, flight[0])
+
+    def _done(self, key, task):
+        flight = self.flights.get(key, None)
+        if flight is not None and flight[0] is task:
+            del self.flights[key]
+
+    def stats(self):
+        return {
+            "running": len(self.flights),
+            "started": self.started,
+            "shared": self.shared,
+            "cancelled": self.cancelled
+        }
+
 
 async def makeTeX(ctx, source, userid, preamble=default_preamble, colour="default", header=header, pad=True):
-    path = "tex/staging/{}".format(userid)
-    os.makedirs(path, exist_ok=True)
+    """
+    Compile the source with the given preamble, and render it in the given colourscheme.
+    Identical documents which are already compiling are awaited rather than compiled again.
+    Returns the compile error, and the png data of the output, or of the failure image if there is no output.
+    The render is done by the render service if one is configured, see tex_service.
+    """
+    service = ctx.bot.objects.get("latex_service", None)
+    if service is not None:
+        result = await service.makeTeX(source, userid, preamble, colour, header, pad)
+        if result is not None:
+            return result
+        if not service.fallback:
+            return (service_unavailable, ctx.bot.objects["latex_staging"].failed_image)
+
+    document = to_compile.format(header=header, preamble=preamble, source=source)
+    raster = get_backend(ctx.bot.bot_conf.get("latex_rasteriser", None))
+    loop = ctx.bot.loop
 
-    fn = "{}/{}.tex".format(path, userid)
+    options = output_options(ctx.bot.bot_conf)
+    stats = ctx.bot.objects["latex_output_stats"]
+    staging = ctx.bot.objects["latex_staging"]
 
-    with open(fn, 'w') as work:
-        work.write(to_compile.format(header=header, preamble=preamble, source=source))
-        work.close()
+    # Serve the render from the cache if we have seen it before, in any colourscheme
+    cache = ctx.bot.objects.get("latex_render_cache", None)
+    key = render_key(document, raster, options["max_area"])
+    cached = await cache.get(loop, key) if cache is not None else None
+    if cached is not None:
+        render, error = cached
+    else:
+        # Otherwise render it, or wait for the identical render already in progress under the same limits
+        limiter = ctx.bot.objects["latex_limits"]
+        started = []
 
-    # Build compile script
-    script = (
-        "{compile_script} {id} || exit;\n"
-        "cd {path}\n"
-        "{colour}\n"
-        "{pad}").format(compile_script=compile_path,
-                        id=userid, path=path,
-                        colour=colourschemes[colour] or "",
-                        pad=pad_script if pad else "").format(image="{}.png".format(userid))
+        def start():
+            started.append(True)
+            return _render(ctx, document, userid, preamble, header, raster, options, key)
+        render, error, killed = await ctx.bot.objects["latex_render_flights"].run(
+            (key, tuple(sorted(limiter.limits(userid).items()))), start
+        )
 
-    # Run the script in an async executor
-    return await ctx.run_sh(script)
+        # The render only counted against the user who started it
+        if killed and not started:
+            limiter.offend(userid)
 
+    if not render:
+        return (error, staging.failed_image)
 
-def setup_structure():
+    # Apply the colourscheme and padding
+    start = time.perf_counter()
+    image = await loop.run_in_executor(None, colourise, render, colourschemes[colour], pad, options)
+    stats.record_encode(time.perf_counter() - start, len(image))
+    return (error, image)
+
+
+async def _render(ctx, document, userid, preamble, header, raster, options, key):
     """
-    Set up the initial tex directory structure,
-    including copying the required resources.
+    Compile and rasterise a document, and reduce the output to its coverage mask, caching the result.
+    Returns the mask data, which is empty if there is no output, the compile error,
+    and the limit the compile was killed for exceeding.
     """
-    os.makedirs("tex/staging", exist_ok=True)
-    shutil.copy(os.path.join(__location__, "failed.png"), "tex")
+    loop = ctx.bot.loop
+    staging = ctx.bot.objects["latex_staging"]
+
+    path = await staging.create(loop, userid, document)
+    try:
+        # Compile against the precompiled preamble format, if it is ready
+        formats = ctx.bot.objects.get("latex_format_cache", None)
+        fmt = formats.get(preamble, header=header) if formats is not None else None
+
+        error, produced, killed = await _compile(ctx, path, userid, fmt=fmt, raster=raster, max_area=options["max_area"])
+
+        render = b""
+        if produced:
+            render = await loop.run_in_executor(None, coverage_file, os.path.join(path, "job.png"))
+    finally:
+        await staging.remove(loop, path)
+
+    # Cache the render without its colourscheme, unless the compile was killed, as the limits depend on the user
+    cache = ctx.bot.objects.get("latex_render_cache", None)
+    if cache is not None and not killed:
+        await cache.put(loop, key, render, error)
+    return (render, error, killed)
+
+
+def coverage_file(path):
+    """
+    Read the rasterised output at path, reduced to its coverage mask.
+    """
+    with open(path, 'rb') as f:
+        return coverage(f.read())
+
+
+def colourise_file(path, scheme, pad, options):
+    """
+    Reduce the rasterised output at path to its coverage mask, and post-process it.
+    Returns the mask data and the png data of the output.
+    """
+    render = coverage_file(path)
+    return (render, colourise(render, scheme, pad, options))
+
+
+def colourise(render, scheme, pad, options):
+    """
+    Apply the colourscheme, padding and output options to a render, returning the png data of the output.
+    """
+    return postprocess(render, scheme, pad=pad,
+                       max_area=options["max_area"] if options["downscale"] else 0,
+                       palette=options["palette"],
+                       compress_level=options["compress_level"])
+
+
+async def fastTeX(ctx, source, preamble=default_preamble, colour="default", pad=True):
+    """
+    Render simple maths on the default preamble in-process, without pdflatex.
+    Returns the compile error and the output png data as makeTeX, or None if the source needs pdflatex.
+    """
+    renderer = ctx.bot.objects.get("latex_math_renderer", None)
+    if renderer is None or preamble != default_preamble:
+        return None
+    math = simple_math(source)
+    if math is None:
+        return None
+
+    options = output_options(ctx.bot.bot_conf)
+    start = time.perf_counter()
+    image = await ctx.bot.loop.run_in_executor(None, render_math, renderer, math, colourschemes[colour], pad, options)
+    if image is None:
+        return None
+    ctx.bot.objects["latex_output_stats"].record_encode(time.perf_counter() - start, len(image))
+    return ("", image)
+
+
+def render_math(renderer, math, scheme, pad, options):
+    """
+    Render a formula with the fast renderer, and apply the colourscheme, padding and output options.
+    Returns the png data of the output, or None if the formula couldn't be rendered.
+    """
+    render = renderer.render(math, density)
+    if render is None:
+        return None
+    return colourise(render, scheme, pad, options)
+
+
+def batch_document(sources, preamble, header=batch_header):
+    """
+    Build the document for a batch of snippets, one page each.
+    Returns the document, and the range of document lines taken by each snippet.
+    """
+    # Everything up to the body, which starts on the line after the prefix
+    prefix = to_compile.format(header=header, preamble=preamble, source="\0").split("\0")[0]
+    line = prefix.count("\n") + 1
+
+    pages = []
+    ranges = []
+    for source in sources:
+        page = batch_page.format(source=source)
+        end = line + page.count("\n")
+        pages.append(page)
+        ranges.append((line, end))
+        line = end + 1
+    return (to_compile.format(header=header, preamble=preamble, source="\n".join(pages)), ranges)
+
+
+def batch_log(log_file, ranges):
+    """
+    Read the log of a batched compile.
+    Returns the number of pages produced, and the first error of each snippet, with up to ten lines of context.
+    Errors which can't be placed in a snippet, such as preamble errors, are given to every snippet without an error.
+    """
+    try:
+        with open(log_file, 'r', errors='replace') as log:
+            lines = log.read().splitlines()
+    except OSError:
+        return (0, [""] * len(ranges))
+
+    errors = [""] * len(ranges)
+    general = ""
+    pages = 0
+    for i, line in enumerate(lines):
+        if line.startswith("Output written on"):
+            match = re.search(r"\((\d+) pages?", line)
+            pages = int(match.group(1)) if match else 0
+        if not line.startswith("!"):
+            continue
+
+        error = "\n".join(lines[i:i + 11])
+        index = None
+        for context in lines[i + 1:i + 20]:
+            match = re.match(r"l\.(\d+)", context)
+            if match:
+                number = int(match.group(1))
+                index = next((j for j, (start, end) in enumerate(ranges) if start <= number <= end), None)
+                break
+        if index is None:
+            general = general or error
+        elif not errors[index]:
+            errors[index] = error
+    return (pages, [error or general for error in errors])
+
+
+async def makeTeX_batch(ctx, sources, userid, preamble=default_preamble, colour="default", pad=True):
+    """
+    Render several snippets sharing a preamble with a single compile, as the pages of one document.
+    Returns a list with the compile error and output png data of each snippet, as makeTeX.
+    Snippets found in the render cache, as individual documents or batch pages, are not recompiled.
+    If the batch doesn't produce one page per snippet, for example if a snippet breaks the page,
+    the remaining snippets are rendered individually.
+    If the batch is killed for exceeding a limit, every remaining snippet fails with the kill message.
+    """
+    service = ctx.bot.objects.get("latex_service", None)
+    if service is not None:
+        results = await service.makeTeX_batch(sources, userid, preamble, colour, pad)
+        if results is not None:
+            return results
+        if not service.fallback:
+            return [(service_unavailable, ctx.bot.objects["latex_staging"].failed_image)] * len(sources)
+
+    raster = get_backend(ctx.bot.bot_conf.get("latex_rasteriser", None))
+    loop = ctx.bot.loop
+
+    options = output_options(ctx.bot.bot_conf)
+    stats = ctx.bot.objects["latex_output_stats"]
+    staging = ctx.bot.objects["latex_staging"]
+    cache = ctx.bot.objects.get("latex_render_cache", None)
+
+    # Batch pages are framed by the batch header and rasterised together, so they may differ from an individual render,
+    # and are cached under the key of their page rather than of the individual document
+    singles = [render_key(to_compile.format(header=header, preamble=preamble, source=source), raster, options["max_area"])
+               for source in sources]
+    keys = [render_key(to_compile.format(header=batch_header, preamble=preamble, source=batch_page.format(source=source)),
+                       raster, options["max_area"])
+            for source in sources]
+    results = [None] * len(sources)
+    if cache is not None:
+        for i in range(len(sources)):
+            if singles[i] in cache:
+                results[i] = await ctx.makeTeX(sources[i], userid, preamble=preamble, colour=colour, pad=pad)
+                continue
+            cached = await cache.get(loop, keys[i])
+            if cached is not None:
+                render, error = cached
+                start = time.perf_counter()
+                image = await loop.run_in_executor(None, colourise, render, colourschemes[colour], pad, options)
+                stats.record_encode(time.perf_counter() - start, len(image))
+                results[i] = (error, image)
+    todo = [i for i, result in enumerate(results) if result is None]
+    if len(todo) <= 1:
+        for i in todo:
+            results[i] = await ctx.makeTeX(sources[i], userid, preamble=preamble, colour=colour, pad=pad)
+        return results
+
+    document, ranges = batch_document([sources[i] for i in todo], preamble)
+    path = await staging.create(loop, userid, document)
+    try:
+        formats = ctx.bot.objects.get("latex_format_cache", None)
+        fmt = formats.get(preamble, header=batch_header) if formats is not None else None
+
+        kill_error, produced, killed = await _compile(ctx, path, userid, fmt=fmt, raster=raster,
+                                                      max_area=options["max_area"], pages=len(todo))
+        if killed:
+            # The snippets would only be killed again on their own
+            for i in todo:
+                results[i] = (kill_error, staging.failed_image)
+            return results
+        pages, errors = await loop.run_in_executor(None, batch_log, os.path.join(path, "job.log"), ranges)
+
+        if produced and pages == len(todo):
+            for page, (i, error) in enumerate(zip(todo, errors), start=1):
+                png = os.path.join(path, page_png("job", page))
+                if not os.path.isfile(png):
+                    results[i] = (error, staging.failed_image)
+                    continue
+                start = time.perf_counter()
+                render, image = await loop.run_in_executor(None, colourise_file, png, colourschemes[colour], pad, options)
+                stats.record_encode(time.perf_counter() - start, len(image))
+                results[i] = (error, image)
+
+                # Error line numbers refer to the batch, so only clean renders are cached
+                if cache is not None and not error:
+                    await cache.put(loop, keys[i], render, error)
+    finally:
+        await staging.remove(loop, path)
+
+    # Render anything the batch couldn't individually
+    for i in todo:
+        if results[i] is None:
+            results[i] = await ctx.makeTeX(sources[i], userid, preamble=preamble, colour=colour, pad=pad)
+    return results
+
+
+async def _compile(ctx, path, userid, fmt=None, raster=None, max_area=0, pages=None):
+    """
+    Compile and rasterise the source file `job.tex` in the work directory path, within the limits of the user.
+    If the number of pages is given, each page is rasterised separately, see tex_raster.rasterise.
+    A batch is killed for the combined time of its snippets, so a killed batch doesn't count as an offence.
+    Returns the compile error, whether any output was produced, and the limit the compile was killed for exceeding.
+    """
+    limiter = ctx.bot.objects["latex_limits"]
+    limits = limiter.limits(userid)
+
+    # Compile on a warm worker if possible
+    pool = ctx.bot.objects.get("latex_worker_pool", None)
+    result = None
+    if pool is not None:
+        result = await pool.compile(path, "job", fmt=fmt, raster=raster, max_area=max_area, pages=pages, limits=limits)
+
+    if result is not None:
+        if result.get("fmt_failed", False):
+            ctx.bot.objects["latex_format_cache"].invalidate(fmt)
+        error, produced, killed = (result["error"].strip(), result["pdf"], result.get("killed", None))
+    else:
+        # Otherwise, fall back to the compile script, and rasterise the output here
+        ext = output_ext(raster)
+        error = await _run_script("{} '{}' job '{}' {} {wall} {cpu} {mem} {output}".format(
+            compile_path, path, fmt or "", ext, **limits
+        ))
+        if error.startswith(format_failed):
+            ctx.bot.objects["latex_format_cache"].invalidate(fmt)
+            error = error[len(format_failed):].strip()
+        killed = error[len(killed_prefix):] if error.startswith(killed_prefix) else None
+        produced = not killed and os.path.isfile(os.path.join(path, "job.{}".format(ext)))
+        if produced:
+            await ctx.bot.loop.run_in_executor(None, rasterise, path, "job", raster, max_area, pages)
+
+    limiter.record(userid, killed, offence=pages is None)
+    if killed:
+        error = kill_message(killed, limits)
+    return (error, produced, killed)
+
+
+async def _run_script(cmd):
+    """
+    Run the compile script, returning its output.
+    If the render is cancelled, the script and the compiler it started are stopped.
+    """
+    process = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, start_new_session=True)
+    try:
+        stdout, _ = await process.communicate()
+    except asyncio.CancelledError:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        raise
+    return stdout.decode(errors='backslashreplace').strip()
+
+
+async def prepare_math_renderer(bot):
+    # The first render loads the fonts, so do it before anyone is waiting
+    renderer = bot.objects["latex_math_renderer"]
+    if renderer is not None:
+        await bot.loop.run_in_executor(None, renderer.render, "$x$", density)
+
+
+async def clean_staging(bot):
+    staging = bot.objects["latex_staging"]
+    if staging.cleaner is None:
+        staging.cleaner = asyncio.ensure_future(staging.clean_loop(bot.loop))
 
 
 def load_into(bot):
-    setup_structure()
+    bot.objects["latex_output_stats"] = OutputStats()
+    bot.objects["latex_render_flights"] = SingleFlight()
+    bot.objects["latex_staging"] = StagingArea(
+        bot.bot_conf.get("latex_staging_dir", None) or default_staging_dir(),
+        max_age=bot.bot_conf.get("latex_staging_max_age", 600)
+    )
+    bot.objects["latex_math_renderer"] = get_renderer() if bot.bot_conf.get("latex_fast_render", True) else None
     bot.add_to_ctx(makeTeX)
+    bot.add_to_ctx(makeTeX_batch)
+    bot.add_to_ctx(fastTeX)
+    bot.add_after_event("ready", clean_staging)
+    bot.add_after_event("ready", prepare_math_renderer)
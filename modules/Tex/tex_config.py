@@ -25,9 +25,8 @@ async def show_config(ctx, user=None):
     user = user or ctx.author
 
     # Grab the config values
-    values = []
-    for to_grab in grab:
-        values.append(await ctx.data.users.get(ctx.authid, to_grab))
+    settings = await ctx.data.users.get_many(ctx.authid, props=grab)
+    values = [settings[to_grab] for to_grab in grab]
 
     # List of lines to display, depending on the option values, corresponding to grab
     value_lines = [
@@ -0,0 +1,90 @@
+"""
+Fast detection of LaTeX in message content, for the automatic tex listener.
+
+scan_tex classifies the content with as few passes as possible, using the C level substring searches,
+which are several times faster than a regular expression or Python level scanner over the same content.
+Most messages are decided by the dollar count, and messages without a backslash skip the remaining checks.
+It also extracts the code block source for parse_tex when LaTeX content contains code blocks,
+only once the content is known to be LaTeX, so other messages cost no more than the classification.
+A message is LaTeX if any of the following hold:
+    It contains a positive even number of dollar signs, and is not only dollar signs.
+    It contains more than six dollar signs.
+    It contains the start of an environment, `\\begin{`.
+    It contains both `\\[` and `\\]`, or both `\\(` and `\\)`.
+Unless it contains a code block which is not marked as LaTeX, in which case it probably isn't LaTeX.
+
+helper_scripts/tex_detect_check.py checks this against the original classifier over a corpus, and benchmarks it.
+"""
+
+# Code block openings marking a message as LaTeX
+_tex_blocks = ["```tex", "```latex", "```\n"]
+
+
+class TexScan:
+    """
+    The result of scanning message content for LaTeX.
+    `code` is the source extracted from the code blocks, or None if there are no code blocks.
+    Content which isn't LaTeX gets the shared scan `not_tex`, without its content, to save building a scan per message.
+    """
+    __slots__ = ("content", "is_tex", "code")
+
+    def __init__(self, content, is_tex, code):
+        self.content = content
+        self.is_tex = is_tex
+        self.code = code
+
+
+not_tex = TexScan(None, False, None)
+
+
+def extract_code(lines):
+    """
+    Extract the source to compile from the code blocks in the given lines.
+    """
+    to_compile = []
+    in_block = False
+    for line in lines:
+        if "```" in line:
+            splits = line.split("```")
+            for split in splits:
+                if in_block and split not in ["", "tex", "latex"]:
+                    to_compile.append("{}\n".format(split))
+                in_block = not in_block
+            if in_block:
+                to_compile.append("\n")
+            in_block = not in_block
+        elif in_block:
+            to_compile.append(line)
+    return "\n".join(to_compile)
+
+
+def scan_tex(content):
+    """
+    Check whether message content contains LaTeX source code, extracting any code blocks if it does.
+    Returns a TexScan.
+    """
+    dollars = content.count("$")
+    is_tex = dollars > 6 or bool(dollars and not dollars % 2 and content.strip("$"))
+
+    # All the remaining markers start with a backslash
+    if not is_tex and "\\" in content:
+        is_tex = (
+            "\\begin{" in content or
+            ("\\[" in content and "\\]" in content) or
+            ("\\(" in content and "\\)" in content)
+        )
+
+    if not is_tex:
+        return not_tex
+    if "```" not in content:
+        return TexScan(content, True, None)
+
+    lines = content.splitlines()
+
+    # If a non-latex code block exists, the message probably isn't LaTeX
+    if not any(word in content for word in _tex_blocks):
+        # Check whether every such code block is a one liner, or has a space in the syntax field
+        if not all(not line.count("```") % 2 or " " in line or line == "```" for line in lines if "```" in line):
+            return not_tex
+
+    return TexScan(content, True, extract_code(lines))
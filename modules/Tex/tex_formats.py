@@ -0,0 +1,191 @@
+import os
+import asyncio
+import hashlib
+
+from cachetools import LRUCache
+
+from tex_compile import header as default_header
+from tex_config import default_preamble
+
+"""
+Cache of precompiled LaTeX formats, one per distinct header and preamble.
+
+Formats are dumped with mylatexformat, so that a compile against a format skips the document preamble,
+and are kept in a size bounded LRU directory on disk.
+Formats are built in the background, and compiles fall back to a plain compile until the format is ready.
+
+Configuration (bot configuration file):
+    latex_format_disk: int
+        Maximum size of the format directory, in MB. 0 disables precompiled formats.
+
+Bot Objects:
+    latex_format_cache: FormatCache
+"""
+
+# Directory for the format files
+format_dir = "tex/formats"
+
+# Command used to dump a format, run in the format directory
+build_cmd = "sudo -u latex timeout 2m pdflatex -ini -no-shell-escape -interaction=nonstopmode -jobname={name} \"&pdflatex\" mylatexformat.ltx {name}.tex"
+
+# Source used to dump a format
+format_source = "{header}\n{preamble}\n\\begin{{document}}\n\\end{{document}}"
+
+
+def format_key(header, preamble):
+    return hashlib.sha256("{}\0{}".format(header, preamble).encode()).hexdigest()
+
+
+class FormatCache:
+    def __init__(self, max_disk=256, directory=format_dir):
+        self.directory = directory
+        self.max_disk = max_disk * 1024 * 1024
+
+        # Keys of the built formats and their sizes, least recently used first
+        self.formats = LRUCache(float('inf'))
+        self.disk_size = 0
+
+        # Formats currently building, and formats which failed to build
+        self.building = set()
+        self.failed = set()
+        self.build_lock = None
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.evictions = 0
+
+        if self.max_disk:
+            self._load_disk()
+
+    def _path(self, key):
+        return os.path.abspath(os.path.join(self.directory, "{}.fmt".format(key)))
+
+    def _load_disk(self):
+        os.makedirs(self.directory, exist_ok=True)
+        os.chmod(self.directory, 0o777)
+
+        entries = []
+        for fn in os.listdir(self.directory):
+            key, ext = os.path.splitext(fn)
+            path = os.path.join(self.directory, fn)
+            if ext == ".fmt":
+                entries.append((os.path.getmtime(path), key, os.path.getsize(path)))
+            else:
+                # Leftovers from interrupted builds
+                os.remove(path)
+
+        for _, key, size in sorted(entries):
+            self.formats[key] = size
+            self.disk_size += size
+        self._evict()
+
+    def _evict(self):
+        while self.disk_size > self.max_disk and self.formats:
+            key, size = self.formats.popitem()
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self.disk_size -= size
+            self.evictions += 1
+
+    def get(self, preamble, header=default_header):
+        """
+        Return the path of the format for this header and preamble, if it has been built.
+        Otherwise, start building it in the background and return None.
+        """
+        if not self.max_disk:
+            return None
+
+        key = format_key(header, preamble)
+        if key in self.formats:
+            # Touch the entry to record its use
+            self.formats[key]
+            self.hits += 1
+            return self._path(key)
+
+        self.misses += 1
+        self.prepare(preamble, header=header)
+        return None
+
+    def prepare(self, preamble, header=default_header):
+        """
+        Start building the format for this header and preamble in the background, if required.
+        """
+        key = format_key(header, preamble)
+        if not self.max_disk or key in self.formats or key in self.building or key in self.failed:
+            return
+        self.building.add(key)
+        asyncio.ensure_future(self._build(key, header, preamble))
+
+    def invalidate(self, path):
+        """
+        Remove a format which failed to load.
+        """
+        key = os.path.splitext(os.path.basename(path))[0]
+        if key in self.formats:
+            self.disk_size -= self.formats.pop(key)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def _build(self, key, header, preamble):
+        if self.build_lock is None:
+            self.build_lock = asyncio.Lock()
+
+        try:
+            # Only build one format at a time, formats are a background task
+            async with self.build_lock:
+                with open(os.path.join(self.directory, "{}.tex".format(key)), 'w') as source:
+                    source.write(format_source.format(header=header, preamble=preamble))
+
+                process = await asyncio.create_subprocess_shell(build_cmd.format(name=key),
+                                                                cwd=self.directory,
+                                                                stdout=asyncio.subprocess.DEVNULL,
+                                                                stderr=asyncio.subprocess.DEVNULL)
+                await process.wait()
+
+                for ext in ["tex", "log"]:
+                    try:
+                        os.remove(os.path.join(self.directory, "{}.{}".format(key, ext)))
+                    except FileNotFoundError:
+                        pass
+
+                path = self._path(key)
+                if process.returncode != 0 or not os.path.isfile(path):
+                    self.failed.add(key)
+                    if os.path.isfile(path):
+                        os.remove(path)
+                    return
+
+                size = os.path.getsize(path)
+                self.formats[key] = size
+                self.disk_size += size
+                self.builds += 1
+                self._evict()
+        finally:
+            self.building.discard(key)
+
+    def stats(self):
+        return {
+            "formats": len(self.formats),
+            "disk": self.disk_size,
+            "building": len(self.building),
+            "failed": len(self.failed),
+            "hits": self.hits,
+            "misses": self.misses,
+            "builds": self.builds,
+            "evictions": self.evictions
+        }
+
+
+async def prepare_default_format(bot):
+    bot.objects["latex_format_cache"].prepare(default_preamble)
+
+
+def load_into(bot):
+    bot.objects["latex_format_cache"] = FormatCache(max_disk=bot.bot_conf.get("latex_format_disk", 256))
+    bot.add_after_event("ready", prepare_default_format)
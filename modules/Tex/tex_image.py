@@ -0,0 +1,211 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+"""
+In-process post-processing of rasterised LaTeX output.
+
+Rasterised output is first reduced to a render independent of the colourscheme with `coverage`,
+which is what the render cache stores, so one rasterisation serves every colourscheme.
+Output consisting only of black text is stored as its alpha (coverage) mask alone, in a single channel png,
+and anything else (e.g. coloured text) is kept as the full RGBA image.
+
+Applies the colourscheme and padding steps to the render in a single decode and encode,
+producing the same pixels as the ImageMagick commands they replace:
+    negate:
+        `+negate`, inverting the grayscale pixels (e.g. black text), leaving coloured pixels alone.
+    border:
+        `-bordercolor transparent -border <n>`
+    background:
+        `-background <colour> -flatten`
+    pad:
+        Splice transparent columns onto the right of the image up to a minimum width,
+        also clearing the last four columns of the original image.
+Renders larger than a maximum pixel area may first be downscaled, which is cheapest on a coverage mask.
+The output is encoded with an exact palette when it has at most 256 colours,
+which holds for black text in the flat (opaque background) colourschemes, and is several times smaller.
+
+These functions are CPU bound, and should be run in an executor.
+"""
+
+# Minimum width of padded output
+min_width = 1000
+
+
+def coverage(data):
+    """
+    Reduce rasterised png data to its coverage mask, if the visible pixels are all black.
+    Returns the png data of the mask, or of the unchanged RGBA image.
+    """
+    with Image.open(BytesIO(data)) as image:
+        pixels = np.array(image.convert("RGBA"))
+
+    visible = pixels[..., 3] > 0
+    if pixels[visible, :3].any():
+        image = Image.fromarray(pixels, "RGBA")
+    else:
+        image = Image.fromarray(pixels[..., 3], "L")
+
+    out = BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+def from_mask(mask, negate):
+    """
+    Build the RGBA pixels of the text described by a coverage mask, in white if negated, otherwise in black.
+    """
+    pixels = np.empty(mask.shape + (4,), dtype=np.uint8)
+    pixels[..., :3] = 255 if negate else 0
+    pixels[..., 3] = mask
+    return pixels
+
+
+def downscale(image, max_area):
+    """
+    Downscale a render to fit within max_area pixels, if it is larger.
+    """
+    area = image.width * image.height
+    if not max_area or area <= max_area:
+        return image
+    scale = (max_area / area) ** 0.5
+    size = (max(int(image.width * scale), 1), max(int(image.height * scale), 1))
+    if image.mode == "L":
+        return image.resize(size, Image.LANCZOS)
+    # Resize with premultiplied alpha, so transparent pixels don't bleed into the edges
+    return image.convert("RGBa").resize(size, Image.LANCZOS).convert("RGBA")
+
+
+def negate_grey(pixels):
+    """
+    Invert the colour of the grayscale pixels, leaving the alpha channel alone.
+    """
+    rgb = pixels[..., :3]
+    grey = (rgb[..., 0] == rgb[..., 1]) & (rgb[..., 1] == rgb[..., 2])
+    rgb[grey] = 255 - rgb[grey]
+    return pixels
+
+
+def add_border(pixels, width):
+    """
+    Surround the image with a transparent border of the given width.
+    """
+    return np.pad(pixels, ((width, width), (width, width), (0, 0)), mode='constant', constant_values=0)
+
+
+def flatten(pixels, background):
+    """
+    Composite the image over a solid background colour.
+    """
+    alpha = pixels[..., 3:].astype(np.float32) / 255
+    rgb = pixels[..., :3].astype(np.float32) * alpha + np.array(background, dtype=np.float32) * (1 - alpha)
+
+    flat = np.empty_like(pixels)
+    flat[..., :3] = np.floor(rgb + 0.5).clip(0, 255)
+    flat[..., 3] = 255
+    return flat
+
+
+def pad_width(pixels, width=min_width):
+    """
+    Pad the image on the right with transparent columns up to the given width.
+    """
+    height, current = pixels.shape[:2]
+    if current >= width:
+        return pixels
+
+    padded = np.empty((height, width, 4), dtype=np.uint8)
+    padded[:, :current] = pixels
+    padded[:, current:] = 255
+
+    # Fully transparent pixels take the (white) background colour
+    padded[padded[..., 3] == 0, :3] = 255
+
+    # Clear the padding, and the edge of the original image
+    padded[:, max(current - 4, 0):, 3] = 0
+    return padded
+
+
+def palette_image(pixels):
+    """
+    Build a palette image with exactly the colours of the given RGBA pixels, if there are at most 256 of them.
+    Returns the image and the palette transparency, or None.
+    """
+    # Fully transparent pixels are invisible, so give them all the same colour
+    pixels = pixels.copy()
+    pixels[pixels[..., 3] == 0] = 0
+
+    colours = Image.fromarray(pixels, "RGBA").getcolors(256)
+    if colours is None:
+        return None
+
+    packed = pixels.view(np.uint32)[..., 0]
+    palette = np.sort(np.array([np.array(colour, dtype=np.uint8).view(np.uint32)[0] for _, colour in colours]))
+    indices = np.searchsorted(palette, packed).astype(np.uint8)
+
+    entries = palette.view(np.uint8).reshape(-1, 4)
+    image = Image.fromarray(indices, "P")
+    image.putpalette(entries[:, :3].tobytes())
+    return (image, entries[:, 3].tobytes())
+
+
+def encode(pixels, palette=True, compress_level=6):
+    """
+    Encode RGBA pixels as png data, with an exact palette if possible and requested,
+    otherwise dropping the alpha channel if the image is opaque.
+    """
+    out = BytesIO()
+    paletted = palette_image(pixels) if palette else None
+    if paletted is not None:
+        image, transparency = paletted
+        if transparency.count(b"\xff") == len(transparency):
+            image.save(out, format="PNG", compress_level=compress_level)
+        else:
+            image.save(out, format="PNG", compress_level=compress_level, transparency=transparency)
+    elif (pixels[..., 3] == 255).all():
+        Image.fromarray(pixels[..., :3], "RGB").save(out, format="PNG", compress_level=compress_level)
+    else:
+        Image.fromarray(pixels, "RGBA").save(out, format="PNG", compress_level=compress_level)
+    return out.getvalue()
+
+
+def postprocess(data, scheme, pad=True, max_area=0, palette=True, compress_level=6):
+    """
+    Apply a colourscheme from tex_compile.colourschemes, and the padding if required,
+    to png data of a render or its coverage mask.
+    The render is first downscaled to max_area pixels if given, and encoded as described in `encode`.
+    Returns the processed png data.
+    """
+    with Image.open(BytesIO(data)) as image:
+        image = downscale(image, max_area)
+        if image.mode == "L":
+            pixels = from_mask(np.array(image), scheme is not None and scheme["negate"])
+        else:
+            pixels = np.array(image.convert("RGBA"))
+            if scheme is not None and scheme["negate"]:
+                pixels = negate_grey(pixels)
+
+    if scheme is not None:
+        pixels = add_border(pixels, scheme["border"])
+        if scheme["background"] is not None:
+            pixels = flatten(pixels, scheme["background"])
+    if pad:
+        pixels = pad_width(pixels)
+
+    return encode(pixels, palette=palette, compress_level=compress_level)
+
+
+def stack(images, palette=True, compress_level=6):
+    """
+    Stack png images vertically, aligned to the left, returning the png data of the result.
+    """
+    layers = []
+    for data in images:
+        with Image.open(BytesIO(data)) as image:
+            layers.append(np.array(image.convert("RGBA")))
+
+    width = max(layer.shape[1] for layer in layers)
+    layers = [np.pad(layer, ((0, 0), (0, width - layer.shape[1]), (0, 0)), mode='constant', constant_values=0)
+              for layer in layers]
+    return encode(np.concatenate(layers), palette=palette, compress_level=compress_level)
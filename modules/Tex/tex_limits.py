@@ -0,0 +1,120 @@
+from timerwheel import TTLStore
+
+"""
+Resource limits for LaTeX compiles, by user tier, with budgets adapted to the recent history of each user.
+
+Each compile runs under a wall clock limit, and rlimits on its CPU time, address space and output file size,
+applied by texworker.py and texcompile.sh.
+A compile which is killed for exceeding a limit reports which limit it exceeded.
+Every killed compile, other than a batch compile, counts as an offence against the user for the offence window,
+and each recent offence halves the user's wall clock and CPU budget, down to a minimum fraction of the tier budget.
+
+Limits:
+    A dictionary of:
+    wall: Maximum wall clock time of a compile, in seconds.
+    cpu: Maximum CPU time of a compile, in seconds.
+    mem: Maximum address space of the compiler, in MB.
+    output: Maximum size of any file written by the compiler, in MB.
+
+Configuration (bot configuration file):
+    latex_limit_tiers: dict
+        Limits of each tier, overriding or extending the default tiers below, by tier name.
+    latex_tier_users: dict
+        Lists of user ids in each tier, by tier name. Bot managers are in the trusted tier, everyone else the default tier.
+    latex_offence_window: int
+        Seconds an offence counts against a user, renewed with each offence. Defaults to 3600.
+    latex_min_budget: float
+        Smallest fraction of the tier time limits a user's budget may be reduced to. Defaults to 0.25.
+
+Bot Objects:
+    latex_limits: CompileLimits
+"""
+
+# Limits of the built in tiers
+default_tiers = {
+    "default": {"wall": 30, "cpu": 20, "mem": 1024, "output": 32},
+    "trusted": {"wall": 60, "cpu": 50, "mem": 2048, "output": 64},
+}
+
+# Error messages given for each kill reason, formatted with the limits of the compile
+kill_messages = {
+    "wall": "Compilation timed out after {wall}s!",
+    "cpu": "Compilation exceeded its CPU time limit of {cpu}s!",
+    "mem": "Compilation exceeded its memory limit of {mem}MB!",
+    "output": "Compilation output exceeded the size limit of {output}MB!"
+}
+
+
+def kill_message(reason, limits):
+    return kill_messages[reason].format(**limits)
+
+
+class CompileLimits:
+    def __init__(self, tiers=None, tier_users=None, managers=(), window=3600, min_budget=0.25):
+        self.tiers = dict(default_tiers)
+        self.tiers.update(tiers or {})
+        self.min_budget = min_budget
+
+        # Tier of each listed user
+        self.user_tiers = {str(userid): "trusted" for userid in managers}
+        for tier, userids in (tier_users or {}).items():
+            for userid in userids:
+                self.user_tiers[str(userid)] = tier
+
+        # Number of recent offences by user
+        self.offences = TTLStore(ttl=window, max_entries=10000)
+
+        # Statistics
+        self.compiles = 0
+        self.kills = {reason: 0 for reason in kill_messages}
+
+    def tier(self, userid):
+        tier = self.user_tiers.get(str(userid), "default")
+        return tier if tier in self.tiers else "default"
+
+    def limits(self, userid):
+        """
+        The limits for the next compile of the given user.
+        """
+        limits = dict(self.tiers[self.tier(userid)])
+        offences = self.offences.get(str(userid), 0)
+        if offences:
+            scale = max(0.5 ** offences, self.min_budget)
+            limits["wall"] = max(int(limits["wall"] * scale), 1)
+            limits["cpu"] = max(int(limits["cpu"] * scale), 1)
+        return limits
+
+    def record(self, userid, killed, offence=True):
+        """
+        Record the outcome of a compile, counting an offence if it was killed for exceeding a limit,
+        unless offence is False.
+        """
+        self.compiles += 1
+        if killed:
+            self.kills[killed] += 1
+            if offence:
+                self.offend(userid)
+
+    def offend(self, userid):
+        """
+        Count an offence against the user, such as sharing a compile which was killed.
+        """
+        self.offences.set(str(userid), self.offences.get(str(userid), 0) + 1)
+
+    def stats(self):
+        return {
+            "compiles": self.compiles,
+            "kills": dict(self.kills),
+            "offenders": len(self.offences)
+        }
+
+
+def load_into(bot):
+    conf = bot.bot_conf
+    bot.objects["latex_limits"] = CompileLimits(
+        tiers=conf.get("latex_limit_tiers", None),
+        tier_users=conf.get("latex_tier_users", None),
+        managers=conf.get("managers", []),
+        window=conf.get("latex_offence_window", 3600),
+        min_budget=conf.get("latex_min_budget", 0.25)
+    )
@@ -0,0 +1,143 @@
+import re
+import threading
+from io import BytesIO
+
+"""
+Fast in-process rendering of simple maths, with matplotlib's mathtext, for snippets which don't need pdflatex.
+
+A source is simple if it is a single inline formula, `$...$` or `\\(...\\)`, made only of ASCII symbols
+and the whitelisted commands below, which mathtext lays out close enough to LaTeX with the default preamble.
+Anything else, or anything mathtext fails to parse, is left to pdflatex.
+The default preamble typesets all maths in display style, so fractions are rendered as `\\dfrac`.
+
+The render is returned as a coverage mask, as in tex_image.coverage, so the colourscheme and padding are applied
+exactly as for pdflatex output.
+matplotlib is optional, and the fast path is disabled if it isn't installed.
+"""
+
+# Commands mathtext renders like LaTeX does
+allowed_commands = set([
+    # Greek letters
+    "alpha", "beta", "gamma", "delta", "epsilon", "varepsilon", "zeta", "eta", "theta", "vartheta", "iota",
+    "kappa", "lambda", "mu", "nu", "xi", "pi", "varpi", "rho", "varrho", "sigma", "varsigma", "tau",
+    "upsilon", "phi", "varphi", "chi", "psi", "omega",
+    "Gamma", "Delta", "Theta", "Lambda", "Xi", "Pi", "Sigma", "Upsilon", "Phi", "Psi", "Omega",
+    # Structures
+    "frac", "sqrt", "left", "right",
+    # Big operators
+    "sum", "prod", "int", "oint", "lim",
+    # Binary operators and relations
+    "cdot", "times", "div", "pm", "mp", "circ", "leq", "le", "geq", "ge", "neq", "ne", "approx", "equiv",
+    "sim", "simeq", "propto", "to", "rightarrow", "leftarrow", "Rightarrow", "Leftarrow", "leftrightarrow",
+    "Leftrightarrow", "mapsto", "in", "notin", "subset", "subseteq", "supset", "supseteq", "cup", "cap",
+    "mid", "land", "lor",
+    # Symbols
+    "infty", "partial", "nabla", "emptyset", "forall", "exists", "neg", "ldots", "cdots",
+    "langle", "rangle", "lfloor", "rfloor", "lceil", "rceil",
+    # Functions
+    "sin", "cos", "tan", "log", "ln", "exp", "min", "max", "det",
+    # Fonts and spacing
+    "mathrm", "mathbf", "quad", "qquad",
+    ",", ";", "!", " ", "{", "}", "|"
+])
+
+# Characters allowed outside commands
+allowed_chars = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 +-=<>()[]|/*',.;:!^_{}")
+
+_command = re.compile(r"\\([A-Za-z]+|.)")
+
+# Font size of the default preamble, in points
+font_size = 14
+
+
+def simple_math(source):
+    """
+    Check whether the source is a single simple inline formula.
+    Returns the formula, in mathtext form, or None if the source needs pdflatex.
+    """
+    source = source.strip()
+    if len(source) > 2 and source[0] == "$" and source[-1] == "$" and source[1] != "$" and source[-2] != "$":
+        math = source[1:-1]
+    elif source.startswith("\\(") and source.endswith("\\)"):
+        math = source[2:-2]
+    else:
+        return None
+    if not math.strip():
+        return None
+
+    # Check the commands, then everything outside the commands
+    for command in _command.findall(math):
+        if command not in allowed_commands:
+            return None
+    if not all(char in allowed_chars for char in _command.sub("", math)):
+        return None
+
+    # Brace groups must balance, as mathtext is more forgiving than LaTeX
+    depth = 0
+    for char in _command.sub("", math):
+        depth += (char == "{") - (char == "}")
+        if depth < 0:
+            return None
+    if depth:
+        return None
+
+    # The default preamble renders all maths in display style
+    math = re.sub(r"\\frac(?![A-Za-z])", r"\\dfrac", math)
+    return "${}$".format(math)
+
+
+class MathRenderer:
+    """
+    Renders formulae to coverage masks with mathtext.
+    matplotlib isn't thread safe, so renders are serialised.
+    """
+    def __init__(self):
+        import matplotlib
+        from matplotlib.mathtext import MathTextParser
+        from matplotlib.font_manager import FontProperties
+
+        matplotlib.rcParams["mathtext.fontset"] = "cm"
+        self.parser = MathTextParser("agg")
+        self.prop = FontProperties(size=font_size)
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.rendered = 0
+        self.failed = 0
+
+    def render(self, math, density):
+        """
+        Render a formula from simple_math at the given density.
+        Returns the png data of the coverage mask, trimmed to the content, or None if mathtext can't render it.
+        """
+        import numpy as np
+        from PIL import Image
+
+        with self.lock:
+            try:
+                parsed = self.parser.parse(math, dpi=density, prop=self.prop)
+            except Exception:
+                self.failed += 1
+                return None
+            mask = np.array(parsed.image, dtype=np.uint8)
+
+        image = Image.fromarray(mask, "L")
+        bbox = image.getbbox()
+        if bbox is None:
+            self.failed += 1
+            return None
+        self.rendered += 1
+
+        out = BytesIO()
+        image.crop(bbox).save(out, format="PNG")
+        return out.getvalue()
+
+
+def get_renderer():
+    """
+    Create a MathRenderer, or return None if matplotlib isn't installed.
+    """
+    try:
+        return MathRenderer()
+    except ImportError:
+        return None
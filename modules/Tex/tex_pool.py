@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import shlex
+import asyncio
+import logging
+
+import psutil
+
+"""
+Pool of long lived, sandboxed LaTeX compilation workers.
+
+Each worker is a texworker.py process started through the configured sandbox command,
+which keeps a pdflatex process primed and takes compilation jobs over its stdin/stdout pipes.
+Workers are recycled after a fixed number of jobs, or when their memory usage grows too large.
+
+Configuration (bot configuration file):
+    latex_pool_size: int
+        Number of workers to run. 0 disables the pool, so all compiles use texcompile.sh.
+    latex_worker_max_jobs: int
+        Number of jobs a worker handles before being restarted.
+    latex_worker_max_mem: int
+        Maximum resident memory of a worker and its children in MB before it is restarted.
+    latex_worker_cmd: string
+        Command used to start a worker, formatted with `python`, `script` and `scratch`.
+
+Bot Objects:
+    latex_worker_pool: TexWorkerPool
+"""
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+# Path to the worker script
+worker_path = os.path.join(__location__, "texworker.py")
+
+# Default command used to start a worker inside the sandbox
+default_worker_cmd = "sudo -u latex {python} -u {script} {scratch}"
+
+# Root directory for the worker scratch directories
+scratch_root = "tex/workers"
+
+
+class TexWorker:
+    """
+    A single compilation worker process.
+    """
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.scratch = os.path.abspath(os.path.join(scratch_root, str(index)))
+
+        self.proc = None
+        self.jobs = 0
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        os.makedirs(self.scratch, exist_ok=True)
+        os.chmod(self.scratch, 0o777)
+
+        cmd = self.pool.cmd.format(python=sys.executable, script=worker_path, scratch=self.scratch)
+        self.proc = await asyncio.create_subprocess_exec(*shlex.split(cmd),
+                                                         stdin=asyncio.subprocess.PIPE,
+                                                         stdout=asyncio.subprocess.PIPE)
+        self.jobs = 0
+
+    async def stop(self):
+        if not self.alive:
+            self.proc = None
+            return
+        # Closing stdin makes the worker exit cleanly
+        self.proc.stdin.close()
+        try:
+            await asyncio.wait_for(self.proc.wait(), 5)
+        except asyncio.TimeoutError:
+            self.proc.kill()
+            await self.proc.wait()
+        self.proc = None
+
+    async def kill(self):
+        """
+        Stop the worker in the middle of a job.
+        The sandbox forwards the signal to the worker, which stops its compiler.
+        """
+        if not self.alive:
+            self.proc = None
+            return
+        self.proc.terminate()
+        try:
+            await asyncio.wait_for(self.proc.wait(), 5)
+        except asyncio.TimeoutError:
+            self.proc.kill()
+            await self.proc.wait()
+        self.proc = None
+
+    def memory(self):
+        """
+        Resident memory of the worker and its children, in bytes.
+        """
+        try:
+            proc = psutil.Process(self.proc.pid)
+            return sum(p.memory_info().rss for p in [proc] + proc.children(recursive=True))
+        except psutil.Error:
+            return 0
+
+    async def run(self, job):
+        """
+        Send a job to the worker and wait for the result.
+        Returns None if the worker has died.
+        """
+        if not self.alive:
+            await self.start()
+
+        self.proc.stdin.write((json.dumps(job) + "\n").encode())
+        try:
+            await self.proc.stdin.drain()
+            line = await self.proc.stdout.readline()
+        except ConnectionError:
+            line = b""
+        self.jobs += 1
+
+        if not line:
+            await self.stop()
+            return None
+        return json.loads(line.decode())
+
+    def needs_recycle(self):
+        if self.jobs >= self.pool.max_jobs:
+            return True
+        return self.pool.max_mem and self.memory() > self.pool.max_mem * 1024 * 1024
+
+
+class TexWorkerPool:
+    """
+    Hands compilation jobs out to a fixed number of warm workers.
+    Workers are started lazily, on their first job.
+    Cancelling a compile kills the worker running it, which is restarted for its next job.
+    """
+    def __init__(self, size=2, max_jobs=200, max_mem=256, cmd=default_worker_cmd):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_mem = max_mem
+        self.cmd = cmd
+
+        self.workers = [TexWorker(self, i) for i in range(size)]
+        self.idle = None
+
+        # Statistics
+        self.jobs = 0
+        self.failures = 0
+        self.recycled = 0
+        self.cancelled = 0
+
+    def _ensure_queue(self):
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for worker in self.workers:
+                self.idle.put_nowait(worker)
+
+    async def compile(self, path, name, fmt=None, raster=None, max_area=0, pages=None, limits=None):
+        """
+        Compile `<path>/<name>.tex` on a worker, rasterising the output to `<name>.png`.
+        If a precompiled format path is given, the source is compiled against it.
+        The output is rasterised with the given tex_raster backend, or the default, within max_area pixels if given.
+        If the number of pages is given, each page is rasterised to `<name>-<page>.png` instead.
+        The compile runs within the given tex_limits limits, or the worker defaults.
+        Returns the worker result, containing the compile error string and whether a pdf was produced,
+        or None if no worker was able to run the job, in which case the caller should fall back to texcompile.sh.
+        """
+        if not self.size:
+            return None
+        self._ensure_queue()
+
+        worker = await self.idle.get()
+        try:
+            try:
+                result = await worker.run({"path": os.path.abspath(path), "name": name, "fmt": fmt, "raster": raster,
+                                           "max_area": max_area, "pages": pages, "limits": limits})
+            except asyncio.CancelledError:
+                # The render was superseded, stop the compile rather than waiting for it
+                self.cancelled += 1
+                await worker.kill()
+                raise
+            except Exception:
+                logging.exception("LaTeX worker {} failed, restarting it.".format(worker.index))
+                await worker.stop()
+                result = None
+
+            if result is None or result.get("failed", False):
+                self.failures += 1
+                return None
+
+            self.jobs += 1
+            if worker.needs_recycle():
+                self.recycled += 1
+                await worker.stop()
+            return result
+        finally:
+            self.idle.put_nowait(worker)
+
+    async def close(self):
+        for worker in self.workers:
+            await worker.stop()
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "alive": sum(worker.alive for worker in self.workers),
+            "idle": self.idle.qsize() if self.idle is not None else self.size,
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "recycled": self.recycled,
+            "cancelled": self.cancelled
+        }
+
+
+def load_into(bot):
+    conf = bot.bot_conf
+    bot.objects["latex_worker_pool"] = TexWorkerPool(
+        size=conf.get("latex_pool_size", 2),
+        max_jobs=conf.get("latex_worker_max_jobs", 200),
+        max_mem=conf.get("latex_worker_max_mem", 256),
+        cmd=conf.get("latex_worker_cmd", default_worker_cmd)
+    )
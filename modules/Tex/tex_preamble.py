@@ -6,6 +6,8 @@ from io import BytesIO
 
 import discord
 
+from tex_image import stack
+
 from paraCH import paraCH
 
 cmds = paraCH()
@@ -21,14 +23,13 @@ Commands:
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
-preamble_test_code = r"""
-ABCDEFGHIJKLMNOPQRSTUVWXYZ\\
-
-Here is a fraction: \(\frac{1}{2}\).
-
-Here is a display equation: \[(a+b)^2 = a^2 + b^2\]
-(in fields of order $2$)
-"""
+# Test snippets for pending preambles, rendered together in a single batch
+preamble_test_snippets = [
+    r"ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+    r"Here is a fraction: \(\frac{1}{2}\).",
+    r"""Here is a display equation: \[(a+b)^2 = a^2 + b^2\]
+(in fields of order $2$)"""
+]
 
 # Load default preamble from file
 with open(os.path.join(__location__, "preamble.tex"), 'r') as preamble:
@@ -123,6 +124,15 @@ def tex_pagination(text, basetitle="", header=None, timestamp=True, author=None,
     return embeds
 
 
+def prepare_format(ctx, preamble):
+    """
+    Start building the precompiled format for a newly applied preamble in the background.
+    """
+    formats = ctx.bot.objects.get("latex_format_cache", None)
+    if formats is not None and preamble:
+        formats.prepare(preamble)
+
+
 async def sendfile_reaction_handler(ctx, out_msg, contents, title):
     try:
         await ctx.bot.add_reaction(out_msg, ctx.bot.objects["emoji_sendfile"])
@@ -133,30 +143,28 @@ async def sendfile_reaction_handler(ctx, out_msg, contents, title):
     temp_file = BytesIO()
     temp_file.write(contents.encode())
 
-    while True:
-        res = await ctx.bot.wait_for_reaction(message=out_msg,
-                                              emoji=ctx.bot.objects["emoji_sendfile"],
-                                              timeout=300)
-        if res is None:
-            try:
-                await ctx.bot.remove_reaction(out_msg, ctx.bot.objects["emoji_sendfile"], ctx.me)
-            except Exception:
-                pass
-            break
-        elif res.user != ctx.me:
-            try:
-                temp_file.seek(0)
-                await ctx.bot.send_file(res.user, fp=temp_file, filename="preamble.tex", content=title)
-            except discord.Forbidden:
-                pass
-            except discord.HTTPException:
-                pass
-            try:
-                await ctx.bot.remove_reaction(out_msg, ctx.bot.objects["emoji_sendfile"], res.user)
-            except Exception:
-                pass
+    async def send_file(reaction, user):
+        try:
+            temp_file.seek(0)
+            await ctx.bot.send_file(user, fp=temp_file, filename="preamble.tex", content=title)
+        except discord.Forbidden:
+            pass
+        except discord.HTTPException:
+            pass
+        try:
+            await ctx.bot.remove_reaction(out_msg, ctx.bot.objects["emoji_sendfile"], user)
+        except Exception:
+            pass
 
-    temp_file.close()
+    async def send_file_expired():
+        try:
+            await ctx.bot.remove_reaction(out_msg, ctx.bot.objects["emoji_sendfile"], ctx.me)
+        except Exception:
+            pass
+        temp_file.close()
+
+    ctx.bot.objects["reaction_router"].register(out_msg, send_file, emojis=[ctx.bot.objects["emoji_sendfile"]],
+                                                on_expire=send_file_expired)
 
 
 async def view_preamble(ctx, preamble, title, header=None, start_page=0,
@@ -296,7 +304,7 @@ async def judgement_reactions(ctx, userid, msg):
 
     # Checks whether the emoji is valid and whether the user has permission to review preambles
     def judgement_check(reaction, user):
-        return (reaction.emoji in [approve_emo, deny_emo, test_emo]) and ctx.is_manager(user)
+        return ctx.is_manager(user)
 
     # Add the reactions, if possible
     try:
@@ -306,41 +314,41 @@ async def judgement_reactions(ctx, userid, msg):
     except discord.Forbidden:
         return
 
-    # Reaction action loop
-    while True:
-        res = await ctx.bot.wait_for_reaction(message=msg,
-                                              check=judgement_check,
-                                              timeout=600)
-
-        # On timeout
-        if res is None:
-            # If the user still has a pending preamble, continue the loop
-            if await ctx.bot.data.users_long.get(userid, "pending_preamble"):
-                continue
-
-            # Otherwise, remove the reactions and return
-            try:
-                await ctx.bot.remove_reaction(msg, approve_emo, ctx.me)
-                await ctx.bot.remove_reaction(msg, deny_emo, ctx.me)
-                await ctx.bot.remove_reaction(msg, test_emo, ctx.me)
-            except Exception:
-                pass
-            return None
-
+    async def judge(reaction, user):
         # If the user no longer has a pending preamble, let the reviewer know and exit
         if not await ctx.bot.data.users_long.get(userid, "pending_preamble"):
+            handler.finish(None)
             await ctx.reply("Submission no longer exists!")
-            return None
+            return
 
         # Handle the reacted emoji as appropriate
-        if res.reaction.emoji == approve_emo:
-            if await approve_submission(ctx, userid, res.user):
-                return True
-        elif res.reaction.emoji == deny_emo:
-            if await deny_submission(ctx, userid, res.user):
-                return False
-        elif res.reaction.emoji == test_emo:
-            await test_submission(ctx, userid, res.user)
+        if reaction.emoji == approve_emo:
+            if await approve_submission(ctx, userid, user):
+                handler.finish(True)
+        elif reaction.emoji == deny_emo:
+            if await deny_submission(ctx, userid, user):
+                handler.finish(False)
+        elif reaction.emoji == test_emo:
+            await test_submission(ctx, userid, user)
+
+    async def judgement_expired():
+        # If the user still has a pending preamble, keep waiting
+        if await ctx.bot.data.users_long.get(userid, "pending_preamble"):
+            return True
+
+        # Otherwise, remove the reactions
+        try:
+            await ctx.bot.remove_reaction(msg, approve_emo, ctx.me)
+            await ctx.bot.remove_reaction(msg, deny_emo, ctx.me)
+            await ctx.bot.remove_reaction(msg, test_emo, ctx.me)
+        except Exception:
+            pass
+
+    # Handle reactions through the reaction router, and wait for the judgement
+    handler = ctx.bot.objects["reaction_router"].register(msg, judge, emojis=[approve_emo, deny_emo, test_emo],
+                                                          check=judgement_check, ttl=600,
+                                                          on_expire=judgement_expired)
+    return await handler.wait()
 
 
 async def approve_submission(ctx, userid, manager):
@@ -350,13 +358,13 @@ async def approve_submission(ctx, userid, manager):
     await handled_preamble(ctx, userid, "Preamble approved by {}".format(manager.mention), colour=discord.Colour.green())
 
     # Then update the preamble
-    current_preamble = await ctx.data.users_long.get(userid, "latex_preamble")
-    await ctx.data.users_long.set(userid, "previous_preamble", current_preamble)
-
-    new_preamble = await ctx.data.users_long.get(userid, "pending_preamble")
-    await ctx.data.users_long.set(userid, "latex_preamble", new_preamble)
+    preambles = await ctx.data.users_long.get_many(userid, props=["latex_preamble", "pending_preamble"])
+    current_preamble, new_preamble = preambles["latex_preamble"], preambles["pending_preamble"]
+    await ctx.data.users_long.set_many(userid, {"previous_preamble": current_preamble,
+                                                "latex_preamble": new_preamble,
+                                                "pending_preamble": None})
+    prepare_format(ctx, new_preamble)
 
-    await ctx.data.users_long.set(userid, "pending_preamble", None)
     await ctx.data.users.set(userid, "pending_preamble_info", None)
 
     # Find the user
@@ -442,22 +450,20 @@ async def test_submission(ctx, userid, manager):
         await ctx.reply("This user no longer has a pending preamble!")
         return
 
-    # Compile the latex with this preamble
-    log = await ctx.makeTeX(preamble_test_code, manager.id, preamble=preamble)
-
-    file_name = "tex/staging/{id}/{id}.png".format(id=manager.id)
+    # Compile the test snippets with this preamble, and stack the output
+    results = await ctx.makeTeX_batch(preamble_test_snippets, manager.id, preamble=preamble)
+    log = "\n".join("Snippet {}:\n{}".format(i + 1, error) for i, (error, _) in enumerate(results) if error)
+    image = await ctx.bot.loop.run_in_executor(None, stack, [image for _, image in results])
 
     if not log:
         message = "Test compile for pending preamble of {}.\
             \nNo errors during compile. Please check compiled image below.".format(userid)
-        out_msg = await ctx.reply(message=message, file_name=file_name)
+        out_msg = await ctx.reply(message=message, file_data=BytesIO(image), file_name="out.png")
     else:
         message = "Test compile for pending preamble of {}.\
             \nSee the error log and output image below.".format(userid)
         embed = discord.Embed(description="```\n{}\n```".format(log))
-        # Generate file data
-        with open(file_name, 'rb') as im:
-            out_msg = await ctx.send(ctx.ch, message=message, file_data=im, file_name="out.png", embed=embed)
+        out_msg = await ctx.send(ctx.ch, message=message, file_data=BytesIO(image), file_name="out.png", embed=embed)
     asyncio.ensure_future(ctx.offer_delete(out_msg))
 
 
@@ -499,9 +505,7 @@ async def cmd_preamble(ctx):
             # Reset the preamble
             current_preamble = await ctx.data.users_long.get(ctx.authid, "latex_preamble")
 
-            await ctx.data.users_long.set(ctx.authid, "previous_preamble", current_preamble)
-            await ctx.data.users_long.set(ctx.authid, "latex_preamble", None)
-            await ctx.data.users_long.set(ctx.authid, "pending_preamble", None)
+            await ctx.data.users_long.set_many(ctx.authid, {"previous_preamble": current_preamble, "latex_preamble": None, "pending_preamble": None})
             await ctx.data.users.set(ctx.authid, "pending_preamble_info", None)
 
             await handled_preamble(ctx, ctx.authid, "Preamble was reset", colour=discord.Colour.red())
@@ -537,8 +541,7 @@ async def cmd_preamble(ctx):
             else:
                 current_preamble = await ctx.data.users_long.get(ctx.authid, "latex_preamble")
 
-                await ctx.data.users_long.set(ctx.authid, "previous_preamble", current_preamble)
-                await ctx.data.users_long.set(ctx.authid, "latex_preamble", previous_preamble)
+                await ctx.data.users_long.set_many(ctx.authid, {"previous_preamble": current_preamble, "latex_preamble": previous_preamble})
 
                 await ctx.reply("Your preamble has been reverted.")
                 await preamblelog(ctx, "Preamble was reverted to the previous version")
@@ -632,8 +635,7 @@ async def cmd_preamble(ctx):
 
         if new_preamble is not None:
             # Finally, update the preamble
-            await ctx.data.users_long.set(ctx.authid, "previous_preamble", preamble)
-            await ctx.data.users_long.set(ctx.authid, "latex_preamble", new_preamble)
+            await ctx.data.users_long.set_many(ctx.authid, {"previous_preamble": preamble, "latex_preamble": new_preamble})
 
             await ctx.reply("Your preamble has been updated!")
             await preamblelog(ctx, "Material was removed from the preamble. New preamble below.", source=new_preamble)
@@ -684,8 +686,8 @@ async def cmd_preamble(ctx):
 
         # Set the preamble
         current_preamble = await ctx.data.users_long.get(ctx.authid, 'latex_preamble')
-        await ctx.data.users_long.set(ctx.authid, 'previous_preamble', current_preamble)
-        await ctx.data.users_long.set(ctx.authid, 'latex_preamble', preset)
+        await ctx.data.users_long.set_many(ctx.authid, {'previous_preamble': current_preamble, 'latex_preamble': preset})
+        prepare_format(ctx, preset)
 
         await ctx.reply("The preset has been applied!\
                         \nTo revert to your previous preamble, use `{}preamble --revert`".format(ctx.used_prefix))
@@ -747,8 +749,7 @@ async def cmd_preamble(ctx):
             if all(not package.strip() or (package.strip() in whitelisted_packages) for package in packages):
                 # All the requested packages are whitelisted
                 # Update the preamble, log the changes, and notify the user
-                await ctx.data.users_long.set(ctx.authid, "previous_preamble", preamble)
-                await ctx.data.users_long.set(ctx.authid, "latex_preamble", new_submission)
+                await ctx.data.users_long.set_many(ctx.authid, {"previous_preamble": preamble, "latex_preamble": new_submission})
 
                 await ctx.reply("Your preamble has been updated!")
                 await preamblelog(ctx, "Whitelisted packages were added to the preamble. New preamble below.",
@@ -946,6 +947,7 @@ async def cmd_serverpreamble(ctx):
 
         # Change the preamble
         await ctx.data.servers_long.set(ctx.server.id, 'server_latex_preamble', new_preamble)
+        prepare_format(ctx, new_preamble)
 
         # Log this, and notify the user
         await preamblelog(ctx, "Server preamble was updated!", source=new_preamble, author=server_str)
@@ -1066,7 +1068,7 @@ async def user_admin(ctx, userid):
 
         preamble = None
         offer_msg = await ctx.reply(prompt)
-        result_msg = await ctx.bot.wait_for_message(author=ctx.author, timeout=600)
+        result_msg = await ctx.wait_for_message(author=ctx.author, timeout=600)
 
         # Grab response content, using the contents of the first attachment if it exists
         if result_msg is None or result_msg.content.lower() in ["c", "cancel"]:
@@ -1112,8 +1114,7 @@ async def user_admin(ctx, userid):
 
         # Finally, set the preamble
         current_preamble = await ctx.data.users_long.get(userid, "latex_preamble")
-        await ctx.data.users_long.set(userid, "previous_preamble", current_preamble)
-        await ctx.data.users_long.set(userid, "latex_preamble", preamble)
+        await ctx.data.users_long.set_many(userid, {"previous_preamble": current_preamble, "latex_preamble": preamble})
 
         await ctx.reply("The preamble was updated.")
         await preamblelog(ctx, "Manual preamble update",
@@ -1124,9 +1125,7 @@ async def user_admin(ctx, userid):
         # Reset the current preamble to the default
         current_preamble = await ctx.data.users_long.get(userid, "latex_preamble")
 
-        await ctx.data.users_long.set(userid, "previous_preamble", current_preamble)
-        await ctx.data.users_long.set(userid, "latex_preamble", None)
-        await ctx.data.users_long.set(userid, "pending_preamble", None)
+        await ctx.data.users_long.set_many(userid, {"previous_preamble": current_preamble, "latex_preamble": None, "pending_preamble": None})
         await ctx.data.users.set(userid, "pending_preamble_info", None)
 
         await handled_preamble(ctx, userid, "Preamble was reset", colour=discord.Colour.red())
@@ -1205,7 +1204,7 @@ async def server_admin(ctx, serverid):
 
         preamble = None
         offer_msg = await ctx.reply(prompt)
-        result_msg = await ctx.bot.wait_for_message(author=ctx.author, timeout=600)
+        result_msg = await ctx.wait_for_message(author=ctx.author, timeout=600)
 
         # Grab response content, using the contents of the first attachment if it exists
         if result_msg is None or result_msg.content.lower() in ["c", "cancel"]:
@@ -1375,7 +1374,7 @@ async def cmd_ppr(ctx):
 
         preset = None
         offer_msg = await ctx.reply(prompt)
-        result_msg = await ctx.bot.wait_for_message(author=ctx.author, timeout=600)
+        result_msg = await ctx.wait_for_message(author=ctx.author, timeout=600)
 
         # Grab response content, using the contents of the first attachment if it exists
         if result_msg is None or result_msg.content.lower() in ["c", "cancel"]:
@@ -1571,7 +1570,7 @@ async def cmd_ppr(ctx):
 
             preset = None
             offer_msg = await ctx.reply(prompt)
-            result_msg = await ctx.bot.wait_for_message(author=ctx.author, timeout=600)
+            result_msg = await ctx.wait_for_message(author=ctx.author, timeout=600)
 
             # Grab response content, using the contents of the first attachment if it exists
             if result_msg is None or result_msg.content.lower() in ["c", "cancel"]:
@@ -1672,8 +1671,8 @@ async def cmd_ppr(ctx):
 
         # Set the preamble
         current_preamble = await ctx.data.users_long.get(ctx.authid, 'latex_preamble')
-        await ctx.data.users_long.set(ctx.authid, 'previous_preamble', current_preamble)
-        await ctx.data.users_long.set(ctx.authid, 'latex_preamble', preset)
+        await ctx.data.users_long.set_many(ctx.authid, {'previous_preamble': current_preamble, 'latex_preamble': preset})
+        prepare_format(ctx, preset)
 
         await ctx.reply("The preset has been applied!\
                         \nTo revert to your previous preamble, use `{}preamble --revert`".format(ctx.used_prefix))
@@ -0,0 +1,217 @@
+import os
+import re
+import zlib
+import shutil
+import struct
+import subprocess
+
+"""
+Rasterisation backends for compiled LaTeX output.
+
+Each backend renders a page of `<path>/<name>.pdf` (or `<name>.dvi` for DVI backends)
+to a png in `<path>` with a transparent background, trimmed to the content.
+PDF output is rendered at the default density, reduced so that the trimmed page fits in a maximum pixel area if given.
+The page size of DVI output isn't known in advance, so DVI backends always render at the default density.
+This module is also imported by texworker.py inside the sandbox, so it only depends on the standard library,
+and on Pillow or PyMuPDF where a backend needs them.
+
+Backends:
+    convert:
+        ImageMagick convert through Ghostscript. The original rasteriser.
+    dvipng:
+        Compile to DVI and render with dvipng. Much faster, but ignores PostScript specials (e.g. TikZ).
+    pdftocairo:
+        Poppler's cairo renderer.
+    mupdf:
+        In-process rendering with PyMuPDF, if it is installed.
+
+Configuration (bot configuration file):
+    latex_rasteriser: string
+        Name of the backend to use. Defaults to convert.
+    latex_max_area: int
+        Target maximum pixel area of the rasterised output. 0 for no limit.
+"""
+
+# Default and minimum rasterisation density, in dots per inch
+density = 700
+min_density = 100
+
+# Border around the page content, in points, matching the standalone border in tex_compile.header
+page_border = 20
+
+_mediabox = re.compile(rb"/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]")
+_stream = re.compile(rb"stream\r?\n")
+
+
+def _run(args, path):
+    subprocess.run(args, cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def trim(png):
+    """
+    Crop the png file to the bounding box of its non-transparent pixels, as `convert -trim` does.
+    """
+    from PIL import Image
+
+    with Image.open(png) as image:
+        image = image.convert("RGBA")
+        bbox = image.getchannel("A").getbbox()
+        if bbox is None or bbox == (0, 0) + image.size:
+            return
+        image = image.crop(bbox)
+    image.save(png, format="PNG")
+
+
+def page_size(pdf):
+    """
+    Read the size of the first page of a pdf file from its MediaBox, in points.
+    For multi-page output this is usually the first page, though the order of the page objects isn't guaranteed.
+    pdfTeX usually stores the page objects in compressed object streams, which are searched if required.
+    Returns a tuple (width, height), or None if the size couldn't be found.
+    """
+    try:
+        with open(pdf, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    match = _mediabox.search(data)
+    if match is None:
+        for stream in _stream.finditer(data):
+            if b"/ObjStm" not in data[max(stream.start() - 200, 0):stream.start()]:
+                continue
+            try:
+                match = _mediabox.search(zlib.decompressobj().decompress(data[stream.end():]))
+            except zlib.error:
+                continue
+            if match is not None:
+                break
+    if match is None:
+        return None
+
+    x0, y0, x1, y1 = (float(coord) for coord in match.groups())
+    return (abs(x1 - x0), abs(y1 - y0))
+
+
+def png_area(png):
+    """
+    Read the pixel area of a png file from its header, or 0 if it couldn't be read.
+    """
+    try:
+        with open(png, 'rb') as f:
+            data = f.read(24)
+    except OSError:
+        return 0
+    if len(data) < 24 or data[12:16] != b"IHDR":
+        return 0
+    width, height = struct.unpack(">II", data[16:24])
+    return width * height
+
+
+def choose_density(pdf, max_area=0):
+    """
+    Choose the rasterisation density for a pdf, so the trimmed page fits within max_area pixels.
+    """
+    if not max_area:
+        return density
+    size = page_size(pdf)
+    if size is None:
+        return density
+
+    # Area of the trimmed page, in square inches
+    area = max(size[0] - 2 * page_border, 1) * max(size[1] - 2 * page_border, 1) / (72 * 72)
+    return max(min(density, int((max_area / area) ** 0.5)), min_density)
+
+
+def raster_convert(path, name, out, density=density, page=1):
+    _run(["convert", "-density", str(density), "-quality", "75", "-depth", "8", "-trim", "+repage",
+          "{}.pdf[{}]".format(name, page - 1), out], path)
+
+
+def raster_dvipng(path, name, out, density=density, page=1):
+    _run(["dvipng", "-q", "-D", str(density), "-T", "tight", "-bg", "Transparent", "--truecolor",
+          "-p", "={}".format(page), "-l", "={}".format(page), "-o", out, "{}.dvi".format(name)], path)
+    trim(os.path.join(path, out))
+
+
+def raster_pdftocairo(path, name, out, density=density, page=1):
+    _run(["pdftocairo", "-png", "-transp", "-singlefile", "-r", str(density), "-f", str(page), "-l", str(page),
+          "{}.pdf".format(name), os.path.splitext(out)[0]], path)
+    trim(os.path.join(path, out))
+
+
+def raster_mupdf(path, name, out, density=density, page=1):
+    import fitz
+
+    with fitz.open(os.path.join(path, "{}.pdf".format(name))) as doc:
+        pixmap = doc[page - 1].get_pixmap(dpi=density, alpha=True)
+        pixmap.save(os.path.join(path, out))
+    trim(os.path.join(path, out))
+
+
+def _has_module(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+# Dictionary of rasterisation backends, with the output format they render and an availability check
+backends = {}
+
+backends["convert"] = {"func": raster_convert, "dvi": False, "available": lambda: bool(shutil.which("convert"))}
+backends["dvipng"] = {"func": raster_dvipng, "dvi": True, "available": lambda: bool(shutil.which("dvipng"))}
+backends["pdftocairo"] = {"func": raster_pdftocairo, "dvi": False, "available": lambda: bool(shutil.which("pdftocairo"))}
+backends["mupdf"] = {"func": raster_mupdf, "dvi": False, "available": lambda: _has_module("fitz")}
+
+default_backend = "convert"
+
+
+def get_backend(name):
+    """
+    Return the name of the backend to use, falling back to the default if it is unknown.
+    """
+    return name if name in backends else default_backend
+
+
+def output_ext(backend):
+    """
+    The extension of the compiler output the backend rasterises.
+    """
+    return "dvi" if backends[get_backend(backend)]["dvi"] else "pdf"
+
+
+def page_png(name, page=None):
+    """
+    The filename of the rasterised output, or of a single page of multi-page output.
+    """
+    return "{}.png".format(name) if page is None else "{}-{}.png".format(name, page)
+
+
+def rasterise(path, name, backend=default_backend, max_area=0, pages=None):
+    """
+    Render the first page of the compiled output `<path>/<name>.pdf` or `<path>/<name>.dvi` to `<path>/<name>.png`,
+    or if the number of pages is given, render each page to `<path>/<name>-<page>.png`.
+    PDF output is fitted within max_area pixels if given, choosing the density of multi-page output from the first page
+    and reducing it for any page which doesn't fit.
+    """
+    backend = get_backend(backend)
+    if backends[backend]["dvi"]:
+        dpi = density
+    else:
+        dpi = choose_density(os.path.join(path, "{}.pdf".format(name)), max_area)
+
+    if pages is None:
+        backends[backend]["func"](path, name, page_png(name), density=dpi)
+    else:
+        for page in range(1, pages + 1):
+            out = page_png(name, page)
+            backends[backend]["func"](path, name, out, density=dpi, page=page)
+
+            # The density is chosen from a single page, so render any larger page again at a density which fits
+            area = png_area(os.path.join(path, out)) if max_area and not backends[backend]["dvi"] else 0
+            if area > max_area:
+                page_dpi = max(int(dpi * (max_area / area) ** 0.5), min_density)
+                if page_dpi < dpi:
+                    backends[backend]["func"](path, name, out, density=page_dpi, page=page)
@@ -0,0 +1,280 @@
+import time
+import asyncio
+from collections import deque
+
+from paraCH import paraCH
+
+cmds = paraCH()
+
+"""
+Global scheduler for LaTeX renders.
+
+Every render waits for a slot from the scheduler before compiling.
+At most a fixed number of renders run at once, and waiting renders are queued per server and per user,
+with slots handed out round robin between servers, and between the users of each server,
+so that one busy user or server cannot starve the others.
+Each user has at most one render running at a time, and their renders run in the order they were requested.
+
+Renders are shed instead of waiting, in two cases:
+    superseded:
+        A newer render was queued for the same message (e.g. the source was edited).
+    overload:
+        The queue is full, so the oldest waiting render is dropped.
+
+Commands provided:
+    texqueue:
+        Show the scheduler queue and wait time statistics, and the number of messages tracked for edits.
+
+Configuration (bot configuration file):
+    latex_max_concurrent: int
+        Maximum number of renders running at once.
+    latex_max_queued: int
+        Maximum number of renders waiting for a slot, before the oldest are shed.
+
+Bot Objects:
+    latex_scheduler: RenderScheduler
+"""
+
+
+class RenderJob:
+    """
+    A single render, waiting for or holding a scheduler slot.
+    """
+    __slots__ = ("userid", "serverid", "key", "queued_at", "future", "shed")
+
+    def __init__(self, userid, serverid, key):
+        self.userid = userid
+        self.serverid = serverid
+        self.key = key
+        self.queued_at = time.time()
+        self.future = asyncio.get_event_loop().create_future()
+
+        # Reason the job was shed, if it was
+        self.shed = None
+
+
+class RenderSlot:
+    """
+    Asynchronous context manager waiting for, and then holding, a scheduler slot.
+    Returns the RenderJob, whose `shed` attribute is set if the render should not go ahead.
+    """
+    def __init__(self, scheduler, userid, serverid, key):
+        self.scheduler = scheduler
+        self.job = RenderJob(userid, serverid, key)
+
+    async def __aenter__(self):
+        self.scheduler._submit(self.job)
+        try:
+            await self.job.future
+        except asyncio.CancelledError:
+            self.scheduler._release(self.job)
+            raise
+        return self.job
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler._release(self.job)
+
+
+class RenderScheduler:
+    def __init__(self, max_running=4, max_queued=50):
+        self.max_running = max_running
+        self.max_queued = max_queued
+
+        # Waiting jobs, as queues indexed by user id, indexed by server id
+        self.queues = {}
+        self.queued = 0
+
+        # When each queued server, and each (server, user) pair, was last served, for the round robin
+        self.served = {}
+        self.tick = 0
+
+        # Jobs holding a slot, and the users they belong to
+        self.running = set()
+        self.running_users = set()
+
+        # Latest job for each key, used to shed superseded jobs
+        self.keys = {}
+
+        # Statistics
+        self.jobs = 0
+        self.shed_overload = 0
+        self.shed_superseded = 0
+        self.max_depth = 0
+        self.waits = deque(maxlen=1000)
+
+    def slot(self, userid, serverid=None, key=None):
+        """
+        Wait for a render slot for the given user and server.
+        If a key is given (e.g. the source message id), any render still waiting with the same key is superseded.
+        """
+        return RenderSlot(self, userid, serverid, key)
+
+    def _submit(self, job):
+        if job.key is not None:
+            old = self.keys.get(job.key, None)
+            if old is not None and self._waiting(old):
+                self._shed(old, "superseded")
+            self.keys[job.key] = job
+
+        self.queues.setdefault(job.serverid, {}).setdefault(job.userid, deque()).append(job)
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self.queued)
+
+        if self.queued > self.max_queued:
+            oldest = min((queue[0] for users in self.queues.values() for queue in users.values() if queue),
+                         key=lambda queued: queued.queued_at)
+            self._shed(oldest, "overload")
+        self._dispatch()
+
+    def _waiting(self, job):
+        return job in self.queues.get(job.serverid, {}).get(job.userid, ())
+
+    def _remove(self, job):
+        self.queues[job.serverid][job.userid].remove(job)
+        self.queued -= 1
+        self._tidy(job.serverid, job.userid)
+
+    def _tidy(self, serverid, userid):
+        """
+        Drop the queue of an idle user with no waiting jobs, and of a server with no users.
+        Running users keep their place in the round, so they go to the back when they queue again.
+        """
+        users = self.queues.get(serverid, None)
+        if users is None:
+            return
+        if userid in users and not users[userid] and userid not in self.running_users:
+            del users[userid]
+            self.served.pop((serverid, userid), None)
+        if not users:
+            del self.queues[serverid]
+            self.served.pop(serverid, None)
+
+    def _shed(self, job, reason):
+        self._remove(job)
+        job.shed = reason
+        if reason == "superseded":
+            self.shed_superseded += 1
+        else:
+            self.shed_overload += 1
+        job.future.set_result(False)
+
+    def _next(self):
+        """
+        Pop the next waiting job, round robin over servers and then users, skipping users with a running job.
+        The least recently served server is picked first, then its least recently served user.
+        """
+        ready = [
+            (serverid, userid)
+            for serverid, users in self.queues.items()
+            for userid, queue in users.items()
+            if queue and userid not in self.running_users
+        ]
+        if not ready:
+            return None
+        serverid, userid = min(ready, key=lambda pair: (self.served.get(pair[0], 0), self.served.get(pair, 0)))
+
+        job = self.queues[serverid][userid].popleft()
+        self.queued -= 1
+
+        # Move the served user and server to the back of the round
+        self.tick += 1
+        self.served[serverid] = self.served[(serverid, userid)] = self.tick
+        return job
+
+    def _dispatch(self):
+        while len(self.running) < self.max_running:
+            job = self._next()
+            if job is None:
+                break
+            self.running.add(job)
+            self.running_users.add(job.userid)
+            self.jobs += 1
+            self.waits.append(time.time() - job.queued_at)
+            job.future.set_result(True)
+
+    def _release(self, job):
+        if job in self.running:
+            self.running.discard(job)
+            self.running_users.discard(job.userid)
+            self._tidy(job.serverid, job.userid)
+        elif self._waiting(job):
+            # Cancelled while waiting
+            self._remove(job)
+        if self.keys.get(job.key, None) is job:
+            del self.keys[job.key]
+        self._dispatch()
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            "running": len(self.running),
+            "queued": self.queued,
+            "users": sum(bool(queue) for users in self.queues.values() for queue in users.values()),
+            "servers": sum(any(users.values()) for users in self.queues.values()),
+            "max_depth": self.max_depth,
+            "jobs": self.jobs,
+            "shed_overload": self.shed_overload,
+            "shed_superseded": self.shed_superseded,
+            "mean_wait": sum(waits) / len(waits) if waits else 0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0,
+            "max_wait": waits[-1] if waits else 0
+        }
+
+
+@cmds.cmd("texqueue",
+          category="Bot admin",
+          short_help="Inspect the LaTeX render queue")
+@cmds.require("manager_perm")
+async def cmd_texqueue(ctx):
+    """
+    Usage:
+        {prefix}texqueue
+    Description:
+        Shows the LaTeX render scheduler queue and wait time statistics.
+        Wait times are over the last 1000 renders.
+        Also shows the rendered messages being tracked for edits, the output encoding and upload statistics,
+        the compiles killed for exceeding their resource limits,
+        and the render service requests if renders are sent to a render service.
+    """
+    stats = ctx.bot.objects["latex_scheduler"].stats()
+    tracked = ctx.bot.objects["latex_messages"].stats()
+    output = ctx.bot.objects["latex_output_stats"].stats()
+    limits = ctx.bot.objects["latex_limits"].stats()
+    props = ["Running", "Queued", "Max queued", "Renders", "Shed", "Wait", "Tracked", "Encoding", "Uploads", "Killed"]
+    values = [
+        "{}/{}".format(stats["running"], ctx.bot.objects["latex_scheduler"].max_running),
+        "{} renders from {} users in {} servers".format(stats["queued"], stats["users"], stats["servers"]),
+        stats["max_depth"],
+        stats["jobs"],
+        "{} superseded, {} overloaded".format(stats["shed_superseded"], stats["shed_overload"]),
+        "{:.2f}s mean, {:.2f}s p95, {:.2f}s max".format(stats["mean_wait"], stats["p95_wait"], stats["max_wait"]),
+        "{}/{} messages, {:.1f}KB ({} expired, {} evicted)".format(
+            tracked["entries"], tracked["max_entries"], tracked["memory"] / 1024, tracked["expired"], tracked["evicted"]
+        ),
+        "{} images, {:.0f}ms mean, {:.1f}KB mean".format(
+            output["encodes"], output["mean_encode"] * 1000, output["mean_encode_bytes"] / 1024
+        ),
+        "{} images, {:.2f}s mean, {:.1f}KB mean".format(
+            output["uploads"], output["mean_upload"], output["mean_upload_bytes"] / 1024
+        ),
+        "{} wall, {} CPU, {} memory, {} output, {} users on reduced budgets".format(
+            limits["kills"]["wall"], limits["kills"]["cpu"], limits["kills"]["mem"], limits["kills"]["output"],
+            limits["offenders"]
+        )
+    ]
+    service = ctx.bot.objects.get("latex_service", None)
+    if service is not None:
+        service_stats = service.stats()
+        props.append("Service")
+        values.append("{} requests, {:.2f}s mean, {} retried, {} failed".format(
+            service_stats["requests"], service_stats["mean_request"], service_stats["retried"], service_stats["failures"]
+        ))
+    await ctx.reply("**LaTeX render queue:**\n{}".format(ctx.prop_tabulate(props, values)))
+
+
+def load_into(bot):
+    conf = bot.bot_conf
+    bot.objects["latex_scheduler"] = RenderScheduler(
+        max_running=conf.get("latex_max_concurrent", 4),
+        max_queued=conf.get("latex_max_queued", 50)
+    )
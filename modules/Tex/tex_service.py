@@ -0,0 +1,376 @@
+import os
+import sys
+import json
+import time
+import signal
+import struct
+import asyncio
+import logging
+
+"""
+Standalone LaTeX render service, shared by every bot process on the host.
+
+The service runs the render pipeline of tex_compile (makeTeX, makeTeX_batch and the post-processing)
+with a single worker pool, format cache, render cache and set of in flight renders,
+and answers render requests over a Unix socket.
+Bot processes configured with `latex_service_socket` send their renders to the service through a RenderClient,
+retrying failed requests, and fall back to rendering locally if the service can't be reached.
+
+Usage:
+    python3 modules/Tex/tex_service.py [configuration file]
+    Run from the bot directory, with the bot configuration file (default paradox.conf),
+    from which the service reads its socket path and the usual LaTeX options.
+
+Protocol:
+    One request and one response per connection.
+    Each message is a 4 byte big endian length, a JSON header of that length, and `size` bytes of payload.
+    Requests:
+        {"op": "render", "source", "userid", "preamble", "colour", "header", "pad"}
+        {"op": "batch", "sources", "userid", "preamble", "colour", "pad"}
+        {"op": "stats"}
+    Responses:
+        {"results": [[compile error, png length], ...], "size"}, followed by the concatenated png data of the results.
+        {"stats": {...}, "size": 0}
+        {"failed": reason, "size": 0}, if the request couldn't be handled.
+
+Configuration (bot configuration file):
+    latex_service_socket: string
+        Path of the service socket. Renders are done in-process if not set.
+    latex_service_timeout: float
+        Seconds to wait for the response to a single request. Defaults to 90.
+    latex_service_retries: int
+        Number of times to retry a failed request. Defaults to 2.
+    latex_service_fallback: bool
+        Whether to render in-process when the service can't be reached. Defaults to True.
+
+Bot Objects:
+    latex_service: RenderClient, or None if the service isn't configured
+"""
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+# Largest JSON header accepted, in bytes
+max_header = 1024 * 1024
+
+# Seconds before the first retry of a failed request, doubling with each retry
+retry_delay = 0.5
+
+
+async def read_message(reader):
+    """
+    Read a message from the stream, returning the header and the payload.
+    """
+    length, = struct.unpack(">I", await reader.readexactly(4))
+    if length > max_header:
+        raise ValueError("Message header too large.")
+    header = json.loads((await reader.readexactly(length)).decode())
+    payload = await reader.readexactly(header.get("size", 0))
+    return (header, payload)
+
+
+def write_message(writer, header, payload=b""):
+    """
+    Write a message with the given header and payload to the stream.
+    """
+    data = json.dumps(dict(header, size=len(payload))).encode()
+    writer.write(struct.pack(">I", len(data)) + data + payload)
+
+
+def pack_results(results):
+    """
+    Pack a list of makeTeX results into a response header and payload.
+    """
+    return ({"results": [[error, len(image)] for error, image in results]}, b"".join(image for _, image in results))
+
+
+def unpack_results(header, payload):
+    """
+    Unpack the makeTeX results of a response.
+    """
+    results = []
+    offset = 0
+    for error, length in header["results"]:
+        results.append((error, payload[offset:offset + length]))
+        offset += length
+    return results
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class ServiceFailed(ServiceUnavailable):
+    """
+    The service handled the request, but the render raised an exception, so retrying it would fail again.
+    """
+    pass
+
+
+class RenderClient:
+    """
+    Sends renders to the render service, with a timeout on each request and retries with exponential backoff.
+    A retried render joins the render of the failed request if it is still running in the service.
+    """
+    def __init__(self, path, timeout=90, retries=2, fallback=True):
+        self.path = path
+        self.timeout = timeout
+        self.retries = retries
+        self.fallback = fallback
+
+        # Statistics
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+        self.request_time = 0
+
+    async def _request(self, header):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        try:
+            write_message(writer, header)
+            await writer.drain()
+            try:
+                response, payload = await read_message(reader)
+            except ValueError as e:
+                raise ServiceFailed("Invalid response: {!r}".format(e))
+        finally:
+            writer.close()
+        if "failed" in response:
+            raise ServiceFailed(response["failed"])
+        return (response, payload)
+
+    async def request(self, header):
+        """
+        Send a request to the service, returning the response header and payload.
+        Only transport errors are retried, as a render which failed in the service would fail again.
+        Raises ServiceFailed if the service failed to handle the request,
+        or ServiceUnavailable if every attempt failed to reach it.
+        """
+        start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                await asyncio.sleep(retry_delay * 2 ** (attempt - 1))
+            try:
+                response = await asyncio.wait_for(self._request(header), self.timeout)
+            except ServiceFailed:
+                self.failures += 1
+                raise
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                error = e
+                continue
+            self.requests += 1
+            self.request_time += time.perf_counter() - start
+            return response
+
+        self.failures += 1
+        raise ServiceUnavailable("{}: {!r}".format(self.path, error))
+
+    async def makeTeX(self, source, userid, preamble, colour, header, pad):
+        """
+        Render a single snippet in the service, as tex_compile.makeTeX.
+        Returns the compile error and the png data of the output, or None if the service couldn't be reached.
+        """
+        try:
+            response, payload = await self.request({
+                "op": "render", "source": source, "userid": userid, "preamble": preamble,
+                "colour": colour, "header": header, "pad": pad
+            })
+        except ServiceUnavailable as e:
+            logging.warning("LaTeX render service request failed. {}".format(e))
+            return None
+        return unpack_results(response, payload)[0]
+
+    async def makeTeX_batch(self, sources, userid, preamble, colour, pad):
+        """
+        Render a batch of snippets in the service, as tex_compile.makeTeX_batch.
+        Returns the list of results, or None if the service couldn't be reached.
+        """
+        try:
+            response, payload = await self.request({
+                "op": "batch", "sources": sources, "userid": userid, "preamble": preamble,
+                "colour": colour, "pad": pad
+            })
+        except ServiceUnavailable as e:
+            logging.warning("LaTeX render service request failed. {}".format(e))
+            return None
+        return unpack_results(response, payload)
+
+    async def service_stats(self):
+        """
+        Retrieve the statistics of the service, or None if it couldn't be reached.
+        """
+        try:
+            response, _ = await self.request({"op": "stats"})
+        except ServiceUnavailable:
+            return None
+        return response["stats"]
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "retried": self.retried,
+            "failures": self.failures,
+            "mean_request": self.request_time / self.requests if self.requests else 0
+        }
+
+
+def load_into(bot):
+    conf = bot.bot_conf
+    path = conf.get("latex_service_socket", None)
+    bot.objects["latex_service"] = RenderClient(
+        path,
+        timeout=conf.get("latex_service_timeout", 90),
+        retries=conf.get("latex_service_retries", 2),
+        fallback=conf.get("latex_service_fallback", True)
+    ) if path else None
+
+
+# ------------------------------
+# The service process
+
+
+class ServiceContext:
+    """
+    Context of a render in the service, providing the bot objects and ctx utilities used by tex_compile.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+
+
+class ServiceBot:
+    """
+    Stand-in for the bot in the service process, holding the render objects loaded by the LaTeX modules.
+    """
+    def __init__(self, conf, loop):
+        self.bot_conf = conf
+        self.loop = loop
+        self.objects = {}
+        self.ready_events = []
+
+    def add_to_ctx(self, func):
+        setattr(ServiceContext, func.__name__, func)
+
+    def add_after_event(self, event, func, priority=0):
+        if event == "ready":
+            self.ready_events.append(func)
+
+
+class RenderService:
+    """
+    Serves render requests on a Unix socket with the LaTeX modules loaded into a ServiceBot.
+    """
+    def __init__(self, bot, path):
+        self.bot = bot
+        self.path = path
+        self.server = None
+
+        # Statistics
+        self.requests = 0
+        self.failures = 0
+        self.started = time.time()
+
+    async def start(self):
+        for func in self.bot.ready_events:
+            await func(self.bot)
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        os.chmod(self.path, 0o660)
+        logging.info("LaTeX render service listening on {}.".format(self.path))
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        pool = self.bot.objects.get("latex_worker_pool", None)
+        if pool is not None:
+            await pool.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                request, _ = await read_message(reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                return
+            self.requests += 1
+            try:
+                header, payload = await self.respond(request)
+            except Exception as e:
+                self.failures += 1
+                logging.exception("LaTeX render service failed to handle a request.")
+                header, payload = ({"failed": repr(e)}, b"")
+            write_message(writer, header, payload)
+            await writer.drain()
+        except OSError:
+            # The client went away, and a retry may join the render
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, request):
+        ctx = ServiceContext(self.bot)
+        op = request["op"]
+        if op == "render":
+            kwargs = {}
+            if request.get("header", None) is not None:
+                kwargs["header"] = request["header"]
+            result = await ctx.makeTeX(request["source"], request["userid"], preamble=request["preamble"],
+                                       colour=request["colour"], pad=request["pad"], **kwargs)
+            return pack_results([result])
+        elif op == "batch":
+            results = await ctx.makeTeX_batch(request["sources"], request["userid"], preamble=request["preamble"],
+                                              colour=request["colour"], pad=request["pad"])
+            return pack_results(results)
+        elif op == "stats":
+            return ({"stats": self.stats()}, b"")
+        raise ValueError("Unknown request {}".format(op))
+
+    def stats(self):
+        stats = {
+            "service": {"requests": self.requests, "failures": self.failures, "uptime": time.time() - self.started}
+        }
+        for name in ["latex_render_cache", "latex_worker_pool", "latex_format_cache", "latex_limits",
+                     "latex_render_flights", "latex_output_stats"]:
+            obj = self.bot.objects.get(name, None)
+            if obj is not None:
+                stats[name] = obj.stats()
+        return stats
+
+
+def main():
+    sys.path.insert(0, os.path.join(__location__, "..", ".."))
+    logging.basicConfig(level=logging.INFO, format='[{asctime}][{levelname:^7}] {message}', style='{')
+
+    from botconf import Conf
+    import tex_cache
+    import tex_pool
+    import tex_limits
+    import tex_formats
+    import tex_compile
+
+    conf = Conf(sys.argv[1] if len(sys.argv) > 1 else "paradox.conf")
+    path = conf.get("latex_service_socket", None)
+    if not path:
+        sys.exit("No latex_service_socket set in the configuration.")
+
+    loop = asyncio.get_event_loop()
+    bot = ServiceBot(conf, loop)
+    for module in (tex_cache, tex_pool, tex_limits, tex_formats, tex_compile):
+        module.load_into(bot)
+
+    service = RenderService(bot, path)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    loop.run_until_complete(service.start())
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(service.stop())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,74 @@
-cd tex/staging/$1/
+# Usage: texcompile.sh <job directory> <name> <format or empty> <pdf|dvi> [<wall> <cpu> <mem> <output>]
+# The limits are the wall clock and CPU time in seconds, and the address space and output file size in MB, see tex_limits.py
+# Output: "FormatFailed" first if the format failed to load, then "Killed: <limit>" or the compile errors
+cd "$1"
+NAME=$2
+
+WALL=${5:-60}
+CPU=${6:-60}
+MEM=${7:-1024}
+OUTPUT=${8:-32}
 
 chmod --quiet -R o+rwx .
 
-rm -f $1.png $1.pdf
+rm -f $NAME.png $NAME.pdf $NAME.dvi $NAME.log
+
+# Compile to DVI instead of PDF if $4 is "dvi", for the DVI rasterisers
+OUT=pdf
+OPTS=""
+if [ "$4" = "dvi" ];
+then
+    OUT=dvi
+    OPTS="-output-format=dvi"
+fi
 
-sudo -u latex timeout 1m pdflatex -no-shell-escape $1.tex > texout.log 2>&1
+# Run pdflatex in the sandbox, within the limits
+# The CPU time hard limit is a second above the soft limit, so the compiler is killed if it ignores SIGXCPU
+compile() {
+    sudo -u latex timeout ${WALL}s prlimit --cpu=$CPU:$((CPU + 1)) --as=$((MEM * 1048576)) --fsize=$((OUTPUT * 1048576)) \
+        pdflatex -no-shell-escape "$@" > texout.log 2>&1
+    RET=$?
+}
 
-RET=$?
+# Compile against the precompiled preamble format in $3, if given
+if [ -n "$3" ];
+then
+    compile -interaction=nonstopmode $OPTS -fmt=$3 $NAME.tex
+
+    # If the format couldn't be loaded the log is never opened, so fall back to a plain compile
+    # and tell the caller, so it stops using the format
+    if [ ! -f $NAME.log ] && [ $RET -ne 124 ];
+    then
+        echo "FormatFailed"
+        compile $OPTS $NAME.tex
+    fi
+else
+    compile $OPTS $NAME.tex
+fi
+
+# Report which limit killed the compile, as the caller knows the limits to put in the message
+# Exit codes above 128 are deaths by signal 128 + n: SIGKILL 9, SIGSEGV 11, SIGXCPU 24, SIGXFSZ 25
 if [ $RET -eq 0 ];
 then
  echo "";
 elif [ $RET -eq 124 ];
 then
- echo "Compilation timed out!";
+ echo "Killed: wall";
+elif [ $RET -eq 152 ] || [ $RET -eq 137 ];
+then
+ echo "Killed: cpu";
+elif [ $RET -eq 153 ];
+then
+ echo "Killed: output";
+elif [ $RET -eq 139 ] || grep -q "memory exhausted" texout.log;
+then
+ echo "Killed: mem";
 else
-    grep -A 10 -m 1 "^!" $1.log;
+    grep -A 10 -m 1 "^!" $NAME.log;
 fi
 
-if [ ! -f $1.pdf ];
+# Rasterisation is done by the caller, through tex_raster.py
+if [ ! -f $NAME.$OUT ];
 then
-  cp ../../failed.png $1.png
   exit 1
 fi
-
-convert -density 700 -quality 75 -depth 8 -trim +repage $1.pdf $1.png;
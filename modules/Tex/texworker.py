@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import signal
+import shutil
+import resource
+import subprocess
+
+import tex_raster
+
+"""
+Long lived LaTeX compilation worker, run by the TexWorkerPool in tex_pool.py.
+
+The worker is started once inside the LaTeX sandbox (by default through `sudo -u latex`),
+and then reads newline separated JSON jobs from stdin, writing one JSON result line per job to stdout.
+It keeps a pdflatex process primed in its scratch directory, with the LaTeX format already loaded,
+so that a job only pays for reading its preamble and source.
+
+Usage:
+    python3 texworker.py <scratch directory>
+
+Job format:
+    {"path": absolute path to the job directory, "name": name of the source file without extension,
+     "fmt": absolute path to a precompiled format for the document preamble, or null,
+     "raster": name of the tex_raster backend used to rasterise the output,
+     "max_area": target maximum pixel area of the rasterised output, or 0 for no limit,
+     "pages": number of pages to rasterise to `<name>-<page>.png`, or null to rasterise the first page to `<name>.png`,
+     "limits": resource limits of the compile, as in tex_limits, or null for the default limits}
+
+Result format:
+    {"error": compile error text, "pdf": whether compiled output was produced, "fmt_failed": whether the format failed to load,
+     "killed": the limit the compile was killed for exceeding, one of "wall", "cpu", "mem" or "output", or null}
+
+The worker exits when stdin is closed, or on SIGTERM, which abandons the current job.
+"""
+
+# Limits of a compile if the job doesn't give any
+default_limits = {"wall": 60, "cpu": 60, "mem": 1024, "output": 32}
+
+
+def set_limits(limits):
+    """
+    Apply the CPU time, address space and output file size limits to the current process.
+    The CPU time hard limit is a second above the soft limit, so the compiler is killed if it ignores SIGXCPU.
+    """
+    resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu"], limits["cpu"] + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (limits["mem"] * 1024 * 1024,) * 2)
+    resource.setrlimit(resource.RLIMIT_FSIZE, (limits["output"] * 1024 * 1024,) * 2)
+
+
+class PrimedTeX:
+    """
+    A pdflatex process waiting at the terminal prompt with the format loaded.
+    The job source is copied to `job.tex` in the scratch directory and input from the terminal.
+    The process is primed with the format, output format and limits of the last job, which are usually the default.
+    """
+    def __init__(self, scratch):
+        self.scratch = scratch
+        self.proc = None
+        self.fmt = None
+        self.dvi = False
+        self.limits = default_limits
+
+    def start(self, fmt=None, dvi=False, limits=default_limits):
+        for fn in os.listdir(self.scratch):
+            os.remove(os.path.join(self.scratch, fn))
+
+        # The initial `\relax` line forces the format to load before we have a job to give it
+        # Formats store the interaction mode, so ensure we start at the terminal
+        args = ["pdflatex", "-no-shell-escape", "-interaction=errorstopmode", "-jobname=job"]
+        if fmt:
+            args.append("-fmt={}".format(fmt))
+        if dvi:
+            args.append("-output-format=dvi")
+        self.fmt = fmt
+        self.dvi = dvi
+        self.limits = limits
+        with open(os.path.join(self.scratch, "texerr.log"), 'wb') as err:
+            self.proc = subprocess.Popen(
+                args + ["\\relax"],
+                cwd=self.scratch,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=err,
+                preexec_fn=lambda: set_limits(limits)
+            )
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def run(self, source_file, fmt=None, dvi=False, limits=default_limits):
+        """
+        Compile the given source file within the limits.
+        Returns the pdflatex exit code, and the limit the compile was killed for exceeding, if any.
+        """
+        if (self.proc is None or self.proc.poll() is not None
+                or fmt != self.fmt or dvi != self.dvi or limits != self.limits):
+            self.stop()
+            self.start(fmt, dvi, limits)
+
+        shutil.copyfile(source_file, os.path.join(self.scratch, "job.tex"))
+        try:
+            # Precompiled formats skip the document preamble, including the interaction mode
+            self.proc.stdin.write(b"\\nonstopmode\\input{job.tex}\n")
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        try:
+            ret = self.proc.wait(timeout=limits["wall"])
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+            return (None, "wall")
+        return (ret, self.killed(ret))
+
+    def killed(self, ret):
+        """
+        Determine which rlimit, if any, stopped the compiler with the given exit code.
+        """
+        if ret in (-signal.SIGXCPU, -signal.SIGKILL):
+            return "cpu"
+        if ret == -signal.SIGXFSZ:
+            return "output"
+        if ret == -signal.SIGSEGV:
+            return "mem"
+        if ret:
+            # Allocation failures, and writes past the limit if SIGXFSZ is ignored, are reported on stderr
+            with open(os.path.join(self.scratch, "texerr.log"), 'r', errors='replace') as err:
+                errors = err.read()
+            if "memory exhausted" in errors:
+                return "mem"
+            if "File too large" in errors:
+                return "output"
+        return None
+
+    def collect(self, path, name):
+        """
+        Move the output of the last run into the job directory.
+        """
+        for ext in ["pdf", "dvi", "log"]:
+            out = os.path.join(self.scratch, "job.{}".format(ext))
+            if os.path.isfile(out):
+                shutil.move(out, os.path.join(path, "{}.{}".format(name, ext)))
+
+
+def log_error(log_file):
+    """
+    Extract the first error from a LaTeX log, with up to ten lines of context.
+    """
+    if not os.path.isfile(log_file):
+        return ""
+    with open(log_file, 'r', errors='replace') as log:
+        lines = log.read().splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("!"):
+            return "\n".join(lines[i:i + 11])
+    return ""
+
+
+def run_job(tex, job):
+    path = job["path"]
+    name = job["name"]
+
+    fmt = job.get("fmt", None)
+    raster = tex_raster.get_backend(job.get("raster", None))
+    dvi = tex_raster.output_ext(raster) == "dvi"
+
+    out = os.path.join(path, "{}.{}".format(name, tex_raster.output_ext(raster)))
+    log = os.path.join(path, "{}.log".format(name))
+    for ext in ["pdf", "dvi", "png", "log"]:
+        fn = os.path.join(path, "{}.{}".format(name, ext))
+        if os.path.isfile(fn):
+            os.remove(fn)
+
+    limits = job.get("limits", None) or default_limits
+    ret, killed = tex.run(os.path.join(path, "{}.tex".format(name)), fmt=fmt, dvi=dvi, limits=limits)
+    tex.collect(path, name)
+
+    # If the format couldn't be loaded, the log is never opened, so retry with a plain compile
+    fmt_failed = bool(fmt) and ret is not None and not killed and not os.path.isfile(log)
+    if fmt_failed:
+        fmt = None
+        ret, killed = tex.run(os.path.join(path, "{}.tex".format(name)), dvi=dvi, limits=limits)
+        tex.collect(path, name)
+
+    # Start loading the next format while we handle this output
+    tex.stop()
+    tex.start(fmt, dvi, limits)
+
+    if killed:
+        # The error message is filled in by the caller, which knows the limits
+        error = ""
+    elif ret != 0:
+        error = log_error(log)
+    else:
+        error = ""
+
+    if not os.path.isfile(out) or killed:
+        return {"error": error, "pdf": False, "fmt_failed": fmt_failed, "killed": killed}
+
+    tex_raster.rasterise(path, name, raster, max_area=job.get("max_area", 0), pages=job.get("pages", None))
+    return {"error": error, "pdf": True, "fmt_failed": fmt_failed, "killed": None}
+
+
+def main():
+    scratch = sys.argv[1]
+    os.makedirs(scratch, exist_ok=True)
+
+    # Exit through the finally clause below, so the compiler is stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    tex = PrimedTeX(scratch)
+    tex.start()
+    try:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            try:
+                result = run_job(tex, json.loads(line))
+            except Exception as e:
+                result = {"error": "Internal worker error: {}".format(e), "pdf": False, "failed": True}
+            sys.stdout.write(json.dumps(result) + "\n")
+            sys.stdout.flush()
+    finally:
+        tex.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import time
 import asyncio
 from string import punctuation as punc
 
@@ -307,14 +308,6 @@ async def update_checks(ctx, checks):
     listeners[ctx.authid] = listener
 
 
-async def set_timer(time, flag):
-    """
-    Small timer, waits for the amount of time then sets flag['expired'] to True
-    """
-    await asyncio.sleep(time)
-    flag['expired'] = True
-
-
 async def notify_user(user, ctx, check):
     # Check the user's blacklist
     blocklist = (await ctx.data.users_long.get(user.id, "pounce_blocks")) or []
@@ -333,11 +326,11 @@ async def notify_user(user, ctx, check):
         timeout = 60
         msgcount = 5
 
-        timer = {'expired': False}
-        asyncio.ensure_future(set_timer(timeout, timer))
+        # Wait for new messages in the channel until the total timeout expires
+        expires = time.time() + timeout
 
-        while msgcount > 0 and not timer['expired']:
-            new_msg = await ctx.bot.wait_for_message(timeout=15, channel=ctx.ch)
+        while msgcount > 0 and time.time() < expires:
+            new_msg = await ctx.wait_for_message(channel=ctx.ch, timeout=expires - time.time())
             if new_msg:
                 if new_msg.author.id == user.id:
                     return
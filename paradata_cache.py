@@ -0,0 +1,71 @@
+import json
+
+from cachetools import TTLCache
+
+"""
+Read-through cache of property values for the BotData property tables.
+
+Entries are keyed by the table keys and the mapped property name, as passed to the database,
+so app-specific properties are cached separately for each app.
+Properties with no stored value are cached too, so repeated reads of unset properties don't reach the database.
+Entries expire after a fixed time, which bounds how stale a value written by another process may be.
+
+Scalar values are stored decoded, while lists and dictionaries are stored as their JSON text,
+and decoded on every read, so callers may modify the returned value without modifying the cache.
+"""
+
+# Marker for properties with no stored value
+_absent = object()
+
+
+class PropCache:
+    def __init__(self, capacity=10000, ttl=60):
+        self.entries = TTLCache(capacity, ttl)
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, default=None):
+        """
+        Look up a property value.
+        Returns whether the lookup was a hit, and the cached value, or the default if the property is unset.
+        """
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return (False, default)
+
+        self.hits += 1
+        if entry is _absent:
+            return (True, default)
+        value, raw = entry
+        return (True, json.loads(raw) if raw is not None else value)
+
+    def fill(self, key, raw):
+        """
+        Store the raw JSON text of a property, as read from or written to the database.
+        Returns the decoded value, or None if the property is unset.
+        """
+        if not raw:
+            self.entries[key] = _absent
+            return None
+        value = json.loads(raw)
+        self.entries[key] = (None, raw) if isinstance(value, (list, dict)) else (value, None)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Remove a property from the cache, or empty the cache if no key is given.
+        """
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,117 @@
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Dedicated thread for the blocking database calls of BotData, keeping them off the event loop.
+
+Operations run one at a time on a single thread, which owns the database connection,
+in the order they were submitted, so a read always sees the writes submitted before it.
+
+Usage:
+    executor = DBExecutor()
+    result = await executor.run(func, *args)
+        Run func(*args) on the database thread and return its result.
+    result = executor.run_sync(func, *args)
+        As above, blocking the calling thread, for setup before the event loop is running.
+    async for row in PagedQuery(executor, fetch_page):
+        Iterate over the rows of a query fetched a page at a time on the database thread.
+"""
+
+
+class DBExecutor:
+    def __init__(self, history=1000):
+        self.pool = ThreadPoolExecutor(max_workers=1)
+
+        # Queue wait and query time of the last operations, in seconds
+        self.waits = deque(maxlen=history)
+        self.durations = deque(maxlen=history)
+
+        # Statistics
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def _call(self, queued_at, func, args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.waits.append(start - queued_at)
+            self.durations.append(time.perf_counter() - start)
+            self.completed += 1
+
+    def _submit(self, func, args):
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.submitted - self.completed)
+        return self.pool.submit(self._call, time.perf_counter(), func, args)
+
+    async def run(self, func, *args):
+        """
+        Run func(*args) on the database thread, after every operation submitted before it, and return the result.
+        """
+        return await asyncio.wrap_future(self._submit(func, args))
+
+    def run_sync(self, func, *args):
+        """
+        Run func(*args) on the database thread, blocking until it has completed.
+        """
+        return self._submit(func, args).result()
+
+    def close(self):
+        """
+        Wait for the queued operations to complete, and stop the thread.
+        """
+        self.pool.shutdown(wait=True)
+
+    def stats(self):
+        durations = sorted(self.durations)
+        return {
+            "queued": self.submitted - self.completed,
+            "max_depth": self.max_depth,
+            "queries": self.completed,
+            "errors": self.errors,
+            "mean_wait": sum(self.waits) / len(self.waits) if self.waits else 0,
+            "mean_query": sum(durations) / len(durations) if durations else 0,
+            "p95_query": durations[int(len(durations) * 0.95)] if durations else 0,
+            "max_query": durations[-1] if durations else 0
+        }
+
+
+class PagedQuery:
+    """
+    Async iterator over the rows of a query, fetched in pages on the database thread,
+    so a large result is never held in memory at once, and other operations may run between pages.
+    fetch_page(after, size) returns up to size rows following the row `after`, or the first rows if it is None.
+    If given, the coroutine function `before` is awaited before each page is fetched.
+    """
+    def __init__(self, executor, fetch_page, size=1000, before=None):
+        self.executor = executor
+        self.fetch_page = fetch_page
+        self.size = size
+        self.before = before
+
+        self.page = deque()
+        self.after = None
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.page and not self.done:
+            if self.before is not None:
+                await self.before()
+            rows = await self.executor.run(self.fetch_page, self.after, self.size)
+            self.done = len(rows) < self.size
+            if rows:
+                self.after = rows[-1]
+                self.page.extend(rows)
+        if not self.page:
+            raise StopAsyncIteration
+        return self.page.popleft()
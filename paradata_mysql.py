@@ -1,6 +1,13 @@
 import json
 import mysql.connector
 
+from paradata_executor import DBExecutor, PagedQuery
+from paradata_cache import PropCache
+from paradata_writes import WriteBuffer
+
+# Length of the indexed prefix of the property and value columns, within the InnoDB key size limit for utf8mb4
+index_prefix = 191
+
 prop_table_info = [
     ("users", "users", ["userid"]),
     ("servers", "servers", ["serverid"]),
@@ -12,26 +19,97 @@ prop_table_info = [
 
 
 class BotData:
-    def __init__(self, app="", **dbopts):
-        self.conn = mysql.connector.connect(**dbopts)
+    """
+    Property tables stored in mysql.
+    All queries run on a dedicated database thread, see paradata_executor.
+    Property reads are cached, see paradata_cache, with at most cache_size properties per table,
+    each kept for cache_ttl seconds. A cache_size of 0 disables the cache.
+    With write_behind, property writes are buffered and written in batches, see paradata_writes,
+    every flush_interval milliseconds or once flush_ops writes are pending.
+    """
+    def __init__(self, app="", cache_size=10000, cache_ttl=60, write_behind=False, flush_interval=500, flush_ops=100,
+                 **dbopts):
+        self.executor = DBExecutor()
+        self.tables = []
+        self.conn = self.executor.run_sync(lambda: mysql.connector.connect(**dbopts))
         self.conn.autocommit = True
+        self.buffer = WriteBuffer(self.executor, self._write_batch, flush_interval, flush_ops) if write_behind else None
         for name, table_name, keys in prop_table_info:
-            manipulator = _propTableManipulator(table_name, keys, self.conn, app)
+            manipulator = _propTableManipulator(table_name, keys, self.conn, app, self.executor,
+                                                PropCache(cache_size, cache_ttl) if cache_size else None,
+                                                self.buffer)
             self.__setattr__(name, manipulator)
+            self.tables.append(manipulator)
+
+    def _execute(self, query, params):
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+
+    async def execute(self, query, params=()):
+        """
+        Execute a raw query on the database thread.
+        """
+        # The query may change any property, so stop in flight reads filling the caches, and empty them
+        for table in self.tables:
+            table.invalidate()
+        if self.buffer is not None:
+            await self.buffer.flush()
+        await self.executor.run(self._execute, query, params)
+
+    def _write_batch(self, batch):
+        """
+        Upsert a batch of raw property values from the write buffer, in a single transaction.
+        """
+        cursor = self.conn.cursor()
+        self.conn.start_transaction()
+        try:
+            for table, entries in batch.items():
+                rows = [(*key, value) for key, value in entries.items()]
+                values = ", ".join("%s" for column in rows[0])
+                cursor.executemany('REPLACE INTO {} VALUES ({})'.format(table, values), rows)
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    async def flush(self):
+        """
+        Write any buffered property writes to the database.
+        """
+        if self.buffer is not None:
+            await self.buffer.flush()
 
     def close(self):
-        self.conn.close()
+        if self.buffer is not None:
+            self.buffer.flush_sync()
+        self.executor.run_sync(self.conn.close)
+        self.executor.close()
+
+    def stats(self):
+        stats = self.executor.stats()
+        caches = [table.cache.stats() for table in self.tables if table.cache is not None]
+        stats["cache_entries"] = sum(cache["entries"] for cache in caches)
+        stats["cache_hits"] = sum(cache["hits"] for cache in caches)
+        stats["cache_misses"] = sum(cache["misses"] for cache in caches)
+        stats["write_buffer"] = self.buffer.stats() if self.buffer is not None else None
+        return stats
 
 
 class _propTableManipulator:
-    def __init__(self, table, keys, conn, app):
+    def __init__(self, table, keys, conn, app, executor, cache=None, buffer=None):
         self.table = table
         self.keys = keys
         self.conn = conn
         self.app = app
+        self.executor = executor
+        self.cache = cache
+        self.buffer = buffer
 
-        # self.ensure_tables()
-        self.propmap = self.get_propmap()
+        # Number of writes started, so reads which overlap a write don't fill the cache with the old value
+        self.writes = 0
+
+        # self.executor.run_sync(self.ensure_tables)
+        self.propmap = self.executor.run_sync(self.get_propmap)
 
     def ensure_tables(self):
         cursor = self.conn.cursor()
@@ -42,6 +120,18 @@ class _propTableManipulator:
         cursor.execute('CREATE TABLE IF NOT EXISTS {}_props (property TEXT NOT NULL,\
                        shared BOOLEAN NOT NULL,\
                        PRIMARY KEY (property))'.format(self.table))
+        self.ensure_index()
+
+    def ensure_index(self):
+        """
+        Create the index on property values used by find and find_not_empty, if it doesn't already exist.
+        """
+        name = "{}_property_value".format(self.table)
+        cursor = self.conn.cursor()
+        cursor.execute('SHOW INDEX FROM {} WHERE Key_name = %s'.format(self.table), (name,))
+        if not cursor.fetchall():
+            cursor.execute('CREATE INDEX {0} ON {1} (property({2}), value({2}), {3})'.format(
+                name, self.table, index_prefix, ", ".join(self.keys)))
 
     def get_propmap(self):
         cursor = self.conn.cursor()
@@ -55,6 +145,9 @@ class _propTableManipulator:
         return "{}_{}".format(self.app, prop) if (prop in self.propmap and not self.propmap[prop] and self.app) else prop
 
     def ensure_exists(self, *props, shared=True):
+        self.executor.run_sync(self._ensure_exists, props, shared)
+
+    def _ensure_exists(self, props, shared):
         for prop in props:
             if prop in self.propmap:
                 if self.propmap[prop] != shared:
@@ -66,34 +159,181 @@ class _propTableManipulator:
                 cursor.execute('INSERT INTO {}_props VALUES (%s,%s)'.format(self.table), (prop, shared))
                 self.propmap = self.get_propmap()
 
+    def invalidate(self, key=None):
+        """
+        Remove a property from the cache, or empty the cache, stopping any reads in flight from filling it.
+        """
+        self.writes += 1
+        if self.cache is not None:
+            self.cache.invalidate(key)
+
     async def get(self, *args, default=None):
         if len(args) != len(self.keys) + 1:
             raise Exception("Improper number of keys passed to get.")
-        prop = self.map_prop(args[-1])
+        key = (*args[:-1], self.map_prop(args[-1]))
+        if self.buffer is not None:
+            pending, raw = self.buffer.lookup(self.table, key)
+            if pending:
+                return json.loads(raw) if raw else default
+        if self.cache is not None:
+            hit, value = self.cache.lookup(key, default)
+            if hit:
+                return value
+
+        writes = self.writes
+        raw = await self.executor.run(self._get, key)
+        if self.cache is not None and writes == self.writes:
+            value = self.cache.fill(key, raw)
+        else:
+            value = json.loads(raw) if raw else None
+        return value if raw else default
+
+    def _get(self, args):
         criteria = " AND ".join("{} = %s" for key in args)
 
         cursor = self.conn.cursor()
-        cursor.execute('SELECT value from {} where {}'.format(self.table, criteria).format(*self.keys, 'property'), tuple([*args[:-1], prop]))
+        cursor.execute('SELECT value from {} where {}'.format(self.table, criteria).format(*self.keys, 'property'), tuple(args))
         value = cursor.fetchone()
-        return json.loads(value[0]) if (value and value[0]) else default
+        return value[0] if value else None
+
+    async def get_many(self, *args, props=(), default=None):
+        """
+        Read several properties of the same keys, fetching those not buffered or cached in a single query.
+        Returns a dictionary of the values by property.
+        """
+        if len(args) != len(self.keys):
+            raise Exception("Improper number of keys passed to get_many.")
+        keys = {prop: (*args, self.map_prop(prop)) for prop in props}
+
+        values = {}
+        missing = []
+        for prop, key in keys.items():
+            if self.buffer is not None:
+                pending, raw = self.buffer.lookup(self.table, key)
+                if pending:
+                    values[prop] = json.loads(raw) if raw else default
+                    continue
+            if self.cache is not None:
+                hit, value = self.cache.lookup(key, default)
+                if hit:
+                    values[prop] = value
+                    continue
+            missing.append(prop)
+        if not missing:
+            return values
+
+        writes = self.writes
+        rows = await self.executor.run(self._get_many, args, [keys[prop][-1] for prop in missing])
+        for prop in missing:
+            key = keys[prop]
+            raw = rows.get(key[-1], None)
+            if self.cache is not None and writes == self.writes:
+                value = self.cache.fill(key, raw)
+            else:
+                value = json.loads(raw) if raw else None
+            values[prop] = value if raw else default
+        return values
+
+    def _get_many(self, keys, props):
+        criteria = " AND ".join("{} = %s".format(key) for key in self.keys)
+        in_props = ", ".join("%s" for prop in props)
+
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT property, value from {} where {} AND property IN ({})'.format(self.table, criteria, in_props),
+                       tuple([*keys, *props]))
+        return dict(cursor.fetchall())
 
     async def set(self, *args):
         if len(args) != len(self.keys) + 2:
             raise Exception("Improper number of keys passed to set.")
-        prop = self.map_prop(args[-2])
+        key = (*args[:-2], self.map_prop(args[-2]))
         value = json.dumps(args[-1])
+
+        self.invalidate(key)
+        if self.buffer is not None:
+            # Reads see the buffered value until it is written
+            self.buffer.put(self.table, key, value)
+            if self.cache is not None:
+                self.cache.fill(key, value)
+            return
+
+        writes = self.writes
+        await self.executor.run(self._set, args[:-2], key[-1], value)
+        if self.cache is not None and writes == self.writes:
+            self.cache.fill(key, value)
+
+    def _set(self, keys, prop, value):
+        args = (*keys, prop, value)
         values = ", ".join("%s" for key in args)
 
         cursor = self.conn.cursor()
         cursor.execute('REPLACE INTO {} VALUES ({})'.format(self.table, values), tuple([*args[:-2], prop, value]))
 
+    async def set_many(self, *args):
+        """
+        Write several properties of the same keys, given as a dictionary of values by property,
+        as a single batched upsert.
+        """
+        if len(args) != len(self.keys) + 1:
+            raise Exception("Improper number of keys passed to set_many.")
+        values = {(*args[:-1], self.map_prop(prop)): json.dumps(value) for prop, value in args[-1].items()}
+        if not values:
+            return
+
+        for key in values:
+            self.invalidate(key)
+        if self.buffer is not None:
+            for key, value in values.items():
+                self.buffer.put(self.table, key, value)
+                if self.cache is not None:
+                    self.cache.fill(key, value)
+            return
+
+        writes = self.writes
+        await self.executor.run(self._set_many, [(*key, value) for key, value in values.items()])
+        if self.cache is not None and writes == self.writes:
+            for key, value in values.items():
+                self.cache.fill(key, value)
+
+    def _set_many(self, rows):
+        values = ", ".join("%s" for key in rows[0])
+
+        cursor = self.conn.cursor()
+        cursor.executemany('REPLACE INTO {} VALUES ({})'.format(self.table, values), rows)
+
     async def find(self, prop, value, read=False):
+        if len(self.keys) > 1:
+            raise Exception("This method cannot currently be used when there are multiple keys")
+        if self.buffer is not None:
+            await self.buffer.flush()
+        return await self.executor.run(self._find, self.map_prop(prop), json.dumps(value) if read else value)
+
+    def iter_find(self, prop, value, read=False, page_size=1000):
+        """
+        Iterate asynchronously over the keys with the given property value, as find, fetching them in pages.
+        Writes made while iterating may or may not be seen.
+        """
         if len(self.keys) > 1:
             raise Exception("This method cannot currently be used when there are multiple keys")
         prop = self.map_prop(prop)
-        if read:
-            value = json.dumps(value)
+        value = json.dumps(value) if read else value
+
+        def fetch_page(after, size):
+            return self._find_page(prop, value, after, size)
+        return PagedQuery(self.executor, fetch_page, page_size,
+                          before=self.buffer.flush if self.buffer is not None else None)
+
+    def _find_page(self, prop, value, after, size):
+        # Each page is a range of the property index, sorted by key
+        after_criteria = " AND {} > %s".format(self.keys[0]) if after is not None else ""
+        params = (prop, value, after, size) if after is not None else (prop, value, size)
 
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT {0} FROM {1} WHERE property = %s AND value = %s{2} ORDER BY {0} LIMIT %s'.format(
+            self.keys[0], self.table, after_criteria), params)
+        return [value[0] for value in cursor.fetchall()]
+
+    def _find(self, prop, value):
         cursor = self.conn.cursor()
         cursor.execute('SELECT {} FROM {} WHERE property = %s AND value = %s'.format(self.keys[0], self.table), (prop, value))
         return [value[0] for value in cursor.fetchall()]
@@ -101,8 +341,11 @@ class _propTableManipulator:
     async def find_not_empty(self, prop):
         if len(self.keys) > 1:
             raise Exception("This method cannot currently be used when there are multiple keys")
-        prop = self.map_prop(prop)
+        if self.buffer is not None:
+            await self.buffer.flush()
+        return await self.executor.run(self._find_not_empty, self.map_prop(prop))
 
+    def _find_not_empty(self, prop):
         cursor = self.conn.cursor()
         cursor.execute('SELECT {} FROM {} WHERE property = %s AND value IS NOT NULL AND value != \'\''.format(self.keys[0], self.table), (prop,))
         return [value[0] for value in cursor.fetchall()]
@@ -0,0 +1,167 @@
+import time
+import asyncio
+import logging
+
+"""
+Write-behind buffer for the BotData property tables.
+
+Property writes are held in memory, where reads see them immediately, and written to the database in batches,
+every `interval` milliseconds or once `max_ops` writes are pending, whichever comes first.
+Each batch is written as upserts in a single transaction, so a burst of writes costs one commit,
+and repeated writes of the same property within a batch are coalesced into one.
+A batch which fails to write is kept, and retried with the next batch.
+Writes which haven't been flushed are lost if the process dies, so the buffer is flushed when the data is closed.
+"""
+
+
+class WriteBuffer:
+    def __init__(self, executor, write_batch, interval=500, max_ops=100):
+        self.executor = executor
+        self.write_batch = write_batch
+        self.interval = interval
+        self.max_ops = max_ops
+
+        # Pending raw values, as {table: {(keys..., property): value}}
+        self.pending = {}
+        self.ops = 0
+
+        # The batch being written, still visible to reads until its transaction is committed
+        self.flushing = {}
+
+        self.timer = None
+
+        # The scheduled flush, of which at most one is outstanding
+        self.flush_task = None
+
+        # Statistics
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+        self.flush_time = 0
+
+    def lookup(self, table, key):
+        """
+        Look up a pending write.
+        Returns whether the property has a pending write, and its raw value.
+        """
+        for batch in (self.pending, self.flushing):
+            entries = batch.get(table, None)
+            if entries is not None and key in entries:
+                return (True, entries[key])
+        return (False, None)
+
+    def put(self, table, key, value):
+        """
+        Buffer a write of the raw value of a property, scheduling a flush.
+        """
+        entries = self.pending.setdefault(table, {})
+        if key in entries:
+            self.coalesced += 1
+        entries[key] = value
+        self.writes += 1
+        self.ops += 1
+        self._schedule()
+
+    def _schedule(self):
+        """
+        Schedule a flush, immediately if max_ops writes are pending, and otherwise after the interval,
+        unless a scheduled flush is outstanding, which schedules the next one when it is done.
+        """
+        if self.flush_task is not None or not self.pending:
+            return
+        if self.ops >= self.max_ops:
+            self.flush_task = asyncio.ensure_future(self._scheduled_flush())
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.interval / 1000, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self._scheduled_flush())
+
+    async def _scheduled_flush(self):
+        failures = self.failures
+        try:
+            await self.flush()
+        finally:
+            self.flush_task = None
+        # Schedule the writes made during the flush, unless it failed, in which case it is retried on the timer
+        if self.failures == failures:
+            self._schedule()
+
+    def _take(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending
+        self.pending = {}
+        self.ops = 0
+        return batch
+
+    def _restore(self, batch):
+        # Keep any newer writes made while the batch was being written, whether pending or taken by another flush
+        for table, entries in batch.items():
+            pending = self.pending.setdefault(table, {})
+            flushing = self.flushing.get(table, {})
+            for key, value in entries.items():
+                if key not in pending and flushing.get(key, value) is value:
+                    pending[key] = value
+                    self.ops += 1
+
+    async def flush(self):
+        """
+        Write every pending write to the database in a single transaction.
+        """
+        if not self.pending:
+            return
+        batch = self._take()
+        for table, entries in batch.items():
+            self.flushing.setdefault(table, {}).update(entries)
+
+        start = time.perf_counter()
+        try:
+            await self.executor.run(self.write_batch, batch)
+        except Exception:
+            logging.exception("Failed to write {} buffered property writes, retrying with the next batch.".format(
+                sum(len(entries) for entries in batch.values())
+            ))
+            self.failures += 1
+            self._restore(batch)
+            if self.timer is None:
+                self.timer = asyncio.get_event_loop().call_later(self.interval / 1000, self._on_timer)
+        else:
+            self.flushes += 1
+            self.flushed += sum(len(entries) for entries in batch.values())
+            self.flush_time += time.perf_counter() - start
+        finally:
+            # Reads submitted from now on are queued behind the batch
+            for table, entries in batch.items():
+                flushing = self.flushing.get(table, {})
+                for key, value in entries.items():
+                    if flushing.get(key, None) is value:
+                        del flushing[key]
+                if not flushing:
+                    self.flushing.pop(table, None)
+
+    def flush_sync(self):
+        """
+        Write every pending write to the database, blocking until the transaction is committed.
+        """
+        if self.pending:
+            batch = self._take()
+            self.executor.run_sync(self.write_batch, batch)
+            self.flushes += 1
+            self.flushed += sum(len(entries) for entries in batch.values())
+
+    def stats(self):
+        return {
+            "pending": sum(len(entries) for entries in self.pending.values()),
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+            "mean_batch": self.flushed / self.flushes if self.flushes else 0,
+            "mean_flush": self.flush_time / self.flushes if self.flushes else 0,
+            "failures": self.failures
+        }
@@ -0,0 +1,205 @@
+import sys
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+"""
+Expiring key-value store, backed by a hashed timer wheel with a single sweeper task.
+
+Entries are hashed into wheel slots by the first tick at or after their expiry, and the sweeper visits one slot per tick,
+expiring the entries in the slot which are due, so expiring an entry costs O(1) and there is no task per entry.
+Entries more than one rotation away stay in their slot until the wheel comes round to their tick.
+Lookups also check the expiry, so an entry the sweeper hasn't reached yet is never returned.
+Renewing an entry moves it to the slot of its new expiry tick.
+The store holds at most a fixed number of entries, evicting the least recently set or renewed entry when full.
+
+Usage:
+    store = TTLStore(ttl=600, max_entries=10000)
+    store.set(key, value)
+    store.renew(key)
+    value = store.get(key)
+"""
+
+
+class TTLEntry:
+    """
+    A value in the store, with its expiry time and wheel slot.
+    """
+    __slots__ = ("value", "expires", "slot")
+
+    def __init__(self, value, expires, slot):
+        self.value = value
+        self.expires = expires
+        self.slot = slot
+
+
+class TTLStore:
+    """
+    Store of values which expire a fixed time after they were last set or renewed.
+
+    Parameters
+    ----------
+    ttl: float
+        Default lifetime of an entry, in seconds.
+    max_entries: int
+        Maximum number of entries, or 0 for no limit.
+    tick: float
+        Resolution of the wheel, in seconds. Entries expire up to one tick late.
+    slots: int
+        Number of slots in the wheel.
+    on_expire: function(key, value)
+        Called when an entry expires or is evicted, but not when it is popped.
+    """
+    def __init__(self, ttl, max_entries=0, tick=1, slots=512, on_expire=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.tick = tick
+        self.on_expire = on_expire
+
+        self.entries = OrderedDict()
+        self.wheel = [set() for _ in range(slots)]
+
+        self.sweeper = None
+        self.last_tick = self._tick(time.time())
+
+        # Statistics
+        self.expired = 0
+        self.evicted = 0
+
+    def _tick(self, when):
+        return int(when // self.tick)
+
+    def _slot(self, expires):
+        # The first tick at or after the expiry, so the slot is never visited before the entry is due
+        return int(math.ceil(expires / self.tick)) % len(self.wheel)
+
+    def _live(self, key):
+        """
+        The entry for the key, or None if there is none, expiring it if it is due.
+        """
+        entry = self.entries.get(key, None)
+        if entry is not None and entry.expires <= time.time():
+            self.expired += 1
+            self._expire(key)
+            return None
+        return entry
+
+    def _ensure_sweeper(self):
+        if self.sweeper is None or self.sweeper.done():
+            self.last_tick = self._tick(time.time())
+            self.sweeper = asyncio.ensure_future(self._sweep())
+
+    def __contains__(self, key):
+        return self._live(key) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        entry = self._live(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry.value
+
+    def get(self, key, default=None):
+        entry = self._live(key)
+        return entry.value if entry is not None else default
+
+    def set(self, key, value, ttl=None):
+        """
+        Add or replace an entry, expiring after the given ttl or the default.
+        """
+        if self._live(key) is not None:
+            self.entries[key].value = value
+            self.renew(key, ttl=ttl)
+            return
+
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        entry = TTLEntry(value, expires, self._slot(expires))
+        self.entries[key] = entry
+        self.wheel[entry.slot].add(key)
+
+        while self.max_entries and len(self.entries) > self.max_entries:
+            old_key = next(iter(self.entries))
+            self.evicted += 1
+            self._expire(old_key)
+        self._ensure_sweeper()
+
+    def renew(self, key, ttl=None):
+        """
+        Restart the lifetime of an entry, if it exists.
+        Returns whether the entry exists.
+        """
+        entry = self._live(key)
+        if entry is None:
+            return False
+        self.wheel[entry.slot].discard(key)
+        entry.expires = time.time() + (ttl if ttl is not None else self.ttl)
+        entry.slot = self._slot(entry.expires)
+        self.wheel[entry.slot].add(key)
+        self.entries.move_to_end(key)
+        return True
+
+    def pop(self, key, default=None):
+        """
+        Remove an entry without calling the expiry callback, returning its value.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        self.wheel[entry.slot].discard(key)
+        return entry.value
+
+    def _expire(self, key):
+        value = self.pop(key)
+        if self.on_expire is not None:
+            try:
+                self.on_expire(key, value)
+            except Exception:
+                logging.exception("Exception in expiry callback for {}".format(key))
+
+    async def _sweep(self):
+        while self.entries:
+            # Wake at the start of the next tick
+            await asyncio.sleep(max((self.last_tick + 1) * self.tick - time.time(), 0))
+            now = time.time()
+            current = self._tick(now)
+
+            # Visit every slot we passed since the last sweep, at most once around the wheel
+            for tick in range(max(self.last_tick + 1, current - len(self.wheel) + 1), current + 1):
+                slot = self.wheel[tick % len(self.wheel)]
+                due = [key for key in slot if self.entries[key].expires <= now]
+                for key in due:
+                    self.expired += 1
+                    self._expire(key)
+            self.last_tick = current
+
+    def memory(self):
+        """
+        Approximate memory used by the store, in bytes, counting the values one level deep.
+        """
+        size = sys.getsizeof(self.entries) + sys.getsizeof(self.wheel)
+        size += sum(sys.getsizeof(slot) for slot in self.wheel)
+        for key, entry in self.entries.items():
+            size += sys.getsizeof(key) + sys.getsizeof(entry) + _value_size(entry.value)
+        return size
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "memory": self.memory()
+        }
+
+
+def _value_size(value):
+    size = sys.getsizeof(value)
+    if hasattr(value, "__slots__"):
+        size += sum(sys.getsizeof(getattr(value, attr, None)) for attr in value.__slots__)
+    elif hasattr(value, "__dict__"):
+        size += sum(sys.getsizeof(attr) for attr in vars(value).values())
+    return size
@@ -8,13 +8,13 @@ def load_into(bot):
         if not check:
             def check(message):
                 return ((message.content.lower() if lower else message.content) in chars)
-        msg = await ctx.bot.wait_for_message(author=ctx.author, check=check, timeout=timeout)
+        msg = await ctx.wait_for_message(author=ctx.author, check=check, timeout=timeout)
         return msg
 
     @bot.util
     async def input(ctx, msg="", timeout=120, prompt_msg=None):
         offer_msg = prompt_msg if prompt_msg is not None else await ctx.reply(msg)
-        result_msg = await ctx.bot.wait_for_message(author=ctx.author, channel=ctx.ch, timeout=timeout)
+        result_msg = await ctx.wait_for_message(channel=ctx.ch, author=ctx.author, timeout=timeout)
         if result_msg is None:
             return None
         result = result_msg.content
@@ -121,7 +121,7 @@ def load_into(bot):
         # send pages off to discord
         sent_message = await ctx.pager(pages)
         # get answer
-        user_answer = await ctx.bot.wait_for_message(author=ctx.author, timeout=timeout)
+        user_answer = await ctx.wait_for_message(author=ctx.author, timeout=timeout)
         try:
             # delete answer
             await ctx.bot.delete_message(sent_message)
@@ -303,7 +303,7 @@ def load_into(bot):
         to_return = None
 
         while invalid:
-            output = await ctx.bot.wait_for_message(author=ctx.author, timeout=600, channel=ctx.ch)
+            output = await ctx.wait_for_message(channel=ctx.ch, author=ctx.author, timeout=600)
             to_delete.append(output)
             if output is None:
                 break
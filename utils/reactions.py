@@ -0,0 +1,190 @@
+import asyncio
+import logging
+
+from timerwheel import TTLStore
+
+"""
+Central dispatcher for reactions on bot messages, replacing per-message `wait_for_reaction` loops.
+
+Handlers are registered for a message, and optionally a set of emojis, and are indexed by message id and emoji,
+so each reaction only reaches the handlers for its message.
+Handlers expire after a period with no matching reactions, through a single timer wheel.
+Reactions from the bot itself are ignored.
+
+Usage:
+    handler = ctx.bot.objects["reaction_router"].register(
+        message, callback, emojis=[emoji], check=check, ttl=300, on_expire=on_expire
+    )
+    callback: async function(reaction, user)
+        Called for each matching reaction, one at a time per handler.
+        The handler is renewed for another ttl after each matching reaction.
+    check: function(reaction, user) -> bool
+        Optional filter applied before the callback.
+    on_expire: async function() -> bool
+        Optional, called when the handler expires. If it returns True, the handler is kept for another ttl.
+    handler.finish(result):
+        Unregister the handler, without calling on_expire.
+    await handler.wait():
+        Wait for the handler to finish, returning the finish result, or None if it expired.
+
+Configuration (bot configuration file):
+    reaction_handlers_max: int
+        Maximum number of live handlers, expiring the least recently used first. 0 for no limit.
+
+Bot Objects:
+    reaction_router: ReactionRouter
+"""
+
+
+def emoji_key(emoji):
+    """
+    Hashable key for a unicode or custom emoji.
+    """
+    return getattr(emoji, "id", None) or str(emoji)
+
+
+class ReactionHandler:
+    """
+    A registered reaction handler for a single message.
+    """
+    __slots__ = ("router", "message_id", "keys", "callback", "check", "ttl", "on_expire", "lock", "future")
+
+    def __init__(self, router, message_id, keys, callback, check, ttl, on_expire):
+        self.router = router
+        self.message_id = message_id
+        self.keys = keys
+        self.callback = callback
+        self.check = check
+        self.ttl = ttl
+        self.on_expire = on_expire
+
+        self.lock = asyncio.Lock()
+        self.future = asyncio.get_event_loop().create_future()
+
+    @property
+    def active(self):
+        return self in self.router.handlers
+
+    def finish(self, result=None):
+        """
+        Unregister the handler, resolving `wait` with the result.
+        """
+        self.router._remove(self)
+        if not self.future.done():
+            self.future.set_result(result)
+
+    def renew(self):
+        self.router.handlers.renew(self, ttl=self.ttl)
+
+    async def wait(self):
+        return await asyncio.shield(self.future)
+
+    async def _run(self, reaction, user):
+        async with self.lock:
+            if not self.active:
+                return
+            try:
+                await self.callback(reaction, user)
+            except Exception:
+                logging.exception("Exception in reaction handler for message {}".format(self.message_id))
+
+    async def _expire(self):
+        keep = False
+        if self.on_expire is not None:
+            try:
+                keep = await self.on_expire()
+            except Exception:
+                logging.exception("Exception in reaction expiry handler for message {}".format(self.message_id))
+        if keep:
+            self.router._add(self)
+        elif not self.future.done():
+            self.future.set_result(None)
+
+
+class ReactionRouter:
+    def __init__(self, bot, max_handlers=0):
+        self.bot = bot
+
+        # Handlers indexed by message id, then emoji key, with None for handlers of any emoji
+        self.index = {}
+
+        # Registered handlers, expiring through the timer wheel
+        self.handlers = TTLStore(ttl=300, max_entries=max_handlers, on_expire=self._expired)
+
+        # Statistics
+        self.dispatched = 0
+
+    def register(self, message, callback, emojis=None, check=None, ttl=300, on_expire=None):
+        """
+        Register a handler for reactions on the given message.
+        Returns the ReactionHandler.
+        """
+        keys = [emoji_key(emoji) for emoji in emojis] if emojis is not None else [None]
+        handler = ReactionHandler(self, message.id, keys, callback, check, ttl, on_expire)
+        self._add(handler)
+        return handler
+
+    def _add(self, handler):
+        emojis = self.index.setdefault(handler.message_id, {})
+        for key in handler.keys:
+            emojis.setdefault(key, []).append(handler)
+        self.handlers.set(handler, None, ttl=handler.ttl)
+
+    def _remove(self, handler):
+        self.handlers.pop(handler)
+        self._unindex(handler)
+
+    def _unindex(self, handler):
+        emojis = self.index.get(handler.message_id, None)
+        if emojis is None:
+            return
+        for key in handler.keys:
+            handlers = emojis.get(key, [])
+            if handler in handlers:
+                handlers.remove(handler)
+            if not handlers:
+                emojis.pop(key, None)
+        if not emojis:
+            del self.index[handler.message_id]
+
+    def _expired(self, handler, value):
+        # The store has already dropped the handler
+        self._unindex(handler)
+        asyncio.ensure_future(handler._expire())
+
+    def clear(self, message_id):
+        """
+        Finish every handler for a message, e.g. when it is deleted.
+        """
+        for emojis in list(self.index.get(message_id, {}).values()):
+            for handler in list(emojis):
+                handler.finish()
+
+    async def dispatch(self, reaction, user):
+        emojis = self.index.get(reaction.message.id, None)
+        if emojis is None or user == self.bot.user:
+            return
+
+        handlers = emojis.get(emoji_key(reaction.emoji), []) + emojis.get(None, [])
+        for handler in handlers:
+            if handler.check is not None and not handler.check(reaction, user):
+                continue
+            self.dispatched += 1
+            handler.renew()
+            asyncio.ensure_future(handler._run(reaction, user))
+
+    def stats(self):
+        return {
+            "handlers": len(self.handlers),
+            "messages": len(self.index),
+            "dispatched": self.dispatched
+        }
+
+
+async def route_reaction(bot, reaction, user):
+    await bot.objects["reaction_router"].dispatch(reaction, user)
+
+
+def load_into(bot):
+    bot.objects["reaction_router"] = ReactionRouter(bot, max_handlers=bot.bot_conf.get("reaction_handlers_max", 0))
+    bot.add_after_event("reaction_add", route_reaction)
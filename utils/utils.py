@@ -203,7 +203,7 @@ def load_into(bot):
         emo_prev = ctx.bot.objects["emoji_prev"]
 
         def check(reaction, user):
-            return (reaction.emoji in [emo_next, emo_prev]) and (not (user == ctx.me)) and (not locked or user == ctx.author)
+            return (not locked or user == ctx.author)
         try:
             await ctx.bot.add_reaction(out_msg, emo_prev)
             await ctx.bot.add_reaction(out_msg, emo_next)
@@ -211,25 +211,22 @@ def load_into(bot):
             await ctx.reply("Cannot page results because I do not have permissions to add emojis!")
             return
 
-        async def paging():
-            page = start_page
-            while True:
-                res = await ctx.bot.wait_for_reaction(message=out_msg,
-                                                      timeout=300,
-                                                      check=check)
-                if res is None:
-                    break
-                try:
-                    await ctx.bot.remove_reaction(out_msg, res.reaction.emoji, res.user)
-                except discord.Forbidden:
-                    pass
-                page += 1 if res.reaction.emoji == emo_next else -1
-                if page == -1:
-                    page = len(pages) - 1
-                if page == len(pages):
-                    page = 0
-                args[arg] = pages[page]
-                await ctx.bot.edit_message(out_msg, **args)
+        page = [start_page]
+
+        async def paging(reaction, user):
+            try:
+                await ctx.bot.remove_reaction(out_msg, reaction.emoji, user)
+            except discord.Forbidden:
+                pass
+            page[0] += 1 if reaction.emoji == emo_next else -1
+            if page[0] == -1:
+                page[0] = len(pages) - 1
+            if page[0] == len(pages):
+                page[0] = 0
+            args[arg] = pages[page[0]]
+            await ctx.bot.edit_message(out_msg, **args)
+
+        async def paging_expired():
             try:
                 await ctx.bot.remove_reaction(out_msg, emo_prev, ctx.me)
                 await ctx.bot.remove_reaction(out_msg, emo_next, ctx.me)
@@ -238,7 +235,9 @@ def load_into(bot):
                 pass
             except discord.NotFound:
                 pass
-        asyncio.ensure_future(paging())
+
+        ctx.bot.objects["reaction_router"].register(out_msg, paging, emojis=[emo_next, emo_prev], check=check,
+                                                    on_expire=paging_expired)
         return out_msg
 
     @bot.util
@@ -367,23 +366,24 @@ def load_into(bot):
         except discord.Forbidden:
             return
 
-        res = await ctx.bot.wait_for_reaction(message=out_msg,
-                                              emoji=ctx.bot.objects["emoji_delete"],
-                                              check=check,
-                                              timeout=300)
-        if res is None:
-            try:
-                await ctx.bot.remove_reaction(out_msg, ctx.bot.objects["emoji_delete"], ctx.me)
-            except Exception:
-                pass
-        elif res.reaction.emoji == ctx.bot.objects["emoji_delete"]:
-            to_delete = to_delete if to_delete is not None else [out_msg]
-            for msg in to_delete:
+        async def delete(reaction, user):
+            handler.finish()
+            for msg in (to_delete if to_delete is not None else [out_msg]):
                 try:
                     await ctx.bot.delete_message(msg)
                 except Exception:
                     pass
 
+        async def delete_expired():
+            try:
+                await ctx.bot.remove_reaction(out_msg, ctx.bot.objects["emoji_delete"], ctx.me)
+            except Exception:
+                pass
+
+        handler = ctx.bot.objects["reaction_router"].register(out_msg, delete, emojis=[ctx.bot.objects["emoji_delete"]],
+                                                              check=check, on_expire=delete_expired)
+        return handler
+
     @bot.util
     async def find_message(ctx, msgid, chlist=None, ignore=[]):
         message = None
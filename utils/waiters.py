@@ -0,0 +1,124 @@
+import asyncio
+import logging
+
+from timerwheel import TTLStore
+
+"""
+Central registry of coroutines waiting for a message, replacing per-call `wait_for_message` predicates.
+
+Waiters are indexed by (channel id, author id), with None matching any channel or any author,
+so each message only reaches the waiters for its channel and author, instead of testing every outstanding waiter.
+Timeouts are handled by a single timer wheel rather than a timer per waiter.
+
+Usage:
+    message = await ctx.bot.objects["message_waiters"].wait(channel=ctx.ch, author=ctx.author, check=check, timeout=30)
+    channel, author: Channel and User, or None to match any.
+    check: function(message) -> bool
+        Optional filter applied to messages matching the channel and author.
+    Returns the first matching message, or None on timeout.
+
+Bot Objects:
+    message_waiters: WaiterRegistry
+"""
+
+
+class MessageWaiter:
+    """
+    A coroutine waiting for a message.
+    """
+    __slots__ = ("key", "check", "future")
+
+    def __init__(self, key, check):
+        self.key = key
+        self.check = check
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class WaiterRegistry:
+    def __init__(self):
+        # Waiters indexed by (channel id, author id), with None as a wildcard
+        self.index = {}
+
+        # Waiters with a timeout, expiring through the timer wheel
+        self.timers = TTLStore(ttl=120, on_expire=self._timed_out)
+
+        # Statistics
+        self.messages = 0
+        self.matched = 0
+        self.timed_out = 0
+
+    async def wait(self, channel=None, author=None, check=None, timeout=None):
+        """
+        Wait for the next message in the channel from the author, which passes the check.
+        Returns the message, or None on timeout.
+        """
+        key = (channel.id if channel is not None else None, author.id if author is not None else None)
+        waiter = MessageWaiter(key, check)
+        self.index.setdefault(key, []).append(waiter)
+        if timeout is not None:
+            self.timers.set(waiter, None, ttl=timeout)
+        try:
+            return await waiter.future
+        finally:
+            self._remove(waiter)
+
+    def _remove(self, waiter):
+        self.timers.pop(waiter)
+        waiters = self.index.get(waiter.key, None)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self.index[waiter.key]
+
+    def _timed_out(self, waiter, value):
+        if not waiter.future.done():
+            self.timed_out += 1
+            waiter.future.set_result(None)
+
+    def dispatch(self, message):
+        if not self.index:
+            return
+        self.messages += 1
+
+        chid = message.channel.id
+        authid = message.author.id
+        for key in ((chid, authid), (chid, None), (None, authid), (None, None)):
+            for waiter in list(self.index.get(key, ())):
+                if waiter.future.done():
+                    continue
+                if waiter.check is not None:
+                    try:
+                        matches = waiter.check(message)
+                    except Exception as e:
+                        # Fail this waiter, without stopping the message reaching the others
+                        logging.exception("Exception in message waiter check.")
+                        waiter.future.set_exception(e)
+                        self._remove(waiter)
+                        continue
+                    if not matches:
+                        continue
+                self.matched += 1
+                waiter.future.set_result(message)
+                self._remove(waiter)
+
+    def stats(self):
+        return {
+            "waiting": sum(len(waiters) for waiters in self.index.values()),
+            "keys": len(self.index),
+            "messages": self.messages,
+            "matched": self.matched,
+            "timed_out": self.timed_out
+        }
+
+
+async def dispatch_message(bot, message):
+    bot.objects["message_waiters"].dispatch(message)
+
+
+def load_into(bot):
+    bot.objects["message_waiters"] = WaiterRegistry()
+    bot.add_after_event("message", dispatch_message)
+
+    @bot.util
+    async def wait_for_message(ctx, channel=None, author=None, check=None, timeout=None):
+        return await ctx.bot.objects["message_waiters"].wait(channel=channel, author=author, check=check, timeout=timeout)